@@ -0,0 +1,453 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of the store and retrieve hot paths.
+
+Run from the repository root:
+
+    python -m benchmarks.bench --output results.json
+    python -m benchmarks.bench --backend s3 --endpoint http://localhost:9000 \\
+        --bucket history-bench --output results.json
+    python -m benchmarks.bench --compare baseline.json results.json
+
+The `s3` backend needs a versioned bucket; it is created on the endpoint if
+missing, which makes a local S3 stand-in (MinIO, `moto_server`) convenient.
+The `fs` backend (`FilesystemCacheStorage`) needs nothing.
+
+Every case runs in its own process so that its peak RSS is not inflated by
+the cases before it. Responses are generated from a fixed seed, so two runs
+on the same machine measure the same work.
+
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+import argparse
+from datetime import datetime
+import json
+from multiprocessing.pool import ThreadPool
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+from timeit import default_timer
+
+KB = 1024
+MB = 1024 * KB
+DEFAULT_SIZES = '1k,64k,1m,50m'
+# upper bound on the bytes processed by a case, to keep big bodies quick
+CASE_BYTES = 256 * MB
+WORDS = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing',
+         'elit', 'sed', 'do', 'eiusmod', 'tempor', 'été', 'über']
+
+
+def parse_size(size):
+    units = {'k': KB, 'm': MB}
+    size = size.strip().lower()
+    if size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def make_body(kind, size, seed=0):
+    """Body of `size` bytes: an HTML page, or random (incompressible) bytes.
+    A block of at most 1 MB is generated and repeated.
+
+    """
+    rnd = random.Random(seed)
+    block_size = min(size, MB)
+    if kind == 'binary':
+        block = bytes(bytearray(rnd.getrandbits(8) for _ in range(block_size)))
+    else:
+        words = []
+        length = 0
+        while length < block_size:
+            word = rnd.choice(WORDS)
+            words.append(word)
+            length += len(word.encode('utf-8')) + 1
+        block = ' '.join(words).encode('utf-8')
+
+    body = block * (size // len(block) + 1)
+    if kind == 'binary':
+        return body[:size]
+    # cut on a character boundary so that the body stays valid UTF-8
+    return (b'<html><body><p>' + body)[:size].decode('utf-8', 'ignore').encode('utf-8')
+
+
+def make_response(kind, size, url='http://example.com/', seed=0):
+    from scrapy.http import HtmlResponse, Request, Response
+
+    request = Request(url)
+    body = make_body(kind, size, seed)
+    if kind == 'binary':
+        return request, Response(url, body=body, request=request,
+                                 headers={'Content-Type': 'application/octet-stream'})
+    return request, HtmlResponse(url, body=body, encoding='utf-8', request=request,
+                                 headers={'Content-Type': 'text/html; charset=utf-8'})
+
+
+def iterations(size, maximum=200):
+    return max(3, min(maximum, CASE_BYTES // max(size, 1)))
+
+
+def percentile(values, q):
+    values = sorted(values)
+    index = int(round(q / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def timed(func, count):
+    latencies = []
+    for _ in range(count):
+        start = default_timer()
+        func()
+        latencies.append(default_timer() - start)
+    return latencies
+
+
+def peak_rss_mb():
+    # kilobytes on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (MB if sys.platform == 'darwin' else KB)
+
+
+class Backend(object):
+    """Storage backend set up for a benchmark case."""
+
+    def __init__(self, options):
+        from scrapy.spiders import Spider
+        from scrapy.utils.test import get_crawler
+
+        self.options = options
+        self.tmpdir = tempfile.mkdtemp(prefix='history-bench-')
+        settings = {
+            'HISTORY_FS_DIR': self.tmpdir,
+            'HISTORY_RECORD_FORMAT': options['format'],
+            'HISTORY_COMPRESSION': options['compression'],
+        }
+        if options['backend'] == 's3':
+            from history.storage import S3CacheStorage as storage_class
+            settings.update({
+                'HISTORY_S3_BUCKET': options['bucket'],
+                'HISTORY_S3_ENDPOINT': options['endpoint'],
+                'AWS_ACCESS_KEY_ID': options['access_key'],
+                'AWS_SECRET_ACCESS_KEY': options['secret_key'],
+            })
+            self._create_bucket()
+        else:
+            from history.storage import FilesystemCacheStorage as storage_class
+
+        crawler = get_crawler(settings_dict=settings)
+        crawler.stats.set_value('start_time', datetime.utcnow())
+        # a spider per run, so that cases don't see each other's versions
+        self.spider = Spider('bench{}'.format(os.getpid()))
+        start = default_timer()
+        self.storage = storage_class(crawler.stats, crawler.settings)
+        self.storage.open_spider(self.spider)
+        self.open_time = default_timer() - start
+
+    def _create_bucket(self):
+        from history import s3
+
+        connection = s3.connect(self.options['access_key'], self.options['secret_key'],
+                                endpoint=self.options['endpoint'])
+        bucket = connection.lookup(self.options['bucket'])
+        if bucket is None:
+            bucket = connection.create_bucket(self.options['bucket'])
+            bucket.configure_versioning(True)
+        connection.close()
+
+    def close(self):
+        self.storage.close_spider(self.spider)
+        shutil.rmtree(self.tmpdir)
+
+
+def bench_reformat(options, kind, size):
+    from history.record import _reformat_response
+
+    _, response = make_response(kind, size)
+    return timed(lambda: _reformat_response(response), iterations(size)), size
+
+
+def bench_decode_body(options, kind, size):
+    from history.record import _try_decoding_response_body
+
+    body = make_body(kind, size)
+    return timed(lambda: _try_decoding_response_body(body, 'utf-8'), iterations(size)), size
+
+
+def _codec(options):
+    from scrapy.utils.test import get_crawler
+
+    from history.record import RecordCodec
+
+    return RecordCodec(get_crawler(settings_dict={
+        'HISTORY_RECORD_FORMAT': options['format'],
+        'HISTORY_COMPRESSION': options['compression'],
+    }).settings)
+
+
+def bench_encode(options, kind, size):
+    codec = _codec(options)
+    request, response = make_response(kind, size)
+    return timed(lambda: codec.encode(request, response), iterations(size)), size
+
+
+def bench_decode(options, kind, size):
+    codec = _codec(options)
+    data, _ = codec.encode(*make_response(kind, size))
+    return timed(lambda: codec.decode(data), iterations(size)), size
+
+
+def bench_store(options, kind, size):
+    backend = Backend(options)
+    try:
+        request, response = make_response(kind, size)
+        store = lambda: backend.storage.store_response(backend.spider, request, response)  # noqa
+        return timed(store, iterations(size, 50)), size
+    finally:
+        backend.close()
+
+
+def bench_retrieve(options, kind, size):
+    backend = Backend(options)
+    try:
+        request, response = make_response(kind, size)
+        backend.storage.store_response(backend.spider, request, response)
+        request.meta['epoch'] = True
+        retrieve = lambda: backend.storage.retrieve_response(backend.spider, request)  # noqa
+        return timed(retrieve, iterations(size, 50)), size
+    finally:
+        backend.close()
+
+
+def bench_versions(options, kind, size):
+    """Retrieve the first version of a key stored many times."""
+    backend = Backend(options)
+    try:
+        epoch = datetime.utcnow()
+        for seed in range(options['versions']):
+            request, response = make_response(kind, size, seed=seed)
+            backend.storage.store_response(backend.spider, request, response)
+        request.meta['epoch'] = epoch
+        if options['backend'] == 's3':
+            # version lookup only, without downloading the record
+            key = backend.storage._get_request_storage_key(backend.spider, request)
+            lookup = lambda: backend.storage._get_s3_key(key, epoch)  # noqa
+        else:
+            lookup = lambda: backend.storage.retrieve_response(backend.spider, request)  # noqa
+        return timed(lookup, 50), size
+    finally:
+        backend.close()
+
+
+def bench_concurrent(options, kind, size):
+    """Retrieve distinct keys from `concurrency` threads at once."""
+    backend = Backend(options)
+    try:
+        requests = []
+        for seed in range(options['concurrency'] * 4):
+            request, response = make_response(kind, size, 'http://example.com/{}'.format(seed),
+                                              seed=seed)
+            backend.storage.store_response(backend.spider, request, response)
+            request.meta['epoch'] = True
+            requests.append(request)
+
+        def retrieve(request):
+            start = default_timer()
+            backend.storage.retrieve_response(backend.spider, request)
+            return default_timer() - start
+
+        pool = ThreadPool(options['concurrency'])
+        try:
+            start = default_timer()
+            latencies = pool.map(retrieve, requests * 4)
+            wall = default_timer() - start
+        finally:
+            pool.close()
+        return latencies, size, wall
+    finally:
+        backend.close()
+
+
+IMPORT_CODE = """
+import scrapy.http, scrapy.spiders, twisted.internet.defer
+from timeit import default_timer
+start = default_timer()
+import history.middleware, history.storage
+print(default_timer() - start)
+"""
+
+
+def bench_import(options, kind, size):
+    """Import the middleware and the storage backends in a fresh
+    interpreter, on top of Scrapy and Twisted.
+
+    """
+    return [float(subprocess.check_output([sys.executable, '-c', IMPORT_CODE]))
+            for _ in range(20)], size
+
+
+def bench_open_spider(options, kind, size):
+    """Build the storage backend and open the spider."""
+    latencies = []
+    for _ in range(20):
+        backend = Backend(options)
+        latencies.append(backend.open_time)
+        backend.close()
+    return latencies, size
+
+
+CASES = {
+    'reformat': bench_reformat,
+    'decode_body': bench_decode_body,
+    'encode': bench_encode,
+    'decode': bench_decode,
+    'store': bench_store,
+    'retrieve': bench_retrieve,
+    'versions': bench_versions,
+    'concurrent': bench_concurrent,
+    'import': bench_import,
+    'open_spider': bench_open_spider,
+}
+# cases whose cost doesn't depend much on the body size
+FIXED_SIZE_CASES = {'versions': 16 * KB, 'concurrent': 64 * KB, 'import': 0, 'open_spider': 0}
+
+
+def run_case(options, case, kind, size):
+    result = CASES[case](options, kind, size)
+    latencies, size = result[:2]
+    wall = result[2] if len(result) > 2 else sum(latencies)
+    return {
+        'case': case,
+        'kind': kind,
+        'size': size,
+        'operations': len(latencies),
+        'ops_per_sec': len(latencies) / wall,
+        'mb_per_sec': len(latencies) * size / wall / MB,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def run_isolated(options, case, kind, size):
+    command = [sys.executable, '-m', 'benchmarks.bench', '--child',
+               json.dumps([options, case, kind, size])]
+    return json.loads(subprocess.check_output(command).decode('utf-8'))
+
+
+def environment(options):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                         stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    import scrapy
+
+    return {
+        'date': datetime.utcnow().isoformat(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'scrapy': scrapy.__version__,
+        'platform': platform.platform(),
+        'options': {k: v for k, v in options.items() if k not in ('access_key', 'secret_key')},
+    }
+
+
+def format_table(results):
+    lines = ['{:<12} {:<7} {:>9} {:>6} {:>10} {:>9} {:>9} {:>9} {:>9}'.format(
+        'case', 'kind', 'size', 'ops', 'ops/s', 'MB/s', 'p50 ms', 'p99 ms', 'RSS MB')]
+    row = '{:<12} {:<7} {:>9} {:>6} {:>10.1f} {:>9.1f} {:>9.3f} {:>9.3f} {:>9.1f}'
+    for r in results:
+        lines.append(row.format(
+            r['case'], r['kind'], r['size'], r['operations'], r['ops_per_sec'],
+            r['mb_per_sec'], r['p50_ms'], r['p99_ms'], r['peak_rss_mb']))
+    return '\n'.join(lines)
+
+
+def compare(baseline, current):
+    """Print the change of each metric between two result files; ratios
+    above 1 mean `current` is slower (or bigger).
+
+    """
+    def by_case(report):
+        return {(r['case'], r['kind'], r['size']): r for r in report['results']}
+
+    baseline, current = by_case(baseline), by_case(current)
+    print('{:<12} {:<7} {:>9} {:>10} {:>10} {:>10}'.format(
+        'case', 'kind', 'size', 'p50', 'p99', 'RSS'))
+    for key in sorted(set(baseline) & set(current)):
+        before, after = baseline[key], current[key]
+        print('{:<12} {:<7} {:>9} {:>9.2f}x {:>9.2f}x {:>9.2f}x'.format(
+            key[0], key[1], key[2],
+            after['p50_ms'] / before['p50_ms'],
+            after['p99_ms'] / before['p99_ms'],
+            after['peak_rss_mb'] / before['peak_rss_mb']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--backend', choices=['fs', 's3'], default='fs')
+    parser.add_argument('--endpoint', help='S3 endpoint, e.g. http://localhost:9000')
+    parser.add_argument('--bucket', default='history-bench')
+    parser.add_argument('--access-key', default=os.getenv('AWS_ACCESS_KEY_ID', 'bench'))
+    parser.add_argument('--secret-key', default=os.getenv('AWS_SECRET_ACCESS_KEY', 'bench'))
+    parser.add_argument('--format', default='binary', choices=['binary', 'json'])
+    parser.add_argument('--compression', default='gzip')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help='comma separated body sizes (default: %(default)s)')
+    parser.add_argument('--kinds', default='text,binary')
+    parser.add_argument('--cases', default=','.join(sorted(CASES)))
+    parser.add_argument('--versions', type=int, default=100,
+                        help='versions stored by the `versions` case')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='threads of the `concurrent` case')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'))
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(run_case(*json.loads(args.child))))
+        return
+
+    if args.compare:
+        with open(args.compare[0]) as f, open(args.compare[1]) as g:
+            compare(json.load(f), json.load(g))
+        return
+
+    if args.backend == 's3' and not args.endpoint:
+        parser.error('--backend s3 requires --endpoint')
+
+    options = {
+        'backend': args.backend,
+        'endpoint': args.endpoint,
+        'bucket': args.bucket,
+        'access_key': args.access_key,
+        'secret_key': args.secret_key,
+        'format': args.format,
+        'compression': args.compression,
+        'versions': args.versions,
+        'concurrency': args.concurrency,
+    }
+    results = []
+    for case in args.cases.split(','):
+        sizes = [FIXED_SIZE_CASES[case]] if case in FIXED_SIZE_CASES else \
+            [parse_size(size) for size in args.sizes.split(',')]
+        for kind in args.kinds.split(','):
+            for size in sizes:
+                results.append(run_isolated(options, case, kind, size))
+                print(format_table(results[-1:]).split('\n')[1], file=sys.stderr)
+
+    report = {'environment': environment(options), 'results': results}
+    print(format_table(results))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
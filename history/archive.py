@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""Packed archives of cache records.
+
+An archive is a plain concatenation of frames, one per stored record:
+
+    timestamp (double) | fingerprint length (ushort) | data length (uint)
+    fingerprint | data
+
+Frames are self-describing so an archive which was not closed properly
+(e.g. the spider crashed) can be scanned again to rebuild its index. The
+index maps each fingerprint to the (timestamp, offset, length) of its
+records data, which allows a single record to be read with a ranged GET.
+
+"""
+
+from __future__ import absolute_import, unicode_literals
+import bisect
+import json
+import logging
+import os
+import struct
+import time
+
+from history.index import _select_version
+
+logger = logging.getLogger(__name__)
+
+FRAME = struct.Struct('>dHI')
+INDEX_VERSION = 1
+# archives are uploaded to `{name}/segments/{id}`, followed by their index
+# `{name}/segments/{id}.idx`
+INDEX_SUFFIX = '.idx'
+
+
+class ArchiveWriter(object):
+    """Append records to an archive file and keep track of their offsets.
+
+    With `flush`, each record is handed to the OS as soon as it is
+    appended, so that it survives the process; with `fsync` too, it is
+    also synced to disk, to survive the host.
+
+    """
+
+    def __init__(self, path, flush=False, fsync=False):
+        self.path = path
+        self.flush_records = flush or fsync
+        self.fsync_records = fsync
+        self.file = open(path, 'ab')
+        self.size = os.path.getsize(path)
+        self.entries = []
+        self.created = time.time()
+
+    def append(self, fingerprint, timestamp, data):
+        fingerprint = fingerprint.encode('ascii')
+        self.file.write(FRAME.pack(timestamp, len(fingerprint), len(data)))
+        self.file.write(fingerprint)
+        self.file.write(data)
+
+        offset = self.size + FRAME.size + len(fingerprint)
+        self.entries.append((fingerprint.decode('ascii'), timestamp, offset, len(data)))
+        self.size = offset + len(data)
+        if self.fsync_records:
+            self.flush()
+        elif self.flush_records:
+            self.file.flush()
+
+    def flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        return self.entries
+
+
+def scan_archive(path):
+    """Rebuild the index entries of an archive from its frames.
+
+    A truncated trailing frame (the process died while writing it) is cut
+    off the file.
+
+    """
+    entries = []
+    offset = 0
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        while offset + FRAME.size <= size:
+            timestamp, fingerprint_length, data_length = FRAME.unpack(f.read(FRAME.size))
+            data_offset = offset + FRAME.size + fingerprint_length
+            if data_offset + data_length > size:
+                break
+            fingerprint = f.read(fingerprint_length).decode('ascii')
+            entries.append((fingerprint, timestamp, data_offset, data_length))
+            f.seek(data_length, os.SEEK_CUR)
+            offset = data_offset + data_length
+
+    if offset < size:
+        logger.info('truncating {} bytes of partial record in {}'.format(size - offset, path))
+        with open(path, 'ab') as f:
+            f.truncate(offset)
+
+    return entries
+
+
+def dump_index(entries, **metadata):
+    """Serialize index entries along with free-form archive metadata."""
+    index = {
+        'version': INDEX_VERSION,
+        'metadata': metadata,
+        'entries': [list(entry) for entry in entries],
+    }
+    return json.dumps(index).encode('utf-8')
+
+
+def load_index(data):
+    """Return the (entries, metadata) of a serialized index."""
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    index = json.loads(data)
+    entries = [tuple(entry) for entry in index['entries']]
+    return entries, index.get('metadata', {})
+
+
+def read_record(path, offset, length):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+class ArchiveIndex(object):
+    """Merged index of many archives: fingerprint => versions, sorted from
+    the oldest to the most recent.
+
+    """
+
+    def __init__(self):
+        self.versions = {}
+
+    def __len__(self):
+        return len(self.versions)
+
+    def __contains__(self, fingerprint):
+        return fingerprint in self.versions
+
+    def add(self, archive, entries):
+        for fingerprint, timestamp, offset, length in entries:
+            versions = self.versions.setdefault(fingerprint, [])
+            bisect.insort(versions, (timestamp, archive, offset, length))
+
+    def lookup(self, fingerprint, epoch):
+        """Return the (timestamp, archive, offset, length) of the version
+        matching epoch, or None.
+
+        """
+        return _select_version(self.versions.get(fingerprint), epoch)
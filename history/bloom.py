@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""Bloom filter of the fingerprints stored for a spider.
+
+A request whose fingerprint is not in the filter was never stored, so its
+retrieval can be skipped without any S3 request; a fingerprint in the
+filter may still be a false positive, at the configured error rate, and is
+looked up as usual.
+
+Serialized filters are a header, `magic | size in bits (uint64) | hashes
+(ushort)`, followed by the bits.
+
+"""
+
+from __future__ import absolute_import, unicode_literals
+import hashlib
+import math
+import struct
+import threading
+
+HEADER = struct.Struct('>4sQH')
+MAGIC = b'HBF1'
+BIT_COUNTS = [bin(byte).count('1') for byte in range(256)]
+
+
+class BloomFilter(object):
+
+    def __init__(self, size, hashes, bits=None):
+        self.size = size
+        self.hashes = hashes
+        self.bits = bytearray(bits) if bits is not None else bytearray((size + 7) // 8)
+        self.lock = threading.Lock()
+        self.dirty = False
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate=0.01):
+        """Filter holding capacity fingerprints with the given rate of false
+        positives.
+
+        """
+        capacity = max(1, capacity)
+        size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        hashes = max(1, int(round(size / float(capacity) * math.log(2))))
+        return cls(size, hashes)
+
+    def _positions(self, fingerprint):
+        # double hashing: k positions out of two 64 bits hashes
+        h1, h2 = struct.unpack('>QQ', hashlib.md5(fingerprint.encode('ascii')).digest())
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, fingerprint):
+        positions = self._positions(fingerprint)
+        with self.lock:
+            for position in positions:
+                self.bits[position >> 3] |= 1 << (position & 7)
+            self.dirty = True
+
+    def __contains__(self, fingerprint):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(fingerprint))
+
+    def _ones(self):
+        return sum(BIT_COUNTS[byte] for byte in self.bits)
+
+    @property
+    def saturated(self):
+        """Whether every bit is set, so that every fingerprint is in."""
+        return self._ones() >= self.size
+
+    def estimated_count(self):
+        """Estimated number of fingerprints added, at most `size` (when the
+        filter is saturated).
+
+        """
+        ones = self._ones()
+        if ones >= self.size:
+            return self.size
+        return min(self.size, int(round(
+            -self.size / float(self.hashes) * math.log(1 - ones / float(self.size)))))
+
+    def update(self, other):
+        """Add the fingerprints of a filter of the same parameters."""
+        if (other.size, other.hashes) != (self.size, self.hashes):
+            raise ValueError('cannot merge Bloom filters of different parameters')
+        with self.lock:
+            for i, byte in enumerate(other.bits):
+                self.bits[i] |= byte
+
+    def dumps(self):
+        with self.lock:
+            return HEADER.pack(MAGIC, self.size, self.hashes) + bytes(self.bits)
+
+    @classmethod
+    def loads(cls, data):
+        magic, size, hashes = HEADER.unpack(data[:HEADER.size])
+        if magic != MAGIC:
+            raise ValueError('not a Bloom filter')
+        return cls(size, hashes, data[HEADER.size:])
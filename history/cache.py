@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+from datetime import datetime
+import glob
+import logging
+import os
+import threading
+import time
+
+from scrapy.utils.misc import load_object
+from twisted.internet import defer
+
+from history.index import _to_timestamp
+from history.lru import LRUCache
+from history.metrics import Metrics
+from history.record import LazyBody, RecordCodec, body_length, copy_response, decode_record
+from history.storage import _write_file
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIERED_BACKEND = 'history.storage.S3CacheStorage'
+
+
+def _response_size(response):
+    """Rough memory footprint of a response, in bytes."""
+    headers_size = sum(len(k) + sum(len(v) for v in values)
+                       for k, values in response.headers.items())
+    return body_length(response) + len(response.url) + headers_size
+
+
+class TieredCacheStorage(object):
+    """Read-through cache in front of another storage backend.
+
+    Retrieved responses are kept in an in-process LRU bounded to
+    HISTORY_MEMORY_CACHE_SIZE bytes and, if HISTORY_DISK_CACHE_DIR is set,
+    in a local disk cache bounded to HISTORY_DISK_CACHE_SIZE bytes, whose
+    least recently read entries are evicted first. Only misses on both tiers reach the backend
+    (HISTORY_TIERED_BACKEND). Storing a response invalidates the cached
+    copies for its request. Hits, misses and evictions of each tier are
+    counted in the `history/tiered/` stats.
+
+    """
+
+    def __init__(self, stats, general_settings):
+        self.stats = stats
+        self.backend = load_object(
+            general_settings.get('HISTORY_TIERED_BACKEND',
+                                 DEFAULT_TIERED_BACKEND))(stats, general_settings)
+        self.metrics = getattr(self.backend, 'metrics', None) or Metrics(stats, general_settings)
+        self.memory = LRUCache(general_settings.getint('HISTORY_MEMORY_CACHE_SIZE',
+                                                       64 * 1024 * 1024))
+        self.disk_dir = general_settings.get('HISTORY_DISK_CACHE_DIR')
+        self.codec = RecordCodec(general_settings)
+        # seconds after which a disk cache entry is ignored, 0 to keep forever
+        self.disk_ttl = general_settings.getint('HISTORY_DISK_CACHE_TTL', 0)
+        # bytes of disk cache entries, 0 for no limit
+        self.disk_max_size = general_settings.getint('HISTORY_DISK_CACHE_SIZE', 0)
+        # bytes in the disk cache, counted on the first write
+        self.disk_size = None
+        self.disk_lock = threading.Lock()
+
+    def open_spider(self, spider):
+        self.backend.open_spider(spider)
+
+    def close_spider(self, spider):
+        return self.backend.close_spider(spider)
+
+    def prefetch(self, spider, epoch):
+        if hasattr(self.backend, 'prefetch'):
+            self.backend.prefetch(spider, epoch)
+
+    def last_digest(self, spider, request):
+        return self.backend.last_digest(spider, request)
+
+    def last_digest_async(self, spider, request):
+        last_digest_async = getattr(self.backend, 'last_digest_async', None)
+        if last_digest_async is None:
+            return defer.maybeDeferred(self.backend.last_digest, spider, request)
+        return last_digest_async(spider, request)
+
+    def stored_timestamps(self, spider):
+        return self.backend.stored_timestamps(spider)
+
+    def request_fingerprint(self, request):
+        return self.backend.request_fingerprint(request)
+
+    def retrieve_response(self, spider, request):
+        key = self.backend._get_request_storage_key(spider, request)
+        epoch = request.meta.get('epoch')
+        response = self._retrieve_from_memory(spider, key, epoch)
+        if response is not None:
+            return response
+
+        return self._retrieve_uncached(spider, request, key, epoch)
+
+    def retrieve_response_async(self, spider, request):
+        """Serve memory hits right away and read the other tiers on the
+        backend reader pool.
+
+        """
+        key = self.backend._get_request_storage_key(spider, request)
+        epoch = request.meta.get('epoch')
+        response = self._retrieve_from_memory(spider, key, epoch)
+        if response is not None:
+            return defer.succeed(response)
+
+        return self.backend._defer_read(self._retrieve_uncached, spider, request, key, epoch)
+
+    def store_response_async(self, spider, request, response):
+        return defer.maybeDeferred(self.store_response, spider, request, response)
+
+    def _retrieve_from_memory(self, spider, key, epoch):
+        cached = self.memory.get(key)
+        if cached is not None and cached[0] == epoch:
+            self.metrics.inc_value('history/tiered/memory/hit', spider=spider)
+            return copy_response(cached[1])
+        self.metrics.inc_value('history/tiered/memory/miss', spider=spider)
+
+    def _retrieve_uncached(self, spider, request, key, epoch):
+        response = self._retrieve_from_disk(spider, key, epoch)
+        if response is None:
+            response = self.backend.retrieve_response(spider, request)
+            if response is None:
+                return
+            self._store_on_disk(spider, key, epoch, request, response)
+
+        evicted = self.memory.set(key, (epoch, response), _response_size(response))
+        if evicted:
+            self.metrics.inc_value('history/tiered/memory/evictions', evicted, spider=spider)
+
+        return copy_response(response)
+
+    def store_response(self, spider, request, response):
+        key = self.backend._get_request_storage_key(spider, request)
+        self.memory.delete(key)
+        if self.disk_dir:
+            for path in glob.glob(self._disk_path(key, '*')):
+                os.remove(path)
+
+        return self.backend.store_response(spider, request, response)
+
+    def _disk_path(self, key, epoch_tag):
+        prefix, fingerprint = key.rsplit('/', 1)
+        return os.path.join(self.disk_dir, prefix, fingerprint[:2],
+                            '{}-{}.rec'.format(fingerprint, epoch_tag))
+
+    def _epoch_tag(self, epoch):
+        if isinstance(epoch, datetime):
+            return '{:d}'.format(int(_to_timestamp(epoch)))
+        return 'latest'
+
+    def _retrieve_from_disk(self, spider, key, epoch):
+        if not self.disk_dir:
+            return
+
+        path = self._disk_path(key, self._epoch_tag(epoch))
+        try:
+            if self.disk_ttl and time.time() - os.path.getmtime(path) > self.disk_ttl:
+                raise IOError('expired')
+            with open(path, 'rb') as f:
+                data_string = f.read()
+            # the access time orders evictions, the modification time expiry
+            os.utime(path, (time.time(), os.path.getmtime(path)))
+        except (IOError, OSError):
+            self.metrics.inc_value('history/tiered/disk/miss', spider=spider)
+            return
+
+        self.metrics.inc_value('history/tiered/disk/hit', spider=spider)
+        return decode_record(data_string)
+
+    def _store_on_disk(self, spider, key, epoch, request, response):
+        if not self.disk_dir:
+            return
+
+        path = self._disk_path(key, self._epoch_tag(epoch))
+        if not isinstance(response, LazyBody) or response._load_body is None:
+            self._write_to_disk(spider, path, self.codec.iter_encode(request, response))
+            return
+
+        # keep a lazy body lazy: write the disk copy once it is loaded
+        load_body = response._load_body
+
+        def load_and_store():
+            response._set_body(load_body())
+            self._write_to_disk(spider, path, self.codec.iter_encode(request, response))
+            return response._body
+        response._load_body = load_and_store
+
+    def _write_to_disk(self, spider, path, chunks):
+        _write_file(path, chunks)
+        if not self.disk_max_size:
+            return
+
+        with self.disk_lock:
+            if self.disk_size is None:
+                self.disk_size = sum(size for _, _, size in self._disk_entries())
+            else:
+                self.disk_size += os.path.getsize(path)
+            if self.disk_size > self.disk_max_size:
+                evicted = self._evict_from_disk()
+                if evicted:
+                    self.metrics.inc_value('history/tiered/disk/evictions', evicted,
+                                           spider=spider)
+
+    def _disk_entries(self):
+        """Yield the (access time, path, size) of the disk cache entries."""
+        for dirpath, _, filenames in os.walk(self.disk_dir):
+            for filename in filenames:
+                if not filename.endswith('.rec'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    # removed concurrently
+                    continue
+                yield stat.st_atime, path, stat.st_size
+
+    def _evict_from_disk(self):
+        """Remove the least recently read disk cache entries, down to 90% of
+        HISTORY_DISK_CACHE_SIZE so that the next writes do not evict right
+        away. Return the number of removed entries.
+
+        """
+        entries = sorted(self._disk_entries())
+        self.disk_size = sum(size for _, _, size in entries)
+        evicted = 0
+        for _, path, size in entries:
+            if self.disk_size <= self.disk_max_size * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.disk_size -= size
+            evicted += 1
+        return evicted
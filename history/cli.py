@@ -0,0 +1,435 @@
+# -*- coding: utf-8 -*-
+"""Maintenance of the history bucket.
+
+    scrapy-history compact SPIDER --bucket BUCKET [--keep-versions N]
+        [--keep-daily] [--max-age DAYS] [--prune-sources] [--dry-run]
+
+`compact` packs the versions stored under `{name}/cache/` into segments
+under `{name}/segments/`, which `S3CacheStorage` reads with ranged GETs
+(see `history.archive`), then deletes the versions. Retention rules pick
+the versions worth keeping:
+
+* `--max-age DAYS` drops the versions older than DAYS, except the most
+  recent version of each request;
+* `--keep-daily` keeps the most recent version of each (UTC) day;
+* `--keep-versions N` keeps the N most recent versions.
+
+Versions are kept by default. JSON records are transcoded to compressed
+binary ones on the way. The job manifests listing compacted versions are
+rewritten to point at their records in the segments, so that
+`history.replay` still finds them. The compacted versions are cleared
+from the version index, and from the shared index of HISTORY_SHARED_INDEX
+given with `--shared-index URL`. Compact between crawls: a crawl running
+meanwhile may write the version index back with the versions compacted.
+
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+import argparse
+import bisect
+from datetime import datetime
+import itertools
+import json
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+import boto
+from boto.s3.deletemarker import DeleteMarker
+from scrapy.http import Request
+from scrapy.settings import Settings
+
+from history import s3
+from history.archive import INDEX_SUFFIX, ArchiveWriter, dump_index
+from history.index import VersionIndex, _to_timestamp
+from history.record import RecordCodec, decode_record, is_binary_record
+from history.shared import open_backend
+from history.storage import MANIFEST_NAME, cache_key
+
+logger = logging.getLogger(__name__)
+
+HEX_DIGITS = '0123456789abcdef'
+DEFAULT_SEGMENT_SIZE = 256  # MB
+# maximum number of keys of a multi-object delete
+DELETE_BATCH_SIZE = 1000
+# records read ahead of the segment writer, per thread
+READ_AHEAD = 4
+# folders of `{name}/` which are not job folders
+RESERVED_FOLDERS = {'cache', 'index', 'segments'}
+
+
+def retained_versions(versions, keep_versions=None, keep_daily=False, max_age=None, now=None):
+    """Return the versions to keep among versions, tuples whose first item
+    is a timestamp, sorted from the oldest to the most recent.
+
+    max_age (seconds) applies first, but never drops the most recent
+    version; keep_daily then keeps the most recent version of each UTC
+    day and keep_versions the most recent ones left.
+
+    """
+    if not versions:
+        return []
+
+    kept = list(versions)
+    if max_age is not None:
+        now = time.time() if now is None else now
+        kept = [version for version in kept[:-1] if version[0] >= now - max_age] + kept[-1:]
+
+    if keep_daily:
+        days = {}
+        for version in kept:
+            days[datetime.utcfromtimestamp(version[0]).date()] = version
+        kept = sorted(days.values())
+
+    if keep_versions is not None:
+        kept = kept[-keep_versions:] if keep_versions > 0 else []
+
+    return kept
+
+
+def _transcode(data_string, codec):
+    """Encode a JSON record again, in the format of codec."""
+    data = json.loads(data_string)
+    request = Request(data['metadata']['url'],
+                      method=data['metadata'].get('method', 'GET'),
+                      headers=data['request_headers'],
+                      body=(data['request_body'] or '').encode('utf-8'))
+    return codec.encode(request, decode_record(data_string))[0]
+
+
+class Compactor(object):
+    """Compact the cache keys of a spider, see the module documentation."""
+
+    def __init__(self, bucket, spider, keep_versions=None, keep_daily=False, max_age=None,
+                 segment_size=DEFAULT_SEGMENT_SIZE * 1024 * 1024, threads=16,
+                 prune_sources=False, dry_run=False, codec=None, shared_index=None):
+        self.bucket = bucket
+        self.spider = spider
+        self.keep_versions = keep_versions
+        self.keep_daily = keep_daily
+        self.max_age = max_age
+        self.segment_size = segment_size
+        self.threads = threads
+        self.prune_sources = prune_sources
+        self.dry_run = dry_run
+        self.codec = codec or RecordCodec(Settings())
+        # backend of the shared index (see `history.shared`), if any
+        self.shared_index = shared_index
+        self.cache_prefix = '{}/cache/'.format(spider)
+        self.segment_prefix = '{}/segments/'.format(spider)
+        # `{name}/index/` and `{name}/index-{width}/` of sharded layouts
+        self.index_prefix = '{}/index'.format(spider)
+        self.now = time.time()
+        # (key, version id) => (segment, offset, length) of the records written
+        self.locations = {}
+        self.report = {
+            'keys': 0,
+            'versions': 0,
+            'kept': 0,
+            'dropped': 0,
+            'transcoded': 0,
+            'segments': 0,
+            'bytes_read': 0,
+            'bytes_written': 0,
+            'manifests': 0,
+            'sources_pruned': 0,
+        }
+
+    def run(self):
+        stored = self.list_versions()
+        retained = {key: retained_versions(versions, self.keep_versions, self.keep_daily,
+                                           self.max_age, self.now)
+                    for key, versions in stored.items()}
+        self.report['keys'] = len(stored)
+        self.report['versions'] = sum(len(versions) for versions in stored.values())
+        self.report['kept'] = sum(len(versions) for versions in retained.values())
+        self.report['dropped'] = self.report['versions'] - self.report['kept']
+
+        if not self.dry_run and stored:
+            self.write_segments(retained)
+            self.update_manifests(stored)
+            # versions are only deleted once every segment is uploaded
+            self.delete_versions(stored)
+            self.update_index(stored)
+        if self.prune_sources and self.max_age is not None:
+            self.prune_old_sources()
+        return self.report
+
+    def list_versions(self):
+        """Return the versions of every cache key, sorted from the oldest to
+        the most recent. Keys are listed in parallel, by fingerprint prefix.
+
+        """
+        pool = ThreadPool(self.threads)
+        try:
+            listings = pool.map(self._list_prefix, HEX_DIGITS, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        stored = {}
+        for listing in listings:
+            stored.update(listing)
+        return stored
+
+    def _list_prefix(self, digit):
+        stored = {}
+        for s3_key in self.bucket.list_versions(prefix=self.cache_prefix + digit):
+            if isinstance(s3_key, DeleteMarker):
+                continue
+            stored.setdefault(s3_key.name, []).append(
+                (_to_timestamp(boto.utils.parse_ts(s3_key.last_modified)),
+                 s3_key.version_id or 'null'))
+        for versions in stored.values():
+            versions.sort()
+        return stored
+
+    def write_segments(self, retained):
+        records = [(key, timestamp, version_id)
+                   for key, versions in sorted(retained.items())
+                   for timestamp, version_id in versions]
+
+        tmp_dir = tempfile.mkdtemp(prefix='history-compact-')
+        writer = None
+        # (key, version id) of the records of the segment being written
+        written = []
+        pool = ThreadPool(self.threads)
+        try:
+            for key, version_id, timestamp, data_string, size, transcoded in self._fetch_records(
+                    pool, records):
+                self.report['bytes_read'] += size
+                self.report['transcoded'] += transcoded
+                if writer is None:
+                    writer = ArchiveWriter(os.path.join(tmp_dir, self._segment_id()))
+                    written = []
+                writer.append(key.rsplit('/', 1)[1], timestamp, data_string)
+                written.append((key, version_id))
+                if writer.size >= self.segment_size:
+                    self._upload_segment(writer, written)
+                    writer = None
+            if writer is not None:
+                self._upload_segment(writer, written)
+        finally:
+            pool.close()
+            pool.join()
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _fetch_records(self, pool, records):
+        """Fetch records on the pool, in order. At most READ_AHEAD records
+        per thread are held in memory, waiting to be written.
+
+        """
+        chunk_size = self.threads * READ_AHEAD
+        for start in range(0, len(records), chunk_size):
+            for fetched in pool.imap(self._fetch_record, records[start:start + chunk_size]):
+                yield fetched
+
+    def _segment_id(self):
+        return 'compact-{}-{}'.format(datetime.utcfromtimestamp(self.now).strftime('%Y%m%dT%H%M%S'),
+                                      uuid.uuid4().hex[:8])
+
+    def _fetch_record(self, record):
+        key, timestamp, version_id = record
+        s3_key = self.bucket.new_key(key)
+        s3_key.version_id = None if version_id == 'null' else version_id
+        try:
+            data_string = s3_key.get_contents_as_string()
+        finally:
+            s3_key.close()
+
+        if is_binary_record(data_string):
+            return key, version_id, timestamp, data_string, len(data_string), False
+        return (key, version_id, timestamp, _transcode(data_string, self.codec),
+                len(data_string), True)
+
+    def _upload_segment(self, writer, written):
+        entries = writer.close()
+        segment_id = os.path.basename(writer.path)
+        name = self.segment_prefix + segment_id
+        s3_key = self.bucket.new_key(name)
+        try:
+            s3_key.set_contents_from_filename(writer.path)
+        finally:
+            s3_key.close()
+
+        # the index goes last: a segment is only read once it is indexed
+        s3_key = self.bucket.new_key(name + INDEX_SUFFIX)
+        try:
+            s3_key.set_contents_from_string(
+                dump_index(entries, compacted=datetime.utcfromtimestamp(self.now).isoformat()))
+        finally:
+            s3_key.close()
+
+        for location, (_, _, offset, length) in zip(written, entries):
+            self.locations[location] = (segment_id, offset, length)
+        os.remove(writer.path)
+        self.report['segments'] += 1
+        self.report['bytes_written'] += writer.size
+        logger.info('uploaded segment {} of {} records'.format(name, len(entries)))
+
+    def update_manifests(self, stored):
+        """Rewrite the job manifests listing compacted versions: those
+        retained move to the `segments` of the manifest, as the (fingerprint,
+        timestamp, segment, offset, length) of their record, and those
+        dropped are removed.
+
+        """
+        compacted = set((key, version_id) for key, versions in stored.items()
+                        for _, version_id in versions)
+        for folder in self.bucket.list(prefix=self.spider + '/', delimiter='/'):
+            if folder.name.rstrip('/').rsplit('/', 1)[-1] in RESERVED_FOLDERS:
+                continue
+            s3_key = self.bucket.get_key(folder.name + MANIFEST_NAME)
+            if s3_key is None:
+                continue
+
+            manifest = json.loads(s3_key.get_contents_as_string().decode('utf-8'))
+            shard_width = manifest.get('key_shard_width', 0)
+            versions = []
+            segments = manifest.setdefault('segments', [])
+            for fingerprint, version_id, timestamp in manifest['versions']:
+                location = (cache_key(self.spider, fingerprint, shard_width), version_id)
+                if location not in compacted:
+                    versions.append([fingerprint, version_id, timestamp])
+                elif location in self.locations:
+                    segments.append([fingerprint, timestamp] + list(self.locations[location]))
+            if len(versions) == len(manifest['versions']):
+                continue
+
+            manifest['versions'] = versions
+            s3_key.set_contents_from_string(json.dumps(manifest))
+            self.report['manifests'] += 1
+
+    def delete_versions(self, stored):
+        names = [(key, version_id) for key, versions in sorted(stored.items())
+                 for _, version_id in versions]
+        self._delete(names)
+
+    def _delete(self, names):
+        for start in range(0, len(names), DELETE_BATCH_SIZE):
+            result = self.bucket.delete_keys(names[start:start + DELETE_BATCH_SIZE])
+            for error in result.errors:
+                logger.warning('could not delete {}: {}'.format(error.key, error.message))
+
+    def update_index(self, stored):
+        """Clear the compacted versions from the version index, if any."""
+        if self.shared_index is not None:
+            self._update_shared_index(stored)
+        fingerprints = sorted(set(key.rsplit('/', 1)[1] for key in stored))
+        for s3_key in self.bucket.list(prefix=self.index_prefix):
+            if not s3_key.name.endswith('.json'):
+                continue
+            shard = s3_key.name.rsplit('/', 1)[1][:-len('.json')]
+            version_index = VersionIndex(len(shard))
+            version_index.load_shard(shard, s3_key.get_contents_as_string())
+            start = bisect.bisect_left(fingerprints, shard)
+            for fingerprint in itertools.takewhile(lambda fp: fp.startswith(shard),
+                                                   fingerprints[start:]):
+                version_index.clear_versions(fingerprint)
+            if version_index.dirty:
+                s3_key.set_contents_from_string(version_index.dump_shard(shard))
+
+    def _update_shared_index(self, stored):
+        # keys of sharded layouts (`cache/{xx}/{fingerprint}`) are indexed
+        # under `index-{width}`, like S3CacheStorage does
+        cleared = {}
+        for key in stored:
+            parts = key[len(self.cache_prefix):].split('/')
+            name = self.index_prefix
+            if len(parts) > 1:
+                name += '-{}'.format(len(parts[0]))
+            cleared.setdefault(name, {})[parts[-1]] = []
+        for name, versions in sorted(cleared.items()):
+            self.shared_index.set_versions(name, versions)
+
+    def prune_old_sources(self):
+        """Delete the `source/` copies older than max_age."""
+        oldest = datetime.utcfromtimestamp(self.now - self.max_age)
+        names = []
+        for folder in self.bucket.list(prefix=self.spider + '/', delimiter='/'):
+            if folder.name.rstrip('/').rsplit('/', 1)[-1] in RESERVED_FOLDERS:
+                continue
+            # every version, to actually reclaim the storage of a versioned bucket
+            for s3_key in self.bucket.list_versions(prefix=folder.name + 'source/'):
+                if boto.utils.parse_ts(s3_key.last_modified) < oldest:
+                    names.append((s3_key.name, s3_key.version_id))
+
+        self.report['sources_pruned'] = len(names)
+        if not self.dry_run:
+            self._delete(names)
+
+
+def compact(args):
+    connection = s3.connect(args.access_key, args.secret_key, endpoint=args.endpoint,
+                            max_connections=args.threads)
+    shared_index = None
+    if args.shared_index:
+        shared_index = open_backend(args.shared_index, args.shared_index_prefix)
+    try:
+        bucket = connection.get_bucket(args.bucket)
+        compactor = Compactor(
+            bucket, args.spider,
+            keep_versions=args.keep_versions,
+            keep_daily=args.keep_daily,
+            max_age=args.max_age * 24 * 3600 if args.max_age is not None else None,
+            segment_size=args.segment_size * 1024 * 1024,
+            threads=args.threads,
+            prune_sources=args.prune_sources,
+            dry_run=args.dry_run,
+            codec=RecordCodec(Settings({'HISTORY_COMPRESSION': args.compression})),
+            shared_index=shared_index,
+        )
+        report = compactor.run()
+    finally:
+        connection.close()
+        if shared_index is not None:
+            shared_index.close()
+
+    for name in sorted(report):
+        print('{:<16} {}'.format(name, report[name]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='scrapy-history',
+                                     description=__doc__.split('\n\n')[0])
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    parser_compact = subparsers.add_parser('compact', help='pack and prune the history of a spider')
+    parser_compact.add_argument('spider')
+    parser_compact.add_argument('--bucket', required=True)
+    parser_compact.add_argument('--endpoint', help='S3 endpoint, e.g. http://localhost:9000')
+    parser_compact.add_argument('--access-key', default=os.getenv('AWS_ACCESS_KEY_ID'))
+    parser_compact.add_argument('--secret-key', default=os.getenv('AWS_SECRET_ACCESS_KEY'))
+    parser_compact.add_argument('--keep-versions', type=int,
+                                help='keep the N most recent versions of each request')
+    parser_compact.add_argument('--keep-daily', action='store_true',
+                                help='keep the most recent version of each day')
+    parser_compact.add_argument('--max-age', type=float, metavar='DAYS',
+                                help='drop the versions older than DAYS, except the most recent')
+    parser_compact.add_argument('--prune-sources', action='store_true',
+                                help='delete the source/ copies older than --max-age')
+    parser_compact.add_argument('--segment-size', type=int, default=DEFAULT_SEGMENT_SIZE,
+                                metavar='MB', help='(default: %(default)s)')
+    parser_compact.add_argument('--compression', default='gzip',
+                                help='compression of transcoded JSON records')
+    parser_compact.add_argument('--threads', type=int, default=16)
+    parser_compact.add_argument('--shared-index', metavar='URL',
+                                help='HISTORY_SHARED_INDEX of the spider, cleared as well')
+    parser_compact.add_argument('--shared-index-prefix', default='history:',
+                                help='HISTORY_SHARED_INDEX_PREFIX (default: %(default)s)')
+    parser_compact.add_argument('--dry-run', action='store_true',
+                                help='report what would be compacted, change nothing')
+    parser_compact.set_defaults(func=compact)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
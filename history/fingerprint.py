@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""Request fingerprints, which name the cache keys of the responses.
+
+HISTORY_FINGERPRINTER is the path to a class built with the crawler
+settings and implementing `fingerprint(request)`, which returns a hex
+string. The default, `RequestFingerprinter`, is the fingerprint of Scrapy
+(`scrapy.utils.request.request_fingerprint`) with canonicalization rules
+read from the settings:
+
+* HISTORY_FINGERPRINT_IGNORE_PARAMS: query parameters left out of the URL,
+  by name or regular expression (e.g. `utm_.*`);
+* HISTORY_FINGERPRINT_HEADERS: request headers taken into account;
+* HISTORY_FINGERPRINT_BODY: whether the request body is taken into
+  account (default);
+* HISTORY_FINGERPRINT_KEEP_FRAGMENTS: whether URL fragments are.
+
+With the default rules fingerprints are the ones of Scrapy, so that
+responses stored before the setting existed are still found. Changing the
+rules changes the keys of the requests affected.
+
+"""
+
+from __future__ import absolute_import, unicode_literals
+import hashlib
+import re
+import threading
+import weakref
+
+from scrapy.utils.python import to_bytes
+from six.moves.urllib import parse
+from w3lib.url import canonicalize_url
+
+
+class RequestFingerprinter(object):
+
+    def __init__(self, settings):
+        ignore_params = settings.getlist('HISTORY_FINGERPRINT_IGNORE_PARAMS', [])
+        self.ignore_params = None
+        if ignore_params:
+            # compiled once into a single pattern matching whole names
+            self.ignore_params = re.compile(
+                r'(?:{})\Z'.format('|'.join('(?:{})'.format(p) for p in ignore_params)))
+        self.headers = tuple(sorted(to_bytes(header.lower()) for header in
+                                    settings.getlist('HISTORY_FINGERPRINT_HEADERS', [])))
+        self.include_body = settings.getbool('HISTORY_FINGERPRINT_BODY', True)
+        self.keep_fragments = settings.getbool('HISTORY_FINGERPRINT_KEEP_FRAGMENTS', False)
+
+    def fingerprint(self, request):
+        fp = hashlib.sha1()
+        fp.update(to_bytes(request.method))
+        fp.update(to_bytes(canonicalize_url(self._clean_url(request.url),
+                                            keep_fragments=self.keep_fragments)))
+        if self.include_body:
+            fp.update(request.body or b'')
+        for header in self.headers:
+            if header in request.headers:
+                fp.update(header)
+                for value in request.headers.getlist(header):
+                    fp.update(value)
+        return fp.hexdigest()
+
+    def _clean_url(self, url):
+        if self.ignore_params is None or '?' not in url:
+            return url
+        parts = parse.urlsplit(url)
+        query = [(name, value) for name, value in parse.parse_qsl(parts.query, True)
+                 if not self.ignore_params.match(name)]
+        return parse.urlunsplit(parts._replace(query=parse.urlencode(query)))
+
+
+class FingerprintCache(object):
+    """Fingerprints of the requests alive, so that the retrieve and store
+    paths of a request compute it once.
+
+    """
+
+    def __init__(self, fingerprinter):
+        self.fingerprinter = fingerprinter
+        self.fingerprints = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+
+    def __call__(self, request):
+        with self.lock:
+            fingerprint = self.fingerprints.get(request)
+        if fingerprint is None:
+            fingerprint = self.fingerprinter.fingerprint(request)
+            with self.lock:
+                self.fingerprints[request] = fingerprint
+        return fingerprint
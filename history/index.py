@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+import bisect
+import calendar
+from datetime import datetime
+import json
+import threading
+
+
+def _to_timestamp(dt):
+    """Seconds since the epoch of a naive datetime, taken as UTC like the
+    `last_modified` dates returned by S3.
+
+    """
+    return calendar.timegm(dt.timetuple()) + dt.microsecond / 1e6
+
+
+def _select_version(versions, epoch):
+    """Pick a version following the same rules as `S3CacheStorage._get_s3_key`.
+
+    `versions` is a list of tuples whose first item is a timestamp, sorted
+    from the oldest to the most recent. Return the oldest version stored
+    at or after epoch, or the most recent one if they are all older (or if
+    epoch is not a datetime).
+
+    """
+    if not versions:
+        return None
+
+    if not isinstance(epoch, datetime):
+        return versions[-1]
+
+    timestamps = [version[0] for version in versions]
+    index = bisect.bisect_left(timestamps, _to_timestamp(epoch))
+    return versions[min(index, len(versions) - 1)]
+
+
+class VersionIndex(object):
+    """Map request fingerprints to their stored versions.
+
+    Versions are (timestamp, version_id) pairs sorted from the oldest to the
+    most recent, so finding the version matching an epoch is a binary
+    search. The body digest of the most recent version is kept as well.
+
+    The index is split into shards by fingerprint prefix, which are
+    serialized independently; shards modified since they were last dumped
+    are tracked in `dirty`. Fingerprints found missing are kept apart, in
+    `misses`, and never dumped.
+
+    """
+
+    def __init__(self, shard_width=2):
+        self.shard_width = shard_width
+        # shard => fingerprint => versions
+        self.shards = {}
+        # shard => fingerprint => digest of the most recent version
+        self.digests = {}
+        self.dirty = set()
+        self.misses = set()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards.values())
+
+    def __contains__(self, fingerprint):
+        return (fingerprint in self.misses or
+                fingerprint in self.shards.get(self.shard(fingerprint), {}))
+
+    def shard(self, fingerprint):
+        return fingerprint[:self.shard_width]
+
+    def get(self, fingerprint):
+        return self.shards.get(self.shard(fingerprint), {}).get(fingerprint)
+
+    def add(self, fingerprint, timestamp, version_id):
+        shard = self.shard(fingerprint)
+        with self.lock:
+            self.misses.discard(fingerprint)
+            versions = self.shards.setdefault(shard, {}).setdefault(fingerprint, [])
+            version = (timestamp, version_id)
+            if version not in versions:
+                bisect.insort(versions, version)
+                self.dirty.add(shard)
+
+    def lookup(self, fingerprint, epoch):
+        """Return the (timestamp, version_id) matching epoch, or None."""
+        return _select_version(self.get(fingerprint), epoch)
+
+    def set_versions(self, fingerprint, versions):
+        """Replace the versions of fingerprint, e.g. without those found
+        deleted. It keeps its digest.
+
+        """
+        shard = self.shard(fingerprint)
+        versions = sorted(tuple(version) for version in versions)
+        with self.lock:
+            fingerprints = self.shards.setdefault(shard, {})
+            if fingerprints.get(fingerprint) != versions:
+                fingerprints[fingerprint] = versions
+                self.dirty.add(shard)
+
+    def clear_versions(self, fingerprint):
+        """Forget the versions of fingerprint, e.g. once they are moved to
+        segments. The fingerprint stays known, so that its key is not
+        listed again, and keeps its digest.
+
+        """
+        self.set_versions(fingerprint, [])
+
+    def add_missing(self, fingerprint):
+        """Record that fingerprint has no stored version, so that its key
+        is not listed again until a version is added. Misses only last as
+        long as the index.
+
+        """
+        with self.lock:
+            self.misses.add(fingerprint)
+
+    def latest(self, fingerprint):
+        versions = self.get(fingerprint)
+        return versions[-1] if versions else None
+
+    def timestamps(self):
+        """Return the time of the most recent version of every fingerprint."""
+        return {fingerprint: versions[-1][0] for fingerprints in self.shards.values()
+                for fingerprint, versions in fingerprints.items() if versions}
+
+    def digest(self, fingerprint):
+        return self.digests.get(self.shard(fingerprint), {}).get(fingerprint)
+
+    def set_digest(self, fingerprint, digest):
+        shard = self.shard(fingerprint)
+        with self.lock:
+            digests = self.digests.setdefault(shard, {})
+            if digests.get(fingerprint) != digest:
+                digests[fingerprint] = digest
+                self.dirty.add(shard)
+
+    def load_shard(self, shard, data):
+        """Merge a serialized shard into the index."""
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        data = json.loads(data)
+        if 'versions' not in data:
+            # shards dumped before digests were tracked
+            data = {'versions': data}
+        with self.lock:
+            fingerprints = self.shards.setdefault(shard, {})
+            for fingerprint, versions in data['versions'].items():
+                self.misses.discard(fingerprint)
+                merged = set(fingerprints.get(fingerprint, []))
+                merged.update(tuple(version) for version in versions)
+                fingerprints[fingerprint] = sorted(merged)
+
+            # digests known locally are the most recent ones
+            digests = self.digests.setdefault(shard, {})
+            for fingerprint, digest in data.get('digests', {}).items():
+                digests.setdefault(fingerprint, digest)
+
+    def dump_shard(self, shard):
+        with self.lock:
+            data = {
+                'versions': {fingerprint: [list(version) for version in versions]
+                             for fingerprint, versions in self.shards.get(shard, {}).items()},
+                'digests': self.digests.get(shard, {}),
+            }
+            return json.dumps(data, sort_keys=True).encode('utf-8')
@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import absolute_import, unicode_literals
-from datetime import datetime
+from datetime import datetime, timedelta
+import time
 
+from scrapy.exceptions import NotConfigured
 from scrapy.utils.httpobj import urlparse_cached
 from six.moves import map
 
+from history.record import body_digest
+
+# fingerprints are sampled on their first 8 hex digits
+SAMPLE_RANGE = 16 ** 8
+
 
 class LogicBase(object):
 
@@ -13,6 +20,16 @@ class LogicBase(object):
         self.ignore_missing = settings.getbool('HTTPCACHE_IGNORE_MISSING', False)
         self.ignore_schemes = settings.getlist('HTTPCACHE_IGNORE_SCHEMES', ['file'])
         self.ignore_http_codes = list(map(int, settings.getlist('HTTPCACHE_IGNORE_HTTP_CODES', [])))
+        self.storage = None
+        self.stats = None
+
+    def bind(self, storage, stats):
+        """Called by the middleware with the storage backend and the crawler
+        stats, for policies depending on what is already stored.
+
+        """
+        self.storage = storage
+        self.stats = stats
 
     def spider_opened(self, spider):
         pass
@@ -94,5 +111,120 @@ class StoreAlways(StoreBase):
 
 class StoreDaily(StoreBase):
     """Store response only if it is currently between midnight and 1am."""
+    def __init__(self, settings):
+        super(StoreDaily, self).__init__(settings)
+        # the decision holds until the end of the current hour
+        self.storing = False
+        self.decided_until = 0
+
+    def store_if(self, spider, request, response):
+        now = time.time()
+        if now >= self.decided_until:
+            current = datetime.fromtimestamp(now)
+            self.storing = current.hour == 0
+            next_hour = current.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+            self.decided_until = time.mktime(next_hour.timetuple())
+        return self.storing
+
+
+class StoreChanged(StoreBase):
+    """Store response only if its body changed since the last stored version.
+
+    Requires a storage backend implementing `last_digest`. Backends which
+    may need a request to tell it also implement `last_digest_async`, in
+    which case the decision is a Deferred.
+    """
+    def store_if(self, spider, request, response):
+        last_digest_async = getattr(self.storage, 'last_digest_async', None)
+        if last_digest_async is None:
+            return self._changed(self.storage.last_digest(spider, request), spider, response)
+        return last_digest_async(spider, request).addCallback(self._changed, spider, response)
+
+    def _changed(self, last_digest, spider, response):
+        if last_digest is not None and last_digest == body_digest(response.body):
+            self.stats.inc_value('history/store/unchanged', spider=spider)
+            return False
+        return True
+
+
+class StoreSample(StoreBase):
+    """Store the responses of a sample of the requests.
+
+    HISTORY_STORE_SAMPLE_RATE (between 0 and 1) of the requests are picked
+    by fingerprint, so the same requests are stored on every crawl.
+    """
+    def __init__(self, settings):
+        super(StoreSample, self).__init__(settings)
+        self.threshold = int(settings.getfloat('HISTORY_STORE_SAMPLE_RATE', 1.0) * SAMPLE_RANGE)
+
+    def store_if(self, spider, request, response):
+        fingerprint = self.storage.request_fingerprint(request)
+        return int(fingerprint[:8], 16) < self.threshold
+
+
+class StoreBudget(StoreBase):
+    """Store responses until the budget of the current time window is spent.
+
+    Budgets are of HISTORY_STORE_BUDGET_COUNT responses and
+    HISTORY_STORE_BUDGET_BYTES bytes of body (0 for no limit) per window of
+    HISTORY_STORE_BUDGET_WINDOW seconds, either per domain or per spider
+    (HISTORY_STORE_BUDGET_PER). They are counted by the crawl process only.
+    """
+    def __init__(self, settings):
+        super(StoreBudget, self).__init__(settings)
+        self.max_count = settings.getint('HISTORY_STORE_BUDGET_COUNT', 0)
+        self.max_bytes = settings.getint('HISTORY_STORE_BUDGET_BYTES', 0)
+        self.window = settings.getint('HISTORY_STORE_BUDGET_WINDOW', 24 * 3600)
+        per = settings.get('HISTORY_STORE_BUDGET_PER', 'domain')
+        if per not in ('domain', 'spider'):
+            raise NotConfigured('Unknown HISTORY_STORE_BUDGET_PER: {}'.format(per))
+        self.per_domain = per == 'domain'
+        # domain or spider name => [window, count, bytes]
+        self.budgets = {}
+
+    def store_if(self, spider, request, response):
+        scope = urlparse_cached(request).hostname if self.per_domain else spider.name
+        window = int(time.time() // self.window)
+        budget = self.budgets.get(scope)
+        if budget is None or budget[0] != window:
+            budget = self.budgets[scope] = [window, 0, 0]
+
+        size = len(response.body)
+        if ((self.max_count and budget[1] >= self.max_count) or
+                (self.max_bytes and budget[2] + size > self.max_bytes)):
+            self.stats.inc_value('history/store/over_budget', spider=spider)
+            return False
+
+        budget[1] += 1
+        budget[2] += size
+        return True
+
+
+class StoreStale(StoreBase):
+    """Store response only if its request was never stored, or not within
+    the last HISTORY_STORE_MAX_AGE seconds.
+
+    The time each request was last stored is loaded once from the storage
+    backend when the spider opens, which requires a backend implementing
+    `stored_timestamps`, then kept up to date in memory.
+    """
+    def __init__(self, settings):
+        super(StoreStale, self).__init__(settings)
+        self.max_age = settings.getint('HISTORY_STORE_MAX_AGE', 24 * 3600)
+        # fingerprint => timestamp of the most recent version
+        self.stored = {}
+
+    def spider_opened(self, spider):
+        self.stored = self.storage.stored_timestamps(spider)
+        self.stats.set_value('history/store/known', len(self.stored), spider=spider)
+
     def store_if(self, spider, request, response):
-        return datetime.now().hour == 0
+        fingerprint = self.storage.request_fingerprint(request)
+        now = time.time()
+        stored = self.stored.get(fingerprint)
+        if stored is not None and now - stored < self.max_age:
+            self.stats.inc_value('history/store/fresh', spider=spider)
+            return False
+
+        self.stored[fingerprint] = now
+        return True
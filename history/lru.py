@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+from collections import OrderedDict
+import threading
+
+
+class LRUCache(object):
+    """Least recently used mapping, bounded by the total size of its values.
+
+    Safe to use from several threads.
+
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.evictions = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, size = self.items.pop(key)
+            except KeyError:
+                return default
+            # move to the most recently used end
+            self.items[key] = value, size
+            return value
+
+    def set(self, key, value, size):
+        """Add value to the cache and return the number of evicted items."""
+        if size > self.max_size:
+            return 0
+
+        with self.lock:
+            self._pop(key)
+            self.items[key] = value, size
+            self.size += size
+
+            evicted = 0
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self.items.popitem(last=False)
+                self.size -= evicted_size
+                evicted += 1
+            self.evictions += evicted
+            return evicted
+
+    def delete(self, key):
+        with self.lock:
+            self._pop(key)
+
+    def _pop(self, key):
+        if key in self.items:
+            _, size = self.items.pop(key)
+            self.size -= size
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""Counters and histograms of the middleware hot paths.
+
+Everything is recorded in the crawler stats under `history/`: a counter is
+a plain stat, a histogram `name` keeps `name/count`, `name/sum` and
+`name/max` up to date and gets `name/p50` and `name/p99` when the spider
+closes. Latencies are in milliseconds, sizes in bytes.
+
+Stats are updated from the reader, writer and prefetch threads as well as
+from the reactor, while Scrapy's stats collectors are not thread-safe:
+every update of the storage goes through the lock of its `Metrics`, with
+`inc_value`, `set_value` and `max_value` for plain stats.
+
+HISTORY_METRICS_SINK may point to a class receiving the same measures as
+they are taken, to push them to an external metrics system. It is built
+with the crawler settings and implements:
+
+    increment(name, value)
+    observe(name, value)
+    close()  # optional
+
+"""
+
+from __future__ import absolute_import, unicode_literals
+from contextlib import contextmanager
+import logging
+import random
+import threading
+from timeit import default_timer
+
+from scrapy.utils.misc import load_object
+
+logger = logging.getLogger(__name__)
+
+RESERVOIR_SIZE = 1024
+
+
+class Histogram(object):
+    """Uniform sample (reservoir) of observed values, to estimate
+    percentiles in bounded memory.
+
+    """
+
+    def __init__(self, size=RESERVOIR_SIZE):
+        self.size = size
+        self.count = 0
+        self.sample = []
+
+    def add(self, value):
+        self.count += 1
+        if len(self.sample) < self.size:
+            self.sample.append(value)
+        else:
+            index = random.randint(0, self.count - 1)
+            if index < self.size:
+                self.sample[index] = value
+
+    def percentile(self, q):
+        if not self.sample:
+            return None
+        values = sorted(self.sample)
+        return values[int(round(q / 100.0 * (len(values) - 1)))]
+
+
+class Metrics(object):
+
+    def __init__(self, stats, settings):
+        self.stats = stats
+        self.histograms = {}
+        self.lock = threading.Lock()
+        sink = settings.get('HISTORY_METRICS_SINK')
+        self.sink = load_object(sink)(settings) if sink else None
+
+    def inc(self, name, count=1, spider=None):
+        self.inc_value(name, count, spider=spider)
+        self._send('increment', name, count)
+
+    def observe(self, name, value, spider=None):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(value)
+
+            self.stats.inc_value(name + '/count', spider=spider)
+            self.stats.inc_value(name + '/sum', value, spider=spider)
+            self.stats.max_value(name + '/max', value, spider=spider)
+        self._send('observe', name, value)
+
+    def inc_value(self, name, count=1, spider=None):
+        with self.lock:
+            self.stats.inc_value(name, count, spider=spider)
+
+    def set_value(self, name, value, spider=None):
+        with self.lock:
+            self.stats.set_value(name, value, spider=spider)
+
+    def max_value(self, name, value, spider=None):
+        with self.lock:
+            self.stats.max_value(name, value, spider=spider)
+
+    @contextmanager
+    def timer(self, name, spider=None):
+        """Observe the time spent in the block, in milliseconds."""
+        start = default_timer()
+        try:
+            yield
+        finally:
+            self.observe(name, (default_timer() - start) * 1000, spider=spider)
+
+    def timed_iter(self, name, iterable, spider=None):
+        """Iterate over iterable, observing the time spent producing its
+        items (e.g. encoding the chunks of a record as they are written).
+
+        """
+        elapsed = 0
+        iterator = iter(iterable)
+        while True:
+            start = default_timer()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                elapsed += default_timer() - start
+            yield item
+        self.observe(name, elapsed * 1000, spider=spider)
+
+    def close(self, spider=None):
+        """Write the percentiles of the histograms to the stats."""
+        with self.lock:
+            for name, histogram in self.histograms.items():
+                self.stats.set_value(name + '/p50', histogram.percentile(50), spider=spider)
+                self.stats.set_value(name + '/p99', histogram.percentile(99), spider=spider)
+
+        if self.sink is not None and hasattr(self.sink, 'close'):
+            self.sink.close()
+
+    def _send(self, method, name, value):
+        if self.sink is None:
+            return
+        # metrics must never fail the crawl
+        try:
+            getattr(self.sink, method)(name, value)
+        except Exception as e:
+            logger.info('metrics sink failed: {}'.format(e))
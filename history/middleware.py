@@ -3,18 +3,21 @@
 from __future__ import absolute_import, unicode_literals
 from datetime import datetime
 import logging
+from timeit import default_timer
 
-from parsedatetime import parsedatetime, Constants
 from scrapy import signals
 from scrapy.exceptions import NotConfigured, IgnoreRequest
 from scrapy.utils.misc import load_object
+from twisted.internet import defer
+
+from history.metrics import Metrics
+from history.record import body_length
 
 logger = logging.getLogger(__name__)
 
-MANDATORY_SETTINGS = ['HISTORY_S3_BUCKET',
-                      'AWS_ACCESS_KEY_ID',
-                      'AWS_SECRET_ACCESS_KEY']
 EPOCH_DATE_FORMAT = '%Y%m%d'
+# parsed without parsedatetime, which is imported for other epochs only
+EPOCH_FORMATS = (EPOCH_DATE_FORMAT, '%Y-%m-%d', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S')
 
 
 def ignore_on_fail(func):
@@ -44,11 +47,6 @@ class HistoryMiddleware(object):
         self.stats = crawler.stats
         settings = crawler.settings
 
-        configured = all([settings.get(k, False) for k in MANDATORY_SETTINGS])
-        if not configured:
-            # deactivate the login if we can't talk to S3 anyway
-            raise NotConfigured('__init__')
-
         # EPOCH:
         #   == False: don't retrieve historical data
         #   == True : retrieve most recent version
@@ -58,10 +56,16 @@ class HistoryMiddleware(object):
             settings.get('HISTORY_RETRIEVE_IF', 'history.logic.RetrieveNever'))(settings)
         self.store_if = load_object(
             settings.get('HISTORY_STORE_IF', 'history.logic.StoreAlways'))(settings)
+        # backends raise NotConfigured when their own settings are missing
+        # (e.g. S3 credentials), which deactivates the middleware
         self.storage = load_object(
             settings.get('HISTORY_BACKEND',
                          'history.storage.S3CacheStorage'))(self.stats, settings)
         self.ignore_missing = settings.getbool('HTTPCACHE_IGNORE_MISSING')
+        # share the backend metrics (and sink) when it has some
+        self.metrics = getattr(self.storage, 'metrics', None) or Metrics(self.stats, settings)
+        self.retrieve_if.bind(self.storage, self.stats)
+        self.store_if.bind(self.storage, self.stats)
 
     @classmethod
     def from_crawler(cls, crawler):
@@ -75,13 +79,19 @@ class HistoryMiddleware(object):
 
     def spider_opened(self, spider):
         self.storage.open_spider(spider)
+        if self.epoch and hasattr(self.storage, 'prefetch'):
+            self.storage.prefetch(spider, self.epoch)
         self.store_if.spider_opened(spider)
         self.retrieve_if.spider_opened(spider)
 
     def spider_closed(self, spider):
-        self.storage.close_spider(spider)
         self.store_if.spider_closed(spider)
         self.retrieve_if.spider_closed(spider)
+        # may return a Deferred when storage still has writes in flight
+        d = self.storage.close_spider(spider)
+        if isinstance(d, defer.Deferred):
+            return d.addBoth(lambda _: self.metrics.close(spider))
+        self.metrics.close(spider)
 
     @ignore_on_fail
     def process_request(self, request, spider):
@@ -92,12 +102,36 @@ class HistoryMiddleware(object):
         """
         if self.epoch and self.retrieve_if(spider, request):
             request.meta['epoch'] = self.epoch
-            response = self.storage.retrieve_response(spider, request)
-            if response:
-                response.flags.append('historic')
-                return response
-            elif self.ignore_missing:
-                raise IgnoreRequest("Ignored; request not in history: %s" % request)
+            start = default_timer()
+            retrieve_async = getattr(self.storage, 'retrieve_response_async', None)
+            if retrieve_async is None:
+                response = self.storage.retrieve_response(spider, request)
+                return self._retrieved(response, request, spider, start)
+
+            # the downloader waits on the Deferred without blocking the
+            # reactor, so lookups of concurrent requests overlap
+            d = retrieve_async(spider, request)
+            d.addCallback(self._retrieved, request, spider, start)
+            d.addErrback(self._failed, 'retrieve', request)
+            return d
+
+    def _retrieved(self, response, request, spider, start):
+        self.metrics.observe('history/retrieve/latency', (default_timer() - start) * 1000,
+                             spider=spider)
+        if response:
+            self.metrics.inc('history/retrieve/hit', spider=spider)
+            self.metrics.observe('history/retrieve/bytes', body_length(response), spider=spider)
+            response.flags.append('historic')
+            return response
+
+        self.metrics.inc('history/retrieve/miss', spider=spider)
+        if self.ignore_missing:
+            raise IgnoreRequest("Ignored; request not in history: %s" % request)
+
+    def _failed(self, failure, action, request):
+        # same as `ignore_on_fail`, for errors raised asynchronously
+        logger.info('failed to {} {} response: {}'.format(action, request.url,
+                                                          failure.getErrorMessage()))
 
     def process_response(self, request, response, spider):
         """A response is leaving the Downloader. It was either retreived
@@ -106,14 +140,38 @@ class HistoryMiddleware(object):
         Decide if we would like to store it in the history.
         """
         try:
-            if self.store_if(spider, request, response):
-                self.storage.store_response(spider, request, response)
-                self.stats.set_value('history/cached', True, spider=spider)
+            decision = self.store_if(spider, request, response)
+            if isinstance(decision, defer.Deferred):
+                # the policy looks up what is already stored: hold the
+                # response until it has decided
+                decision.addCallback(self._store, request, response, spider)
+                decision.addErrback(self._failed, 'store', request)
+                return decision.addBoth(lambda _: response)
+            return self._store(decision, request, response, spider)
         except Exception as e:
             logger.info('failed to process {} response: {}'.format(request.url, e))
-        finally:
+
+        return response
+
+    def _store(self, decision, request, response, spider):
+        if not decision:
+            self.metrics.inc('history/store/skipped', spider=spider)
             return response
 
+        store_async = getattr(self.storage, 'store_response_async', None)
+        if store_async is None:
+            queued = self.storage.store_response(spider, request, response)
+        else:
+            queued = store_async(spider, request, response)
+        self.stats.set_value('history/cached', True, spider=spider)
+        self.metrics.inc('history/store/stored', spider=spider)
+        if isinstance(queued, defer.Deferred):
+            # storage is applying backpressure: hold the response until the
+            # write has been accepted
+            queued.addErrback(self._failed, 'store', request)
+            return queued.addBoth(lambda _: response)
+        return response
+
     @staticmethod
     def parse_epoch(epoch):
         if isinstance(epoch, bool) or isinstance(epoch, datetime):
@@ -123,10 +181,13 @@ class HistoryMiddleware(object):
         elif epoch == 'False':
             return False
 
-        try:
-            return datetime.strptime(epoch, EPOCH_DATE_FORMAT)
-        except ValueError:
-            pass
+        for epoch_format in EPOCH_FORMATS:
+            try:
+                return datetime.strptime(epoch, epoch_format)
+            except ValueError:
+                pass
+
+        from parsedatetime import parsedatetime, Constants
 
         parser = parsedatetime.Calendar(Constants())
         time_tupple = parser.parse(epoch)  # 'yesterday' => (time.struct_time, int)
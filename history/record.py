@@ -0,0 +1,553 @@
+# -*- coding: utf-8 -*-
+"""Serialization of the request/response pairs stored in the history.
+
+Two formats can be read back:
+
+* `json` (legacy): a JSON document holding the metadata, the headers and
+  the body, decoded to unicode or base64-encoded for binary responses.
+
+* `binary`: a small fixed header followed by JSON metadata and the raw,
+  optionally compressed, body:
+
+      magic (4 bytes) | format version (1 byte) | compression (1 byte)
+      metadata length (uint) | metadata (JSON) | body
+
+  The metadata is never compressed so that it can be read without
+  fetching the body.
+
+Records are written in the format selected by HISTORY_RECORD_FORMAT.
+
+"""
+
+from __future__ import absolute_import, unicode_literals
+import base64
+import codecs
+import hashlib
+import json
+import logging
+import struct
+import zlib
+
+from scrapy.exceptions import NotConfigured
+from scrapy.http import Headers, Response, TextResponse
+from scrapy.responsetypes import responsetypes
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'HREC'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('>4sBBI')
+
+COMPRESSION_NONE = 0
+COMPRESSION_GZIP = 1
+COMPRESSION_ZSTD = 2
+COMPRESSIONS = {
+    'none': COMPRESSION_NONE,
+    'gzip': COMPRESSION_GZIP,
+    'zstd': COMPRESSION_ZSTD,
+}
+# zlib window size for gzip containers
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+# bytes of body (de)compressed at once when streaming records
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+def detect_encoding(response):
+    """Encoding of a text response, found without decoding its body.
+
+    That is the encoding Scrapy already resolved (given to the response,
+    or inferred when its text was accessed), else the one declared in the
+    Content-Type header or in the body (BOM, <meta> tag). None means Scrapy
+    would infer it from the whole body, which it does the same way when
+    the response is built again from its stored bytes.
+
+    """
+    if not isinstance(response, TextResponse):
+        return None
+    cached = getattr(response, '_cached_benc', None)
+    if cached:
+        return cached
+    declared_encoding = getattr(response, '_declared_encoding', None)
+    if declared_encoding is None:
+        return response.encoding
+    return declared_encoding()
+
+
+def _try_decoding_response_body(response_body, encoding):
+    """Decode a body with its encoding if known, else UTF-8, falling back to
+    latin-1, which maps every byte. Return the encoding used along with the
+    text.
+
+    The body is decoded once when the encoding is right, twice at most
+    otherwise. An encoding Python doesn't know is skipped.
+
+    """
+    candidates = []
+    codec = None
+    if encoding:
+        try:
+            codec = codecs.lookup(encoding).name
+            candidates.append(encoding)
+        except LookupError:
+            logger.debug('unknown encoding {}, decoding as UTF-8'.format(encoding))
+    if codec != 'utf-8':
+        candidates.append('utf-8')
+    for candidate in candidates:
+        try:
+            return candidate, response_body.decode(candidate)
+        except UnicodeDecodeError:
+            pass
+
+    return 'latin-1', response_body.decode('latin-1')
+
+
+def _coerce_unicode_encoding(text):
+    if isinstance(text, bytes):
+        return text.decode('utf-8')
+    return text
+
+
+def _reformat_response(response):
+    """Return the body of a response as a string for a JSON record, along
+    with whether it is base64-encoded binary data and the encoding of the
+    text otherwise.
+
+    """
+    if isinstance(response, TextResponse):
+        # Textual response (HTMl, XML, csv, etc.),
+        # decoded to unicode using encoding (from Content-Type)
+        encoding, response_body = _try_decoding_response_body(response.body,
+                                                              detect_encoding(response))
+        logger.debug('encoded to unicode from text response format: {}'.format(encoding))
+        return response_body, False, encoding
+
+    # Binary response (excel, pdf, etc.)
+    # encode it to be able to store it on S3 as a string
+    logger.debug('encoded binary response to base64')
+    return base64.b64encode(response.body).decode('ascii'), True, None
+
+
+def _encode_json_record(request, response):
+    """Serialize a request/response pair to the JSON document stored in
+    the cache. Return the document along with its metadata.
+
+    """
+    response_body, binary, encoding = _reformat_response(response)
+
+    metadata = {
+        'url': request.url,
+        'method': request.method,
+        'status': response.status,
+        'response_url': response.url,
+    }
+
+    data = {
+        'binary': binary,
+        'metadata': metadata,
+        'request_headers': request.headers.to_unicode_dict(),
+        'request_body': _coerce_unicode_encoding(request.body),
+        'response_headers': response.headers.to_unicode_dict(),
+        'response_body': response_body,
+        # encodes response_body back to the original bytes
+        'encoding': encoding,
+    }
+
+    data_string = json.dumps(data, ensure_ascii=False)
+    # sometimes can cause memory error in SH if too big
+    logger.debug('request/response object size: {} kB'.format(len(data_string) / 1024))
+
+    return data_string, metadata
+
+
+def _decode_json_record(data_string):
+    """Build back the response stored by `_encode_json_record`."""
+    data = json.loads(data_string)
+
+    metadata = data['metadata']
+    response_headers = Headers(data['response_headers'])
+    response_body = data['response_body']
+
+    # records written before the encoding was stored hold the text of the
+    # body, which is encoded to UTF-8
+    encoding = data.get('encoding') or 'utf8'
+    if data.get('binary', False):
+        logger.debug('retrieved binary body')
+        response_body = base64.b64decode(response_body)
+    else:
+        response_body = response_body.encode(encoding)
+    url = str(metadata['response_url'])
+    status = metadata.get('status')
+    Response = responsetypes.from_args(headers=response_headers, url=url)
+    if issubclass(Response, TextResponse):
+        encoding = {'encoding': encoding}
+    else:
+        encoding = {}
+
+    return Response(url=url,
+                    headers=response_headers,
+                    status=status,
+                    body=response_body,
+                    **encoding)
+
+
+def _encode_headers(headers):
+    # keep every value of repeated headers (e.g. Set-Cookie)
+    return {k.decode('latin-1'): [v.decode('latin-1') for v in values]
+            for k, values in headers.items()}
+
+
+def _compressor(compression, level):
+    if compression == COMPRESSION_GZIP:
+        return zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    if compression == COMPRESSION_ZSTD:
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    return None
+
+
+def _decompressor(compression):
+    if compression == COMPRESSION_GZIP:
+        return zlib.decompressobj(GZIP_WBITS)
+    if compression == COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise ValueError('zstandard is needed to read zstd compressed records')
+        return zstandard.ZstdDecompressor().decompressobj()
+    return None
+
+
+def record_metadata(request, response):
+    return {
+        'url': request.url,
+        'method': request.method,
+        'status': response.status,
+        'response_url': response.url,
+    }
+
+
+def body_digest(body):
+    """Hex digest identifying a body in content-addressed storage."""
+    return hashlib.sha256(body).hexdigest()
+
+
+def _iter_binary_record(request, response, compression, level, chunk_size, body_ref=None):
+    """Yield a binary record piece by piece.
+
+    The body is compressed chunk_size bytes at a time, so that no full-size
+    copy of it is ever made. If body_ref is given, the body is stored
+    elsewhere under that reference and left out of the record.
+
+    """
+    if body_ref is not None:
+        compression = COMPRESSION_NONE
+
+    header = {
+        'metadata': record_metadata(request, response),
+        'request_headers': _encode_headers(request.headers),
+        'request_body': base64.b64encode(request.body).decode('ascii'),
+        'response_headers': _encode_headers(response.headers),
+        'encoding': detect_encoding(response),
+        'body_length': len(response.body),
+    }
+    if body_ref is not None:
+        header['body_ref'] = body_ref
+    header = json.dumps(header).encode('utf-8')
+    yield HEADER.pack(MAGIC, FORMAT_VERSION, compression, len(header)) + header
+
+    if body_ref is not None:
+        return
+
+    body = response.body
+    compressor = _compressor(compression, level)
+    for start in range(0, len(body), chunk_size):
+        chunk = body[start:start + chunk_size]
+        if compressor is not None:
+            chunk = compressor.compress(chunk)
+        if chunk:
+            yield chunk
+
+    if compressor is not None:
+        yield compressor.flush()
+
+
+def read_header(data_string):
+    """Return the (compression, metadata, body offset) of a binary record.
+
+    data_string only needs to hold the beginning of the record, up to the
+    end of its metadata.
+
+    """
+    magic, version, compression, header_length = HEADER.unpack(data_string[:HEADER.size])
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError('not a binary history record')
+
+    body_offset = HEADER.size + header_length
+    header = json.loads(data_string[HEADER.size:body_offset].decode('utf-8'))
+    return compression, header, body_offset
+
+
+class LazyBody(object):
+    """Mixin of the responses whose body is only read, or decompressed,
+    when first accessed (`.body`, `.text`, selectors...).
+
+    `body_length` is the length of the body, known without loading it.
+
+    """
+
+    _load_body = None
+    body_length = None
+
+    def _get_body(self):
+        load_body, self._load_body = self._load_body, None
+        if load_body is not None:
+            self._set_body(load_body())
+        return self._body
+
+    body = property(_get_body, Response.body.fset)
+
+
+# response class => its LazyBody subclass
+_lazy_classes = {}
+
+
+def _lazy_class(response_class):
+    lazy_class = _lazy_classes.get(response_class)
+    if lazy_class is None:
+        lazy_class = type(str('Lazy' + response_class.__name__), (LazyBody, response_class), {})
+        _lazy_classes[response_class] = lazy_class
+    return lazy_class
+
+
+def body_length(response):
+    """Length of the body of a response, without loading a lazy body."""
+    if isinstance(response, LazyBody) and response._load_body is not None:
+        return response.body_length
+    return len(response.body)
+
+
+def copy_response(response):
+    """Copy of a response, like `response.copy()`, that leaves a lazy body
+    unloaded. The copy loads it through the original, so the body is read
+    at most once for all the copies.
+
+    """
+    if not isinstance(response, LazyBody) or response._load_body is None:
+        return response.copy()
+
+    # not response.replace(), which reads every attribute, the body and the
+    # encoding inferred from it included
+    attributes = getattr(response, 'attributes', ('url', 'status', 'headers', 'flags', 'request'))
+    kwargs = {name: getattr(response, name) for name in attributes
+              if name not in ('body', 'encoding')}
+    if isinstance(response, TextResponse):
+        kwargs['encoding'] = response._encoding
+    copy = response.__class__(body=b'', **kwargs)
+    copy._load_body = lambda: response.body
+    copy.body_length = response.body_length
+    return copy
+
+
+def build_response(header, body, load_body=None):
+    """Build the response described by a binary record header.
+
+    If load_body is given, the response is lazy: body is ignored and
+    load_body is called for it when first accessed.
+
+    """
+    metadata = header['metadata']
+    response_headers = Headers(header['response_headers'])
+    url = str(metadata['response_url'])
+    Response = responsetypes.from_args(headers=response_headers, url=url)
+    if load_body is not None:
+        Response = _lazy_class(Response)
+        body = b''
+
+    kwargs = {}
+    if issubclass(Response, TextResponse) and header.get('encoding'):
+        kwargs['encoding'] = header['encoding']
+
+    response = Response(url=url,
+                        headers=response_headers,
+                        status=metadata.get('status'),
+                        body=body,
+                        **kwargs)
+    if load_body is not None:
+        response._load_body = load_body
+        response.body_length = header.get('body_length')
+    return response
+
+
+def _resolve_body(header, resolve_body):
+    if resolve_body is None:
+        raise ValueError('record body is stored separately: {}'.format(header['body_ref']))
+    return resolve_body(header['body_ref'])
+
+
+def _decompress(compression, body):
+    decompressor = _decompressor(compression)
+    if decompressor is not None:
+        body = decompressor.decompress(body) + decompressor.flush()
+    return body
+
+
+def _decode_binary_record(data_string, resolve_body=None):
+    compression, header, body_offset = read_header(data_string)
+    if 'body_ref' in header:
+        return build_response(header, _resolve_body(header, resolve_body))
+
+    return build_response(header, _decompress(compression, data_string[body_offset:]))
+
+
+def _read_exactly(fileobj, size):
+    data = b''
+    while len(data) < size:
+        chunk = fileobj.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def read_record_stream(fileobj, chunk_size=STREAM_CHUNK_SIZE, resolve_body=None):
+    """Build back the response stored in a record read from a file-like
+    object, chunk_size bytes at a time.
+
+    The compressed body of binary records is never held in memory as a
+    whole, only its decompressed chunks. resolve_body is called with the
+    reference of bodies stored separately and must return them.
+
+    """
+    head = _read_exactly(fileobj, HEADER.size)
+    if not is_binary_record(head):
+        return _decode_json_record(head + fileobj.read())
+
+    _, _, compression, header_length = HEADER.unpack(head)
+    _, header, _ = read_header(head + _read_exactly(fileobj, header_length))
+    if 'body_ref' in header:
+        return build_response(header, _resolve_body(header, resolve_body))
+
+    decompressor = _decompressor(compression)
+    chunks = []
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        chunks.append(decompressor.decompress(chunk) if decompressor is not None else chunk)
+    if decompressor is not None and hasattr(decompressor, 'flush'):
+        chunks.append(decompressor.flush())
+
+    return build_response(header, b''.join(chunks))
+
+
+def _holds_metadata(head):
+    return (len(head) >= HEADER.size and
+            len(head) >= HEADER.size + HEADER.unpack(head[:HEADER.size])[3])
+
+
+def read_record_lazy(head, read_from=None, resolve_body=None):
+    """Build back the response stored in a record from its beginning, head,
+    leaving its body to be read and decompressed when first accessed.
+
+    read_from(offset) returns the record from offset to its end; it is
+    called for the rest of the body, and for the rest of the record if head does not
+    hold the whole metadata or the record is a JSON one, which is decoded
+    right away. Without read_from, head is the whole record. See
+    `read_record_stream` for resolve_body.
+
+    """
+    if read_from is not None and not (is_binary_record(head) and _holds_metadata(head)):
+        head, read_from = head + read_from(len(head)), None
+    if not is_binary_record(head):
+        return _decode_json_record(head)
+
+    compression, header, body_offset = read_header(head)
+    if 'body_ref' in header:
+        return build_response(header, None, lambda: _resolve_body(header, resolve_body))
+
+    def load_body():
+        body = head[body_offset:]
+        if read_from is not None:
+            body += read_from(len(head))
+        return _decompress(compression, body)
+
+    return build_response(header, None, load_body)
+
+
+def is_binary_record(data_string):
+    return data_string[:len(MAGIC)] == MAGIC
+
+
+def decode_record(data_string, resolve_body=None):
+    """Build back the response stored in a record of any format.
+
+    See `read_record_stream` for resolve_body.
+    """
+    if is_binary_record(data_string):
+        return _decode_binary_record(data_string, resolve_body)
+
+    return _decode_json_record(data_string)
+
+
+class RecordCodec(object):
+    """Serialize responses in the format configured in the settings.
+
+    HISTORY_RECORD_FORMAT is either `binary` (default) or `json`. Binary
+    records are compressed with HISTORY_COMPRESSION (`gzip`, default,
+    `zstd` or `none`) at HISTORY_COMPRESSION_LEVEL.
+
+    """
+
+    def __init__(self, settings):
+        self.format = settings.get('HISTORY_RECORD_FORMAT', 'binary')
+        if self.format not in ('binary', 'json'):
+            raise NotConfigured('Unknown HISTORY_RECORD_FORMAT: {}'.format(self.format))
+
+        compression = settings.get('HISTORY_COMPRESSION', 'gzip')
+        if compression not in COMPRESSIONS:
+            raise NotConfigured('Unknown HISTORY_COMPRESSION: {}'.format(compression))
+        if compression == 'zstd' and zstandard is None:
+            raise NotConfigured('HISTORY_COMPRESSION = zstd requires the zstandard package')
+        self.compression = COMPRESSIONS[compression]
+
+        default_level = 3 if self.compression == COMPRESSION_ZSTD else 6
+        self.level = settings.getint('HISTORY_COMPRESSION_LEVEL', default_level)
+
+    def encode(self, request, response, body_ref=None):
+        """Return the record of a request/response pair as bytes, along
+        with its metadata.
+
+        body_ref, only supported by binary records, is the reference of a
+        body stored separately (e.g. its `body_digest`); the body is then
+        left out of the record.
+
+        """
+        if self.format == 'json':
+            if body_ref is not None:
+                raise ValueError('JSON records always hold the response body')
+            data_string, metadata = _encode_json_record(request, response)
+            return data_string.encode('utf-8'), metadata
+
+        data_string = b''.join(self.iter_encode(request, response, body_ref=body_ref))
+        logger.debug('request/response record size: {} kB'.format(len(data_string) / 1024))
+        return data_string, record_metadata(request, response)
+
+    def iter_encode(self, request, response, chunk_size=STREAM_CHUNK_SIZE, body_ref=None):
+        """Yield the record of a request/response pair piece by piece.
+
+        Only binary records are actually streamed, JSON ones are yielded
+        whole.
+
+        """
+        if self.format == 'json':
+            yield self.encode(request, response, body_ref=body_ref)[0]
+            return
+
+        for chunk in _iter_binary_record(request, response, self.compression, self.level,
+                                         chunk_size, body_ref=body_ref):
+            yield chunk
+
+    def decode(self, data_string, resolve_body=None):
+        return decode_record(data_string, resolve_body)
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""Replay a historic job from a local archive.
+
+`ReplayStorage` serves the responses stored by a single job, selected with
+HISTORY_REPLAY_JOB, without any S3 round-trip during the crawl. The first
+time a job is replayed its records are downloaded into a packed archive
+(see `history.archive`) under HISTORY_REPLAY_DIR; following replays read
+that archive only.
+
+The records of a job are found, in order of preference:
+
+* in the manifest written in the job folder (`HISTORY_SAVE_SOURCE`) by
+  `S3CacheStorage`, which points at the segments holding the versions
+  compacted since (see `history.cli`);
+* in the spool segments indexed with the job (`S3SpoolStorage`);
+* for jobs stored before manifests were written, among the cache keys
+  stored between the start of the job (from its folder name) and its last
+  source copy.
+
+"""
+
+from __future__ import absolute_import, unicode_literals
+from datetime import datetime
+import json
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import re
+import shutil
+import tempfile
+
+from scrapy.exceptions import NotConfigured
+
+from history.archive import (
+    INDEX_SUFFIX,
+    ArchiveIndex,
+    ArchiveWriter,
+    dump_index,
+    load_index,
+    read_record,
+)
+from history.index import _to_timestamp
+from history.record import decode_record, is_binary_record, read_header, read_record_lazy
+from history.storage import (
+    MANIFEST_NAME,
+    S3CacheStorage,
+    _key_timestamp,
+    _write_file,
+    cache_key,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REPLAY_DIR = '.scrapy/history-replay'
+ARCHIVE_SUFFIX = '.arc'
+# `{time}` of the default HISTORY_SAVE_SOURCE template
+JOB_TIME_RE = re.compile(r'(\d{4}-\d\d-\d\dT\d\d-\d\d-\d\d)')
+JOB_TIME_FORMAT = '%Y-%m-%dT%H-%M-%S'
+
+
+class ReplayStorage(S3CacheStorage):
+    """Serve the responses of a historic job from a local archive.
+
+    HISTORY_REPLAY_JOB is either the job folder (e.g.
+    `myspider/2018-01-01T00-00-00_123_4_5`) or the id of the job
+    (`123/4/5`). Set HISTORY_REPLAY_REFRESH to download the archive again.
+
+    Requests are matched by fingerprint, whatever the epoch; responses are
+    never stored.
+
+    """
+
+    def __init__(self, stats, general_settings):
+        super(ReplayStorage, self).__init__(stats, general_settings)
+        self.replay_job = general_settings.get('HISTORY_REPLAY_JOB')
+        if not self.replay_job:
+            raise NotConfigured('ReplayStorage requires HISTORY_REPLAY_JOB')
+        self.replay_dir = general_settings.get('HISTORY_REPLAY_DIR', DEFAULT_REPLAY_DIR)
+        self.refresh = general_settings.getbool('HISTORY_REPLAY_REFRESH', False)
+        self.archive_path = None
+        self.index = ArchiveIndex()
+
+    def open_spider(self, spider):
+        # no S3 connection unless the archive has to be built
+        super(S3CacheStorage, self).open_spider(spider)
+
+        job = self._find_local_job(spider)
+        if job is None or self.refresh:
+            S3CacheStorage._check_configured(self)
+            self._connect()
+            try:
+                job = self._find_job(spider)
+                self._build_archive(spider, job)
+            finally:
+                self.s3_connection.close()
+
+        self.archive_path = self._archive_path(job, ARCHIVE_SUFFIX)
+        with open(self._archive_path(job, INDEX_SUFFIX), 'rb') as f:
+            entries, _ = load_index(f.read())
+        self.index.add(self.archive_path, entries)
+        logger.info('replaying {} records of job {}'.format(len(entries), job))
+
+    def _check_configured(self):
+        # the S3 settings are only required to build the archive, jobs
+        # already archived replay offline
+        pass
+
+    def close_spider(self, spider):
+        return super(S3CacheStorage, self).close_spider(spider)
+
+    def prefetch(self, spider, epoch):
+        pass
+
+    def last_digest(self, spider, request):
+        return None
+
+    def stored_timestamps(self, spider):
+        return {}
+
+    def retrieve_response(self, spider, request):
+        version = self.index.lookup(self.request_fingerprint(request), True)
+        if version is None:
+            self.metrics.inc_value('history/replay/miss', spider=spider)
+            return
+
+        self.metrics.inc_value('history/replay/hit', spider=spider)
+        _, archive, offset, length = version
+        data_string = read_record(archive, offset, length)
+        if self.lazy_body:
+            return read_record_lazy(data_string, resolve_body=self._read_blob)
+        return decode_record(data_string, resolve_body=self._read_blob)
+
+    def store_response(self, spider, request, response):
+        logger.debug('not storing replayed response for {}.'.format(request.url))
+
+    def _read_blob(self, digest):
+        version = self.index.lookup(digest, True)
+        if version is None:
+            raise ValueError('body {} is missing from the replay archive'.format(digest))
+        _, archive, offset, length = version
+        return read_record(archive, offset, length)
+
+    def _archive_path(self, job, suffix):
+        return os.path.join(self.replay_dir, job + suffix)
+
+    def _job_suffix(self):
+        return '_' + self.replay_job.strip('/').replace('/', '_')
+
+    def _find_local_job(self, spider):
+        """Return the job of an archive built by a previous replay."""
+        job = self.replay_job.strip('/')
+        if not job.startswith(spider.name + '/'):
+            local_dir = os.path.join(self.replay_dir, spider.name)
+            names = os.listdir(local_dir) if os.path.isdir(local_dir) else []
+            jobs = sorted(name[:-len(INDEX_SUFFIX)] for name in names
+                          if name.endswith(self._job_suffix() + INDEX_SUFFIX))
+            if not jobs:
+                return None
+            job = '{}/{}'.format(spider.name, jobs[-1])
+
+        return job if os.path.exists(self._archive_path(job, INDEX_SUFFIX)) else None
+
+    def _find_job(self, spider):
+        """Return the S3 folder of the job to replay."""
+        job = self.replay_job.strip('/')
+        if job.startswith(spider.name + '/'):
+            return job
+
+        suffix = self._job_suffix()
+        jobs = sorted(prefix.name.rstrip('/')
+                      for prefix in self.s3_bucket.list(prefix=spider.name + '/', delimiter='/')
+                      if prefix.name.endswith(suffix + '/'))
+        if not jobs:
+            # spooled jobs have no folder, only segments
+            jobs = sorted(metadata.get('job', '') for _, _, metadata in self._segments(spider)
+                          if metadata.get('job', '').endswith(suffix))
+        if not jobs:
+            raise ValueError('no history found for job {}'.format(self.replay_job))
+        return jobs[-1]
+
+    def _build_archive(self, spider, job):
+        """Download the records of job into a local archive and index."""
+        # segments are downloaded whole, then their records copied
+        self.download_dir = tempfile.mkdtemp(prefix='history-replay-')
+        try:
+            self._write_archive(spider, job)
+        finally:
+            shutil.rmtree(self.download_dir, ignore_errors=True)
+
+    def _write_archive(self, spider, job):
+        records = self._list_manifest(spider, job)
+        if records is None:
+            records = self._list_segments(spider, job)
+        if records is None:
+            records = self._list_job_window(spider, job)
+        logger.info('downloading {} records of job {}'.format(len(records), job))
+
+        archive_path = self._archive_path(job, ARCHIVE_SUFFIX)
+        open_path = archive_path + '.open'
+        if not os.path.isdir(os.path.dirname(archive_path)):
+            os.makedirs(os.path.dirname(archive_path))
+        if os.path.exists(open_path):
+            os.remove(open_path)
+
+        writer = ArchiveWriter(open_path)
+        blobs = set()
+        pool = ThreadPool(self.prefetch_threads)
+        try:
+            for fingerprint, timestamp, data_string, blob in pool.imap(self._fetch_record,
+                                                                       records):
+                writer.append(fingerprint, timestamp, data_string)
+                if blob is not None and blob[0] not in blobs:
+                    blobs.add(blob[0])
+                    writer.append(blob[0], timestamp, blob[1])
+                self.metrics.inc_value('history/replay/records', spider=spider)
+                self.metrics.inc_value('history/replay/bytes', len(data_string), spider=spider)
+        finally:
+            pool.close()
+            pool.join()
+            entries = writer.close()
+
+        # the index goes last: an archive is only used once it is indexed
+        os.rename(open_path, archive_path)
+        _write_file(self._archive_path(job, INDEX_SUFFIX), [dump_index(entries, job=job)])
+
+    def _fetch_record(self, record):
+        """Return the (fingerprint, timestamp, data, blob) of a record; blob
+        is the (digest, body) of a body stored separately, if any.
+
+        """
+        fingerprint, timestamp, fetch = record
+        data_string = fetch()
+        blob = None
+        if is_binary_record(data_string):
+            _, header, _ = read_header(data_string)
+            if 'body_ref' in header:
+                blob = (header['body_ref'], self._get_blob(header['body_ref']))
+        return fingerprint, timestamp, data_string, blob
+
+    def _fetch_version(self, key, version_id):
+        def fetch():
+            s3_key = self.s3_bucket.new_key(key)
+            s3_key.version_id = None if version_id == 'null' else version_id
+            try:
+                return s3_key.get_contents_as_string()
+            finally:
+                s3_key.close()
+        return fetch
+
+    def _fetch_range(self, key, offset, length):
+        return lambda: self._read_range(key, None, offset, offset + length - 1)
+
+    def _list_manifest(self, spider, job):
+        s3_key = self.s3_bucket.get_key('{}/{}'.format(job, MANIFEST_NAME))
+        if s3_key is None:
+            return None
+
+        manifest = json.loads(s3_key.get_contents_as_string().decode('utf-8'))
+        shard_width = manifest.get('key_shard_width', 0)
+        records = [
+            (fingerprint, timestamp,
+             self._fetch_version(cache_key(spider.name, fingerprint, shard_width), version_id))
+            for fingerprint, version_id, timestamp in manifest['versions']
+        ]
+        # versions compacted into segments since the job ran
+        segment_prefix = '{name}/segments/'.format(name=spider.name)
+        records.extend(
+            (fingerprint, timestamp, self._fetch_range(segment_prefix + segment, offset, length))
+            for fingerprint, timestamp, segment, offset, length in manifest.get('segments', [])
+        )
+        return records
+
+    def _list_segments(self, spider, job):
+        """Records of the spool segments written by job, read from local
+        copies of the segments.
+
+        """
+        records = []
+        for segment, entries, metadata in self._segments(spider):
+            if metadata.get('job') != job:
+                continue
+
+            segment_path = self._download(segment)
+            records.extend(
+                (fingerprint, timestamp, self._fetch_local(segment_path, offset, length))
+                for fingerprint, timestamp, offset, length in entries
+            )
+
+        return records or None
+
+    def _segments(self, spider):
+        """Yield the (key, entries, metadata) of the spool segments of the
+        spider.
+
+        """
+        segment_prefix = '{name}/segments/'.format(name=spider.name)
+        for s3_key in self.s3_bucket.list(prefix=segment_prefix):
+            if s3_key.name.endswith(INDEX_SUFFIX):
+                entries, metadata = load_index(s3_key.get_contents_as_string())
+                yield s3_key.name[:-len(INDEX_SUFFIX)], entries, metadata
+
+    def _download(self, key):
+        path = os.path.join(self.download_dir, key.replace('/', '_'))
+        s3_key = self.s3_bucket.new_key(key)
+        try:
+            s3_key.get_contents_to_filename(path)
+        finally:
+            s3_key.close()
+        return path
+
+    def _fetch_local(self, path, offset, length):
+        return lambda: read_record(path, offset, length)
+
+    def _list_job_window(self, spider, job):
+        """Most recent version of every cache key stored while job ran:
+        from its start time to its last source copy.
+
+        """
+        match = JOB_TIME_RE.search(job.rsplit('/', 1)[-1])
+        if match is None:
+            raise ValueError('cannot tell when job {} ran'.format(job))
+        start = _to_timestamp(datetime.strptime(match.group(1), JOB_TIME_FORMAT))
+
+        end = None
+        for s3_key in self.s3_bucket.list(prefix='{}/source/'.format(job)):
+            stored = _key_timestamp(s3_key)
+            end = stored if end is None else max(end, stored)
+        if end is None:
+            return []
+
+        records = []
+        for key, versions in self._list_stored_versions(spider).items():
+            versions = [version for version in versions if start <= version[0] <= end]
+            if versions:
+                timestamp, version_id = versions[-1]
+                records.append((key.rsplit('/', 1)[1], timestamp,
+                                self._fetch_version(key, version_id)))
+        return records
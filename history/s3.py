@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""S3 connection shared by the threads of a storage backend."""
+
+from __future__ import absolute_import, unicode_literals
+import contextlib
+import threading
+import weakref
+
+from boto.s3.connection import OrdinaryCallingFormat, S3Connection
+from six.moves.urllib import parse
+
+DEFAULT_MAX_CONNECTIONS = 10
+DEFAULT_RETRIES = 5
+# query parameters of bucket listings
+LIST_PARAMETERS = {'delimiter', 'key-marker', 'list-type', 'marker', 'max-keys',
+                   'prefix', 'versions'}
+
+# set in the threads whose requests are not retried, see `single_attempt`
+_attempts = threading.local()
+
+
+def _operation(request):
+    """Name of the S3 operation of a request, for metrics: list, get,
+    put, head, post or delete.
+
+    """
+    method = request.method.lower()
+    if method == 'get' and '?' in request.path:
+        query = request.path.split('?', 1)[1]
+        if {param.split('=', 1)[0] for param in query.split('&')} & LIST_PARAMETERS:
+            return 'list'
+    return method
+
+
+@contextlib.contextmanager
+def single_attempt():
+    """Make the S3 requests of the current thread once, without retrying
+    them: for writes retried as a whole by the writer pool.
+
+    """
+    _attempts.single = True
+    try:
+        yield
+    finally:
+        _attempts.single = False
+
+
+class PooledS3Connection(S3Connection):
+    """S3 connection running at most `max_connections` requests at once.
+
+    boto takes an HTTP connection from its pool for every request and puts
+    it back once the response has been read, so threads (reader, writer and
+    prefetch pools) can share a connection and reuse the sockets opened by
+    each other (keep-alive). A request holds its slot until its response
+    body has been read or closed, as boto returns GET responses before
+    reading them. Failed requests (socket errors and 5xx responses) are
+    retried `num_retries` times with an exponential backoff, unless made in
+    `single_attempt`.
+
+    When `metrics` is set, the time spent waiting for a free connection and
+    the latency of each operation are observed under `history/s3/`.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        max_connections = kwargs.pop('max_connections', DEFAULT_MAX_CONNECTIONS)
+        super(PooledS3Connection, self).__init__(*args, **kwargs)
+        self.slots = threading.BoundedSemaphore(max(1, max_connections))
+        self.metrics = None
+
+    def _mexe(self, request, sender=None, override_num_retries=None, retry_handler=None):
+        if override_num_retries is None and getattr(_attempts, 'single', False):
+            override_num_retries = 0
+
+        if self.metrics is None:
+            self.slots.acquire()
+        else:
+            with self.metrics.timer('history/s3/wait'):
+                self.slots.acquire()
+        try:
+            if self.metrics is None:
+                response = super(PooledS3Connection, self)._mexe(
+                    request, sender, override_num_retries, retry_handler=retry_handler)
+            else:
+                with self.metrics.timer('history/s3/' + _operation(request)):
+                    response = super(PooledS3Connection, self)._mexe(
+                        request, sender, override_num_retries, retry_handler=retry_handler)
+        except Exception:
+            self.slots.release()
+            raise
+        return self._hold_slot(response)
+
+    def _hold_slot(self, response):
+        """Release the slot of response once its body has been read to the
+        end or closed, or once it is garbage collected if neither happens.
+
+        """
+        lock = threading.Lock()
+        held = [True]
+
+        def release():
+            with lock:
+                if not held[0]:
+                    return
+                held[0] = False
+            self.slots.release()
+
+        if response is None or response.isclosed():
+            release()
+            return response
+
+        read, close = response.read, response.close
+
+        def read_and_release(*args, **kwargs):
+            try:
+                return read(*args, **kwargs)
+            finally:
+                if response.isclosed():
+                    release()
+
+        def close_and_release():
+            try:
+                close()
+            finally:
+                release()
+
+        response.read = read_and_release
+        response.close = close_and_release
+        if hasattr(weakref, 'finalize'):
+            weakref.finalize(response, release)
+        return response
+
+
+def parse_endpoint(endpoint):
+    """Return the connection arguments of an endpoint URL such as
+    `http://localhost:9000`; HTTPS is assumed without a scheme.
+
+    """
+    if '://' not in endpoint:
+        endpoint = 'https://' + endpoint
+    url = parse.urlparse(endpoint)
+    return {
+        'host': url.hostname,
+        'port': url.port,
+        'is_secure': url.scheme != 'http',
+        # S3 stand-ins (MinIO, moto server) don't serve virtual host buckets
+        'calling_format': OrdinaryCallingFormat(),
+    }
+
+
+def connect(access_key, secret_key, endpoint=None,
+            max_connections=DEFAULT_MAX_CONNECTIONS, retries=DEFAULT_RETRIES):
+    # Fails with understandable Traceback if is_secure is set to True.
+    # Else it will fail on S3Connection.get_bucket() with a super vague
+    # message Trace:
+    # TypeError: int() argument must be a string or a number, not 'NoneType'
+    kwargs = {'is_secure': True}
+    if endpoint:
+        kwargs.update(parse_endpoint(endpoint))
+
+    connection = PooledS3Connection(access_key, secret_key,
+                                    max_connections=max_connections, **kwargs)
+    connection.num_retries = retries
+    # S3Connection does not work when using proxy. S3Connection.use_proxy
+    # must be set to False.
+    connection.use_proxy = False
+    return connection
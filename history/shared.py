@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+"""Version index shared by the crawl processes of a spider.
+
+With HISTORY_SHARED_INDEX the version index (see `history.index`) lives
+in a coordination backend shared by the workers rather than in the memory
+of each process, so that the versions and digests stored by one worker
+are seen by the others right away. Workers also share their negative
+lookups: a fingerprint found missing from S3 is not listed again by any
+worker for HISTORY_SHARED_INDEX_MISS_TTL seconds, unless stored meanwhile.
+
+HISTORY_SHARED_INDEX is the URL of the backend:
+
+* `sqlite:///path/to/index.db`: a SQLite file, for the processes of a
+  single host;
+* `redis://host:6379/0` (or `rediss://`): a Redis server, or any server
+  speaking its protocol, for the workers of many hosts. Requires the
+  redis package.
+
+The index shards saved in S3 stay the durable copy: the first worker
+loads them into an empty backend, and every worker still merges the
+versions it stored into them when it closes.
+
+"""
+
+from __future__ import absolute_import, unicode_literals
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from scrapy.exceptions import NotConfigured
+from six.moves.urllib import parse
+
+from history.index import VersionIndex
+
+
+class SQLiteBackend(object):
+    """Index kept in a SQLite file, shared by the processes of a host.
+
+    Each thread has its own connection; writes of concurrent processes are
+    serialized by SQLite, in WAL mode so that they don't block reads.
+
+    """
+
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS versions (name TEXT, fingerprint TEXT, timestamp REAL, '
+        'version_id TEXT, PRIMARY KEY (name, fingerprint, timestamp, version_id))',
+        'CREATE TABLE IF NOT EXISTS digests (name TEXT, fingerprint TEXT, digest TEXT, '
+        'PRIMARY KEY (name, fingerprint))',
+        'CREATE TABLE IF NOT EXISTS misses (name TEXT, fingerprint TEXT, expires REAL, '
+        'PRIMARY KEY (name, fingerprint))',
+        'CREATE TABLE IF NOT EXISTS seeded (name TEXT PRIMARY KEY)',
+    ]
+
+    def __init__(self, path, timeout=30.0):
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with self._connection() as connection:
+            for statement in self.SCHEMA:
+                connection.execute(statement)
+
+    def _connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            # closed by the thread closing the storage
+            connection = sqlite3.connect(self.path, timeout=self.timeout,
+                                         check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self.local.connection = connection
+            with self.lock:
+                self.connections.append(connection)
+        return connection
+
+    def versions(self, name, fingerprint, now):
+        """Return the sorted (timestamp, version_id) of fingerprint, [] if
+        it was found missing less than the miss TTL ago, or None if it is
+        unknown.
+
+        """
+        connection = self._connection()
+        versions = connection.execute(
+            'SELECT timestamp, version_id FROM versions WHERE name = ? AND fingerprint = ? '
+            'ORDER BY timestamp, version_id', (name, fingerprint)).fetchall()
+        if versions:
+            return [tuple(version) for version in versions]
+        missing = connection.execute(
+            'SELECT 1 FROM misses WHERE name = ? AND fingerprint = ? AND expires > ?',
+            (name, fingerprint, now)).fetchone()
+        return [] if missing else None
+
+    def add_versions(self, name, entries):
+        """Add (fingerprint, timestamp, version_id) entries."""
+        with self._connection() as connection:
+            connection.executemany(
+                'INSERT OR IGNORE INTO versions VALUES (?, ?, ?, ?)',
+                [(name, fingerprint, timestamp, version_id)
+                 for fingerprint, timestamp, version_id in entries])
+            connection.executemany(
+                'DELETE FROM misses WHERE name = ? AND fingerprint = ?',
+                set((name, fingerprint) for fingerprint, _, _ in entries))
+
+    def set_versions(self, name, versions):
+        """Replace the versions of fingerprints, a dict of fingerprint =>
+        [(timestamp, version_id)]. Fingerprints left without a version stay
+        known, as missing until stored again.
+
+        """
+        with self._connection() as connection:
+            for fingerprint, fingerprint_versions in versions.items():
+                connection.execute('DELETE FROM versions WHERE name = ? AND fingerprint = ?',
+                                   (name, fingerprint))
+                connection.executemany(
+                    'INSERT OR IGNORE INTO versions VALUES (?, ?, ?, ?)',
+                    [(name, fingerprint, timestamp, version_id)
+                     for timestamp, version_id in fingerprint_versions])
+                if fingerprint_versions:
+                    connection.execute('DELETE FROM misses WHERE name = ? AND fingerprint = ?',
+                                       (name, fingerprint))
+                else:
+                    connection.execute('INSERT OR REPLACE INTO misses VALUES (?, ?, ?)',
+                                       (name, fingerprint, float('inf')))
+
+    def add_missing(self, name, fingerprint, expires):
+        with self._connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO misses VALUES (?, ?, ?)',
+                               (name, fingerprint, expires))
+
+    def digest(self, name, fingerprint):
+        row = self._connection().execute(
+            'SELECT digest FROM digests WHERE name = ? AND fingerprint = ?',
+            (name, fingerprint)).fetchone()
+        return row[0] if row else None
+
+    def set_digests(self, name, digests, overwrite=True):
+        statement = 'INSERT OR {} INTO digests VALUES (?, ?, ?)'.format(
+            'REPLACE' if overwrite else 'IGNORE')
+        with self._connection() as connection:
+            connection.executemany(statement, [(name, fingerprint, digest)
+                                               for fingerprint, digest in digests.items()])
+
+    def timestamps(self, name):
+        """Return the time of the most recent version of every fingerprint."""
+        return dict(self._connection().execute(
+            'SELECT fingerprint, MAX(timestamp) FROM versions WHERE name = ? '
+            'GROUP BY fingerprint', (name,)))
+
+    def is_seeded(self, name):
+        return self._connection().execute(
+            'SELECT 1 FROM seeded WHERE name = ?', (name,)).fetchone() is not None
+
+    def set_seeded(self, name):
+        with self._connection() as connection:
+            connection.execute('INSERT OR IGNORE INTO seeded VALUES (?)', (name,))
+
+    def close(self):
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+        self.local = threading.local()
+
+
+class RedisBackend(object):
+    """Index kept in a Redis server, shared by the workers of many hosts.
+
+    Under `{prefix}{name}`: a sorted set of the versions of each
+    fingerprint (`:v:{fingerprint}`, scored by timestamp), a sorted set of
+    the time of their most recent version (`:latest`), a hash of their
+    digests (`:digests`) and expiring keys for the misses
+    (`:miss:{fingerprint}`).
+
+    """
+
+    def __init__(self, url, prefix='history:'):
+        # imported for redis:// URLs only, rather than with the storage
+        try:
+            import redis
+        except ImportError:
+            raise NotConfigured('a redis:// HISTORY_SHARED_INDEX requires the redis package')
+        self.client = redis.StrictRedis.from_url(url)
+        self.prefix = prefix
+
+    def _key(self, name, *parts):
+        return ':'.join((self.prefix + name,) + parts)
+
+    def versions(self, name, fingerprint, now):
+        members = self.client.zrange(self._key(name, 'v', fingerprint), 0, -1)
+        if members:
+            return sorted(tuple(json.loads(member)) for member in members)
+        if self.client.exists(self._key(name, 'miss', fingerprint)):
+            return []
+        return None
+
+    def add_versions(self, name, entries):
+        pipeline = self.client.pipeline(transaction=False)
+        for fingerprint, timestamp, version_id in entries:
+            member = json.dumps([timestamp, version_id])
+            pipeline.zadd(self._key(name, 'v', fingerprint), {member: timestamp})
+            pipeline.zadd(self._key(name, 'latest'), {fingerprint: timestamp}, gt=True)
+            pipeline.delete(self._key(name, 'miss', fingerprint))
+        pipeline.execute()
+
+    def set_versions(self, name, versions):
+        pipeline = self.client.pipeline(transaction=False)
+        for fingerprint, fingerprint_versions in versions.items():
+            key = self._key(name, 'v', fingerprint)
+            pipeline.delete(key)
+            if fingerprint_versions:
+                pipeline.zadd(key, {json.dumps([timestamp, version_id]): timestamp
+                                    for timestamp, version_id in fingerprint_versions})
+                pipeline.zadd(self._key(name, 'latest'),
+                              {fingerprint: max(fingerprint_versions)[0]})
+                pipeline.delete(self._key(name, 'miss', fingerprint))
+            else:
+                pipeline.zrem(self._key(name, 'latest'), fingerprint)
+                pipeline.set(self._key(name, 'miss', fingerprint), 1)
+        pipeline.execute()
+
+    def add_missing(self, name, fingerprint, expires):
+        ttl = max(1, int(expires - time.time()))
+        self.client.set(self._key(name, 'miss', fingerprint), 1, ex=ttl)
+
+    def digest(self, name, fingerprint):
+        digest = self.client.hget(self._key(name, 'digests'), fingerprint)
+        return digest.decode('ascii') if digest is not None else None
+
+    def set_digests(self, name, digests, overwrite=True):
+        if not digests:
+            return
+        key = self._key(name, 'digests')
+        if overwrite:
+            self.client.hset(key, mapping=digests)
+            return
+        pipeline = self.client.pipeline(transaction=False)
+        for fingerprint, digest in digests.items():
+            pipeline.hsetnx(key, fingerprint, digest)
+        pipeline.execute()
+
+    def timestamps(self, name):
+        return {fingerprint.decode('ascii'): timestamp for fingerprint, timestamp in
+                self.client.zscan_iter(self._key(name, 'latest'))}
+
+    def is_seeded(self, name):
+        return bool(self.client.exists(self._key(name, 'seeded')))
+
+    def set_seeded(self, name):
+        self.client.set(self._key(name, 'seeded'), 1)
+
+    def close(self):
+        self.client.connection_pool.disconnect()
+
+
+def open_backend(url, prefix='history:'):
+    """Return the backend of a HISTORY_SHARED_INDEX URL; prefix is the one
+    of the Redis keys.
+
+    """
+    scheme = parse.urlsplit(url).scheme
+    if scheme == 'sqlite':
+        # sqlite:///relative/path or sqlite:////absolute/path
+        return SQLiteBackend(url[len('sqlite:///'):])
+    if scheme in ('redis', 'rediss'):
+        return RedisBackend(url, prefix)
+    raise NotConfigured('Unknown HISTORY_SHARED_INDEX: {}'.format(url))
+
+
+class SharedVersionIndex(VersionIndex):
+    """`VersionIndex` whose lookups go to a shared backend.
+
+    The versions and digests added are written to the backend and kept in
+    the shards of the index too, which then hold what this process stored:
+    those are merged into the S3 shards on close as usual.
+
+    """
+
+    def __init__(self, backend, name, shard_width=2, miss_ttl=3600):
+        super(SharedVersionIndex, self).__init__(shard_width)
+        self.backend = backend
+        self.name = name
+        self.miss_ttl = miss_ttl
+
+    def __contains__(self, fingerprint):
+        return self.get(fingerprint) is not None
+
+    def get(self, fingerprint):
+        return self.backend.versions(self.name, fingerprint, time.time())
+
+    def seed(self, version_index):
+        """Load the versions and digests of version_index into an empty
+        backend.
+
+        """
+        self.backend.add_versions(self.name, [
+            (fingerprint, timestamp, version_id)
+            for fingerprints in version_index.shards.values()
+            for fingerprint, versions in fingerprints.items()
+            for timestamp, version_id in versions
+        ])
+        for digests in version_index.digests.values():
+            # digests stored by running workers are the most recent ones
+            self.backend.set_digests(self.name, digests, overwrite=False)
+        self.backend.set_seeded(self.name)
+
+    def add(self, fingerprint, timestamp, version_id):
+        super(SharedVersionIndex, self).add(fingerprint, timestamp, version_id)
+        self.backend.add_versions(self.name, [(fingerprint, timestamp, version_id)])
+
+    def set_versions(self, fingerprint, versions):
+        super(SharedVersionIndex, self).set_versions(fingerprint, versions)
+        self.backend.set_versions(self.name, {fingerprint: versions})
+
+    def add_missing(self, fingerprint):
+        self.backend.add_missing(self.name, fingerprint, time.time() + self.miss_ttl)
+
+    def digest(self, fingerprint):
+        return self.backend.digest(self.name, fingerprint)
+
+    def set_digest(self, fingerprint, digest):
+        super(SharedVersionIndex, self).set_digest(fingerprint, digest)
+        self.backend.set_digests(self.name, {fingerprint: digest})
+
+    def timestamps(self):
+        return self.backend.timestamps(self.name)
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+import logging
+import os
+import time
+import uuid
+
+from twisted.internet import task
+
+from history.archive import INDEX_SUFFIX, ArchiveWriter, dump_index, scan_archive
+from history.storage import S3CacheStorage
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SPOOL_DIR = '.scrapy/history-spool'
+OPEN_SUFFIX = '.seg.open'
+SEGMENT_SUFFIX = '.seg'
+# next to an open segment, the job writing it
+JOB_SUFFIX = '.job'
+
+
+class S3SpoolStorage(S3CacheStorage):
+    """Spool records into local segment files and upload them in batches.
+
+    Stored records are appended to a local segment (a packed archive, see
+    `history.archive`). Once the segment reaches HISTORY_SPOOL_SEGMENT_SIZE
+    bytes or HISTORY_SPOOL_SEGMENT_AGE seconds, it is sealed and uploaded
+    under `{name}/segments/` along with its offset index, so a whole batch
+    of responses costs two PUTs.
+
+    Segments are uploaded by the writer pool (see `BoundedWriter`), with or
+    without HISTORY_ASYNC_STORE, so that sealing them never blocks the
+    reactor.
+
+    Records are flushed to the segment file as they are appended (and
+    synced to disk with HISTORY_SPOOL_FSYNC), so that segments left behind
+    by a crashed crawl hold every record stored. They are sealed and
+    uploaded, under the job which wrote them, when the spider opens again. The spool
+    directory must not be shared by concurrent crawls of the same spider.
+
+    Responses are retrieved with a ranged GET on the segment holding them,
+    like the segments of compacted history (see `S3CacheStorage`). No
+    `source/` copy is written: the segment index keeps track of the job
+    instead.
+
+    """
+
+    def __init__(self, stats, general_settings):
+        super(S3SpoolStorage, self).__init__(stats, general_settings)
+        self.spool_dir = general_settings.get('HISTORY_SPOOL_DIR', DEFAULT_SPOOL_DIR)
+        self.segment_size = general_settings.getint('HISTORY_SPOOL_SEGMENT_SIZE',
+                                                    64 * 1024 * 1024)
+        self.segment_age = general_settings.getfloat('HISTORY_SPOOL_SEGMENT_AGE', 300)
+        self.fsync = general_settings.getbool('HISTORY_SPOOL_FSYNC', False)
+        self.async_store = True
+        self.segment = None
+        self.sealer = None
+
+    def open_spider(self, spider):
+        super(S3SpoolStorage, self).open_spider(spider)
+        self.spider_spool_dir = os.path.join(self.spool_dir, spider.name)
+        if not os.path.isdir(self.spider_spool_dir):
+            os.makedirs(self.spider_spool_dir)
+
+        self._recover()
+
+        self.sealer = task.LoopingCall(self._seal_if_stale)
+        self.sealer.start(max(1, self.segment_age / 10), now=False)
+
+    def close_spider(self, spider):
+        if self.sealer is not None and self.sealer.running:
+            self.sealer.stop()
+        if self.segment is not None:
+            self._seal()
+
+        return super(S3SpoolStorage, self).close_spider(spider)
+
+    def store_response(self, spider, request, response):
+        """Append the response to the current segment.
+
+        Return what sealing the segment returned, if it had to be sealed:
+        see `S3CacheStorage.store_response`.
+
+        """
+        logger.debug('spooling response for {}.'.format(request.url))
+        data_string, _ = self.codec.encode(request, response)
+
+        if self.segment is None:
+            self.segment = self._open_segment()
+        fingerprint = self.request_fingerprint(request)
+        self.segment.append(fingerprint, time.time(), data_string)
+        if self.bloom_filter is not None:
+            self.bloom_filter.add(fingerprint)
+        self.metrics.inc_value('history/spool/records')
+
+        if self.segment.size >= self.segment_size:
+            return self._seal()
+
+    def _segment_path(self, segment_id, suffix):
+        return os.path.join(self.spider_spool_dir, segment_id + suffix)
+
+    def _open_segment(self):
+        segment_id = '{}-{}'.format(int(time.time()), uuid.uuid4().hex[:8])
+        with open(self._segment_path(segment_id, JOB_SUFFIX), 'w') as f:
+            f.write(self.save_source)
+        return ArchiveWriter(self._segment_path(segment_id, OPEN_SUFFIX),
+                             flush=True, fsync=self.fsync)
+
+    def _seal_if_stale(self):
+        if self.segment is not None and time.time() - self.segment.created >= self.segment_age:
+            self._seal()
+
+    def _seal(self):
+        segment, self.segment = self.segment, None
+        entries = segment.close()
+        return self._submit(self._seal_file(segment.path, entries))
+
+    def _seal_file(self, path, entries):
+        """Write the index of an open segment and mark it as sealed."""
+        segment_id = os.path.basename(path)[:-len(OPEN_SUFFIX)]
+        job_path = self._segment_path(segment_id, JOB_SUFFIX)
+        metadata = {}
+        if os.path.exists(job_path):
+            with open(job_path) as f:
+                metadata['job'] = f.read()
+        else:
+            logger.info('job of segment {} is unknown'.format(segment_id))
+        with open(self._segment_path(segment_id, INDEX_SUFFIX), 'wb') as f:
+            f.write(dump_index(entries, **metadata))
+        sealed_path = self._segment_path(segment_id, SEGMENT_SUFFIX)
+        os.rename(path, sealed_path)
+        if os.path.exists(job_path):
+            os.remove(job_path)
+        return sealed_path
+
+    def _submit(self, path):
+        # the keys already uploaded, kept across the retries of the upload
+        return self.writer.submit(self._write, self._upload_segment, path, set())
+
+    def _upload_segment(self, path, uploaded):
+        segment_id = os.path.basename(path)[:-len(SEGMENT_SUFFIX)]
+        index_path = self._segment_path(segment_id, INDEX_SUFFIX)
+
+        # the index goes last: a segment is only visible once it is indexed
+        for local_path, key_name in ((path, segment_id), (index_path, segment_id + INDEX_SUFFIX)):
+            if key_name in uploaded:
+                continue
+            s3_key = self.s3_bucket.new_key(self.segment_prefix + key_name)
+            try:
+                s3_key.set_contents_from_filename(local_path)
+            finally:
+                s3_key.close()
+            uploaded.add(key_name)
+
+        self.metrics.inc_value('history/spool/segments')
+        self.metrics.inc_value('history/spool/bytes', os.path.getsize(path))
+        logger.debug('uploaded segment {}'.format(segment_id))
+        os.remove(path)
+        os.remove(index_path)
+
+    def _recover(self):
+        """Seal and upload the segments a previous crawl left behind."""
+        for name in sorted(os.listdir(self.spider_spool_dir)):
+            path = os.path.join(self.spider_spool_dir, name)
+            if name.endswith(OPEN_SUFFIX):
+                logger.info('recovering unsealed segment {}'.format(name))
+                self._submit(self._seal_file(path, scan_archive(path)))
+            elif name.endswith(SEGMENT_SUFFIX):
+                logger.info('recovering segment {}'.format(name))
+                self._submit(path)
+            elif name.endswith(JOB_SUFFIX) and not os.path.exists(
+                    path[:-len(JOB_SUFFIX)] + OPEN_SUFFIX):
+                # the crawl stopped before opening the segment
+                os.remove(path)
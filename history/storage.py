@@ -1,18 +1,39 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import absolute_import, unicode_literals
-import base64
 from datetime import datetime
+import io
 import json
 import logging
+from multiprocessing.pool import ThreadPool
 import os
+import string
+import threading
+import time
 
-import boto
 from six.moves.urllib import parse
 from scrapy.exceptions import NotConfigured
-from scrapy.http import TextResponse, Headers
-from scrapy.responsetypes import responsetypes
-from scrapy.utils.request import request_fingerprint
+from scrapy.utils.misc import load_object
+from twisted.internet import defer, threads
+from twisted.python.threadpool import ThreadPool as TwistedThreadPool
+
+from history.archive import INDEX_SUFFIX, ArchiveIndex, load_index
+from history.bloom import BloomFilter
+from history.fingerprint import FingerprintCache
+from history.index import VersionIndex, _select_version, _to_timestamp
+from history.lru import LRUCache
+from history.metrics import Metrics
+from history.record import (
+    RecordCodec,
+    body_digest,
+    decode_record,
+    read_record_lazy,
+    read_record_stream,
+    record_metadata,
+)
+from history.shared import SharedVersionIndex, open_backend
+from history.throttle import AdaptiveLimiter
+from history.writer import BoundedWriter
 
 MANDATORY_SETTINGS = [
     'HISTORY_S3_BUCKET',
@@ -25,66 +46,36 @@ MANDATORY_SETTINGS = [
 # in order to replay history.
 DEFAULT_S3_SOURCE_TEMPLATE = '{name}/{time}_{jobid}'
 
+DEFAULT_FS_DIR = '.scrapy/history'
+S3_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+# written in the job folder, lists the versions stored by the job
+MANIFEST_NAME = 'manifest.json'
+RECORD_SUFFIX = '.rec'
+# next to each filesystem record, the digest of its body
+DIGEST_SUFFIX = '.digest'
+
 logger = logging.getLogger('{}:'.format(__name__))
 
 
-def _try_decoding_response_body(response_body, encoding):
-    # Try to guess encoding
-    try:
-        return encoding, response_body.decode(encoding)
-    except Exception:
-        pass
-
-    try:
-        encoding = 'utf-8'
-        return encoding, response_body.decode(encoding)
-    except Exception:
-        pass
-
-    try:
-        encoding = 'latin-1'
-        return encoding, response_body.decode(encoding)
-    except Exception:
-        pass
-
-    try:
-        encoding = 'ISO-8859-1'
-        return encoding, response_body.decode(encoding)
-    except Exception:
-        pass
-
-    try:
-        encoding = 'utf-8'
-        return 'utf-8/ignore', response_body.decode(encoding, 'ignore')
-    except Exception:
-        pass
-
-    # If all failed, raise original exception
-    return encoding, response_body.decode(encoding)
-
-
-def _coerce_unicode_encoding(text):
-    if isinstance(text, bytes):
-        return text.decode('utf-8')
-    return text
-
-
-def _reformat_response(response):
-    binary = response_body = None
-    if isinstance(response, TextResponse):
-        # Textual response (HTMl, XML, csv, etc.),
-        # decoded to unicode using encoding (from Content-Type)
-        binary = False
-        encoding, response_body = _try_decoding_response_body(response.body, response.encoding)
-        logger.debug('encoded to unicode from text response format: {}'.format(encoding))
-    else:
-        # Binary response (excel, pdf, etc.)
-        binary = True
-        # encode it to be able to store it on S3 as a string
-        response_body = base64.b64encode(response.body)
-        logger.debug('encoded binary response to base64')
-
-    return response_body, binary
+def _write_file(path, chunks):
+    """Write an iterable of chunks to path atomically, creating its
+    directory if needed.
+
+    """
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # created concurrently
+            if not os.path.isdir(dirname):
+                raise
+
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+    os.rename(tmp_path, path)
 
 
 def _truncate_metadata_fields(metadata, max_length=400):
@@ -98,53 +89,589 @@ def _truncate_metadata_fields(metadata, max_length=400):
     return truncated_fields
 
 
+def cache_key(name, fingerprint, shard_width=0):
+    """Name of the S3 key holding the responses of a request: either
+    `{name}/cache/{fingerprint}` or, with shard_width,
+    `{name}/cache/{fingerprint[:shard_width]}/{fingerprint}`.
+
+    """
+    if shard_width:
+        return '{}/cache/{}/{}'.format(name, fingerprint[:shard_width], fingerprint)
+    return '{}/cache/{}'.format(name, fingerprint)
+
+
+def _parse_ts(ts):
+    # boto is only imported once S3 is used
+    from boto.utils import parse_ts
+    return parse_ts(ts)
+
+
+def _key_timestamp(s3_key):
+    return _to_timestamp(_parse_ts(s3_key.last_modified))
+
+
+def _template_fields(template):
+    """Names of the arguments a `str.format` template refers to."""
+    return set(field.split('.', 1)[0].split('[', 1)[0]
+               for _, field, _, _ in string.Formatter().parse(template) if field)
+
+
 def _truncate_url(url, max_length=900):
     return (url[:max_length] + '...' if len(url) > max_length else url)
 
 
-class S3CacheStorage(object):
+class CacheStorageBase(object):
+    """Behaviour shared by the storage backends: settings common to all of
+    them, request keys, job folder and asynchronous store.
+
+    Subclasses implement `retrieve_response` and `_store_response`.
+
+    The middleware calls the Deferred returning `retrieve_response_async`
+    and `store_response_async` variants instead, when a backend has them.
+    With HISTORY_ASYNC_RETRIEVE, retrievals run on a pool of reader threads
+    so that lookups don't block the reactor and as many of them as there
+    are concurrent requests run at once.
+
+    """
 
     def __init__(self, stats, general_settings):
+        self.save_source_template = general_settings.get('HISTORY_SAVE_SOURCE',
+                                                         DEFAULT_S3_SOURCE_TEMPLATE)
+        self.codec = RecordCodec(general_settings)
+        fingerprinter = load_object(general_settings.get(
+            'HISTORY_FINGERPRINTER', 'history.fingerprint.RequestFingerprinter'))
+        self.fingerprint = FingerprintCache(fingerprinter(general_settings))
+        # Asynchronous store: uploads run on a bounded thread pool instead of
+        # blocking the reactor.
+        self.async_store = general_settings.getbool('HISTORY_ASYNC_STORE', False)
+        self.store_threads = general_settings.getint('HISTORY_STORE_THREADS', 4)
+        self.store_queue_size = general_settings.getint('HISTORY_STORE_QUEUE_SIZE', 100)
+        # Adapt the concurrency and rate of the uploads to the latency and
+        # throttling of the storage, and retry failed uploads.
+        self.store_adaptive = general_settings.getbool('HISTORY_STORE_ADAPTIVE', True)
+        self.store_target_latency = general_settings.getfloat('HISTORY_STORE_TARGET_LATENCY', 5.0)
+        self.store_max_rate = general_settings.getfloat('HISTORY_STORE_MAX_RATE', 0)
+        self.store_retries = general_settings.getint('HISTORY_STORE_RETRIES', 3)
+        self.writer = None
+        self.async_retrieve = general_settings.getbool('HISTORY_ASYNC_RETRIEVE', False)
+        self.retrieve_threads = general_settings.getint(
+            'HISTORY_RETRIEVE_THREADS', general_settings.getint('CONCURRENT_REQUESTS', 16))
+        self.readers = None
+        self.reads_in_flight = 0
+        # Return responses whose body is read and decompressed on first
+        # access only.
+        self.lazy_body = general_settings.getbool('HISTORY_LAZY_BODY', False)
+        self.stats = stats
+        self.metrics = Metrics(stats, general_settings)
+
+    def open_spider(self, spider):
+        # Use spider fields to replace var in key name.
+        self.save_source = self.save_source_template.format(**self._get_uri_params(spider))
+        if self.async_store:
+            # stats updated through the metrics, see `history.metrics`
+            limiter = None
+            if self.store_adaptive:
+                limiter = AdaptiveLimiter(self.metrics, self.store_threads,
+                                          target_latency=self.store_target_latency,
+                                          max_rate=self.store_max_rate)
+            self.writer = BoundedWriter(self.metrics,
+                                        max_threads=self.store_threads,
+                                        queue_size=self.store_queue_size,
+                                        limiter=limiter,
+                                        retries=self.store_retries)
+            self.writer.start()
+        if self.async_retrieve:
+            self.readers = TwistedThreadPool(minthreads=0,
+                                             maxthreads=max(1, self.retrieve_threads),
+                                             name='history-reader')
+            self.readers.start()
+
+    def close_spider(self, spider):
+        """Return a Deferred firing once queued writes are done, if any."""
+        if self.readers is not None:
+            self.readers.stop()
+            self.readers = None
+        if self.writer is not None:
+            return self.writer.drain()
+
+    def retrieve_response(self, spider, request):
+        raise NotImplementedError("Please implement in your subclass.")
+
+    def retrieve_response_async(self, spider, request):
+        """Return a Deferred firing with the response if present in cache, or
+        None otherwise.
+
+        """
+        return self._defer_read(self.retrieve_response, spider, request)
+
+    def store_response_async(self, spider, request, response):
+        """Return a Deferred firing once the response has been stored, or
+        handed to the writer pool with HISTORY_ASYNC_STORE.
+
+        """
+        return defer.maybeDeferred(self.store_response, spider, request, response)
+
+    def _defer_read(self, func, *args, **kwargs):
+        """Run a blocking read on the reader pool if there is one, or right
+        away otherwise, and return a Deferred of its result.
+
+        """
+        if self.readers is None:
+            return defer.maybeDeferred(func, *args, **kwargs)
+
+        from twisted.internet import reactor
+        self.reads_in_flight += 1
+        self.metrics.observe('history/retrieve/queue_depth', self.reads_in_flight)
+        d = threads.deferToThreadPool(reactor, self.readers, func, *args, **kwargs)
+        d.addBoth(self._read_done)
+        return d
+
+    def _read_done(self, result):
+        self.reads_in_flight -= 1
+        return result
+
+    def store_response(self, spider, request, response):
+        """Store the given response in the cache.
+
+        With HISTORY_ASYNC_STORE the upload is handed to the writer pool and
+        this returns right away; a Deferred is returned instead of None when
+        the writer queue is full, firing once the upload has been queued.
+
+        """
+        if self.writer is None:
+            return self._measure_store(spider, request, response)
+
+        # the steps of the write already done, kept across its retries
+        queued = self.writer.submit(self._measure_store, spider, request, response, {})
+        self.metrics.observe('history/store/queue_depth', self.writer.depth, spider=spider)
+        return queued
+
+    def _measure_store(self, spider, request, response, done=None):
+        with self.metrics.timer('history/store/latency', spider=spider):
+            self._store_response(spider, request, response, {} if done is None else done)
+        self.metrics.observe('history/store/bytes', len(response.body), spider=spider)
+
+    def _store_response(self, spider, request, response, done):
+        """Store the response. done holds the steps of the write that
+        succeeded in a previous attempt, which a retry must not repeat.
+
+        """
+        raise NotImplementedError("Please implement in your subclass.")
+
+    def request_fingerprint(self, request):
+        """Return the fingerprint naming the key of the responses of
+        request."""
+        return self.fingerprint(request)
+
+    def _get_request_storage_key(self, spider, request):
+        return cache_key(spider.name, self.request_fingerprint(request))
+
+    def _get_source_name(self, request):
+        # if the S3 key is too long, the AWS interface does not allow to download the file !
+        source_url = _truncate_url(request.url)
+        return "{}/source/{}".format(self.save_source, parse.quote_plus(source_url))
+
+    # from https://github.com/scrapy/scrapy/blob/342cb622f1ea93268477da557099010bbd72529a/scrapy/extensions/feedexport.py  # noqa
+    def _get_uri_params(self, spider):
+        # only the spider attributes the template refers to
+        fields = _template_fields(self.save_source_template)
+        params = {}
+        for k in fields:
+            if hasattr(spider, k):
+                params[k] = getattr(spider, k)
+        if 'time' in fields:
+            ts = self.stats.get_value('start_time').replace(microsecond=0).isoformat()
+            params['time'] = ts.replace(':', '-')
+        if 'jobid' in fields and not params.get('jobid', None):
+            jobid = os.getenv('SHUB_JOBKEY') or ''
+            params['jobid'] = jobid.replace('/', '_')
+        return params
+
+
+class S3CacheStorage(CacheStorageBase):
+
+    def __init__(self, stats, general_settings):
+        super(S3CacheStorage, self).__init__(stats, general_settings)
+        # boto is imported along with the first S3 backend, rather than
+        # with this module
+        from history import s3
         # Mandatory settings
         self.S3_ACCESS_KEY = general_settings.get('AWS_ACCESS_KEY_ID')
         self.S3_SECRET_KEY = general_settings.get('AWS_SECRET_ACCESS_KEY')
         self.S3_CACHE_BUCKET = general_settings.get('HISTORY_S3_BUCKET', None)
-        configured = all([general_settings.get(k, False) for k in MANDATORY_SETTINGS])
-        if not configured:
-            raise NotConfigured('{} are mandatoy settings, set them either from the settings file '
-                                'or from the Scrapinghub spider settings '
-                                'section.'.format(','.join(MANDATORY_SETTINGS)))
+        self.configured = all([general_settings.get(k, False) for k in MANDATORY_SETTINGS])
+        self._check_configured()
 
         # Optional settings
         # boto s3_connection does not work through proxy.
         # comment this line from the original file
         # self.use_proxy = settings.get('HISTORY_USE_PROXY', False)
-        self.save_source_template = general_settings.get('HISTORY_SAVE_SOURCE',
-                                                         DEFAULT_S3_SOURCE_TEMPLATE)
-        self.stats = stats
+        # e.g. http://localhost:9000 to use a local S3 stand-in (MinIO, moto)
+        self.s3_endpoint = general_settings.get('HISTORY_S3_ENDPOINT')
+        self.s3_max_connections = general_settings.getint('HISTORY_S3_MAX_CONNECTIONS',
+                                                          s3.DEFAULT_MAX_CONNECTIONS)
+        self.s3_retries = general_settings.getint('HISTORY_S3_RETRIES', s3.DEFAULT_RETRIES)
+        # Maintain a fingerprint => versions index instead of listing the
+        # versions of a key on every retrieval.
+        self.use_version_index = general_settings.getbool('HISTORY_VERSION_INDEX', False)
+        self.version_index_shard_width = general_settings.getint(
+            'HISTORY_VERSION_INDEX_SHARD_WIDTH', 2)
+        # Share the index and the misses between the crawl processes.
+        self.shared_index_url = general_settings.get('HISTORY_SHARED_INDEX')
+        self.shared_index_prefix = general_settings.get('HISTORY_SHARED_INDEX_PREFIX',
+                                                        'history:')
+        self.shared_index_miss_ttl = general_settings.getfloat('HISTORY_SHARED_INDEX_MISS_TTL',
+                                                               3600)
+        self.shared_index_backend = None
+        if self.shared_index_url:
+            self.use_version_index = True
+        # Spread cache and source keys over `{fingerprint[:width]}/`
+        # prefixes, which S3 scales independently, and keep reading the keys
+        # stored before.
+        self.key_shard_width = general_settings.getint('HISTORY_S3_KEY_SHARD_WIDTH', 0)
+        self.read_unsharded_keys = general_settings.getbool('HISTORY_S3_READ_UNSHARDED_KEYS',
+                                                            True)
+        self.version_index = None
+        # Download the responses of a replay crawl ahead of its requests.
+        self.prefetch_enabled = general_settings.getbool('HISTORY_PREFETCH', False)
+        self.prefetch_threads = general_settings.getint('HISTORY_PREFETCH_THREADS', 8)
+        self.prefetch_cache_size = general_settings.getint('HISTORY_PREFETCH_CACHE_SIZE',
+                                                           256 * 1024 * 1024)
+        self.prefetched = None
+        self.prefetched_size = 0
+        self.prefetch_lock = threading.Lock()
+        self.prefetcher = None
+        # Records of responses bigger than this are uploaded as they are
+        # encoded, with a multipart upload (parts must be 5 MB at least).
+        self.streaming_threshold = general_settings.getint('HISTORY_STREAMING_THRESHOLD',
+                                                           16 * 1024 * 1024)
+        self.streaming_part_size = max(5 * 1024 * 1024, general_settings.getint(
+            'HISTORY_STREAMING_PART_SIZE', 8 * 1024 * 1024))
+        # Store each distinct body once, under its digest, and reference it
+        # from the cache records and the source copies.
+        self.content_addressed = general_settings.getbool('HISTORY_CONTENT_ADDRESSED', False)
+        if self.content_addressed and self.codec.format != 'binary':
+            raise NotConfigured('HISTORY_CONTENT_ADDRESSED requires binary records')
+        self.blob_prefix = general_settings.get('HISTORY_BLOB_PREFIX', 'blobs')
+        self.known_blobs = set()
+        # key => body digest of its most recent version, when there is no
+        # version index to keep them
+        self.digests = {}
+        self.prefetch_stopped = False
+        # fingerprint, version id and store time of the versions stored by
+        # the job, saved in its folder for `history.replay`
+        self.write_manifest = general_settings.getbool('HISTORY_JOB_MANIFEST', True)
+        self.manifest = []
+        # Look responses up in the segments under `{name}/segments/` too,
+        # written by S3SpoolStorage or the compaction tool.
+        self.read_segments = general_settings.getbool('HISTORY_READ_SEGMENTS', True)
+        self.segments = None
+        # Skip the lookups of requests never stored, saved at `{name}/bloom`
+        # and updated on store.
+        self.use_bloom_filter = general_settings.getbool('HISTORY_BLOOM_FILTER', False)
+        self.bloom_capacity = general_settings.getint('HISTORY_BLOOM_CAPACITY', 1000000)
+        self.bloom_error_rate = general_settings.getfloat('HISTORY_BLOOM_ERROR_RATE', 0.01)
+        self.bloom_rebuild = general_settings.getbool('HISTORY_BLOOM_REBUILD', False)
+        self.bloom_filter = None
+        # With HISTORY_LAZY_BODY, bytes read from a record with its metadata,
+        # the rest of the body is read by another ranged GET when accessed.
+        self.lazy_head_size = general_settings.getint('HISTORY_LAZY_HEAD_SIZE', 64 * 1024)
+
+    def _check_configured(self):
+        if not self.configured:
+            raise NotConfigured('{} are mandatoy settings, set them either from the settings file '
+                                'or from the Scrapinghub spider settings '
+                                'section.'.format(','.join(MANDATORY_SETTINGS)))
 
     def open_spider(self, spider):
-        self.s3_connection = boto.connect_s3(self.S3_ACCESS_KEY,
-                                             self.S3_SECRET_KEY,
-                                             # Fails with understandable Traceback
-                                             # if is_secure is set to True.
-                                             # Else it will fail on S3Connection.get_bucket()
-                                             # with a super vague message Trace:
-                                             # TypeError: int() argument must be a string
-                                             #   or a number, not 'NoneType'
-                                             is_secure=True)
-        # S3Connection does not work when using proxy. S3Connection.use_proxy must be set to False.
-        self.s3_connection.use_proxy = False
-        # Use spider fields to replace var in key name.
-        self.save_source = self.save_source_template.format(**self._get_uri_params(spider))
+        self._connect()
+        super(S3CacheStorage, self).open_spider(spider)
+        self.segment_prefix = '{name}/segments/'.format(name=spider.name)
+        if self.use_version_index:
+            # version ids are those of the keys of a layout, which has its
+            # own index
+            self.version_index_prefix = '{name}/index/'.format(name=spider.name)
+            if self.key_shard_width:
+                self.version_index_prefix = '{name}/index-{width}/'.format(
+                    name=spider.name, width=self.key_shard_width)
+            if self.shared_index_url:
+                self.version_index = self._load_shared_index()
+            else:
+                self.version_index = self._load_version_index()
+        if self.use_bloom_filter:
+            self.bloom_filter_name = '{name}/bloom'.format(name=spider.name)
+            self.bloom_filter = self._load_bloom_filter(spider)
+
+    def _get_request_storage_key(self, spider, request):
+        return cache_key(spider.name, self.request_fingerprint(request), self.key_shard_width)
+
+    def _get_source_name(self, request):
+        source_name = super(S3CacheStorage, self)._get_source_name(request)
+        if not self.key_shard_width:
+            return source_name
+        prefix, name = source_name.rsplit('/', 1)
+        return '{}/{}/{}'.format(prefix, self.request_fingerprint(request)[:self.key_shard_width],
+                                 name)
+
+    def _connect(self):
+        from history import s3
+
+        self.s3_connection = s3.connect(self.S3_ACCESS_KEY, self.S3_SECRET_KEY,
+                                        endpoint=self.s3_endpoint,
+                                        max_connections=self.s3_max_connections,
+                                        retries=self.s3_retries)
+        self.s3_connection.metrics = self.metrics
         # The bucket keeps the name given
         self.s3_bucket = self.s3_connection.get_bucket(self.S3_CACHE_BUCKET)
         # self.versioning = self.s3_bucket.get_versioning_status()
         # => {} or {'Versioning': 'Enabled'}
 
     def close_spider(self, spider):
+        self.prefetch_stopped = True
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher = None
+        d = super(S3CacheStorage, self).close_spider(spider)
+        if d is None:
+            self._close()
+            return
+
+        # wait for queued uploads before closing the connection so that no
+        # write is lost
+        d.addBoth(lambda _: self._close())
+        return d
+
+    def _close(self):
+        if self.version_index is not None:
+            self._save_version_index()
+        if self.bloom_filter is not None and self.bloom_filter.dirty:
+            self._save_bloom_filter()
+        if self.manifest:
+            self._save_manifest()
+        if self.shared_index_backend is not None:
+            self.shared_index_backend.close()
         self.s3_connection.close()
 
+    def _load_bloom_filter(self, spider):
+        """Load the saved Bloom filter of the spider, or build it from the
+        stored keys and segments when there is none, when it is fuller than
+        its capacity, or with HISTORY_BLOOM_REBUILD.
+
+        """
+        s3_key = None if self.bloom_rebuild else self.s3_bucket.get_key(self.bloom_filter_name)
+        if s3_key is not None:
+            bloom_filter = BloomFilter.loads(s3_key.get_contents_as_string())
+            if bloom_filter.saturated:
+                # no telling how many it holds, it is sized after the listing
+                logger.info('rebuilding saturated Bloom filter')
+            else:
+                count = bloom_filter.estimated_count()
+                if count <= self.bloom_capacity:
+                    logger.debug('loaded Bloom filter of about {} fingerprints'.format(count))
+                    return bloom_filter
+                self.bloom_capacity = count * 2
+
+        fingerprints = self._list_stored_fingerprints(spider)
+        bloom_filter = BloomFilter.for_capacity(max(self.bloom_capacity, len(fingerprints) * 2),
+                                                self.bloom_error_rate)
+        for fingerprint in fingerprints:
+            bloom_filter.add(fingerprint)
+        self.metrics.set_value('history/bloom/built', len(fingerprints))
+        logger.info('built Bloom filter of {} fingerprints'.format(len(fingerprints)))
+        return bloom_filter
+
+    def _list_stored_fingerprints(self, spider):
+        """Fingerprints of the cache keys and segments of the spider. Keys
+        are listed in parallel, by fingerprint prefix.
+
+        """
+        prefix = '{name}/cache/'.format(name=spider.name)
+
+        def list_prefix(digit):
+            return [s3_key.name.rsplit('/', 1)[1]
+                    for s3_key in self.s3_bucket.list(prefix=prefix + digit)]
+
+        pool = ThreadPool(self.prefetch_threads)
+        try:
+            listings = pool.map(list_prefix, '0123456789abcdef', chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        fingerprints = set()
+        for listing in listings:
+            fingerprints.update(listing)
+        if self.read_segments:
+            if self.segments is None:
+                self.segments = self._load_segments()
+            fingerprints.update(self.segments.versions)
+        return fingerprints
+
+    def _save_bloom_filter(self):
+        """Upload the Bloom filter, merged with its current remote copy so
+        that concurrent crawls don't drop each other's fingerprints.
+
+        """
+        s3_key = self.s3_bucket.new_key(self.bloom_filter_name)
+        try:
+            remote = self.s3_bucket.get_key(self.bloom_filter_name)
+            if remote is not None:
+                try:
+                    self.bloom_filter.update(BloomFilter.loads(remote.get_contents_as_string()))
+                except ValueError:
+                    # rebuilt with other parameters, ours covers every key
+                    pass
+            s3_key.set_contents_from_string(self.bloom_filter.dumps())
+        finally:
+            s3_key.close()
+
+    def _save_manifest(self):
+        s3_key = self.s3_bucket.new_key('{}/{}'.format(self.save_source, MANIFEST_NAME))
+        try:
+            s3_key.set_contents_from_string(json.dumps({
+                'versions': self.manifest,
+                'key_shard_width': self.key_shard_width,
+            }))
+        finally:
+            s3_key.close()
+        logger.debug('saved manifest of {} versions'.format(len(self.manifest)))
+
+    def prefetch(self, spider, epoch):
+        """Download, in the background, the version matching epoch of every
+        response stored for the spider, in cache keys or segments, so that
+        replayed requests don't wait on S3.
+
+        Downloads run on a pool of HISTORY_PREFETCH_THREADS threads of the
+        backend, stopped when the spider closes. Responses are kept in
+        memory until HISTORY_PREFETCH_CACHE_SIZE bytes have been
+        downloaded; requests not prefetched yet are retrieved as usual.
+
+        """
+        if not self.prefetch_enabled:
+            return
+
+        self.prefetched = LRUCache(self.prefetch_cache_size)
+        self.prefetcher = TwistedThreadPool(minthreads=0,
+                                            maxthreads=max(1, self.prefetch_threads),
+                                            name='history-prefetch')
+        self.prefetcher.start()
+        self.prefetcher.callInThread(self._prefetch, spider, epoch)
+
+    def _prefetch(self, spider, epoch):
+        """List the stored versions and queue the download of those
+        matching epoch.
+
+        """
+        try:
+            # the versions of a request may be spread over its keys of both
+            # layouts and the segments: (timestamp, key, version id, range)
+            stored = {}
+            for key, versions in self._list_stored_versions(spider).items():
+                stored.setdefault(key.rsplit('/', 1)[1], []).extend(
+                    (timestamp, key, version_id, None) for timestamp, version_id in versions)
+            if self.read_segments:
+                if self.segments is None:
+                    self.segments = self._load_segments()
+                for fingerprint, versions in self.segments.versions.items():
+                    stored.setdefault(fingerprint, []).extend(
+                        (timestamp, self.segment_prefix + segment, None, (offset, length))
+                        for timestamp, segment, offset, length in versions)
+        except Exception as e:
+            logger.info('prefetch failed: {}'.format(e))
+            return
+
+        logger.debug('prefetching {} responses'.format(len(stored)))
+        for fingerprint, versions in stored.items():
+            self.prefetcher.callInThread(self._prefetch_version, fingerprint,
+                                         _select_version(sorted(versions), epoch)[1:])
+
+    def _prefetch_version(self, fingerprint, version):
+        with self.prefetch_lock:
+            if self.prefetch_stopped or self.prefetched_size >= self.prefetch_cache_size:
+                return
+
+        name, version_id, record_range = version
+        try:
+            if record_range is not None:
+                offset, length = record_range
+                data_string = self._read_range(name, None, offset, offset + length - 1)
+            else:
+                s3_key = self.s3_bucket.new_key(name)
+                s3_key.version_id = version_id
+                try:
+                    data_string = s3_key.get_contents_as_string()
+                finally:
+                    s3_key.close()
+        except Exception as e:
+            logger.debug('could not prefetch {}: {}'.format(name, e))
+            self.metrics.inc_value('history/prefetch/failed')
+            return
+
+        with self.prefetch_lock:
+            self.prefetched_size += len(data_string)
+        self.prefetched.set(fingerprint, data_string, len(data_string))
+        self.metrics.inc_value('history/prefetch/fetched')
+
+    def _list_stored_versions(self, spider):
+        """Return the versions of every key stored for the spider, sorted
+        from the oldest to the most recent.
+
+        """
+        prefix = '{name}/cache/'.format(name=spider.name)
+        stored_versions = {}
+        for s3_key in self.s3_bucket.list_versions(prefix=prefix):
+            stored_versions.setdefault(s3_key.name, []).append(
+                (_to_timestamp(_parse_ts(s3_key.last_modified)),
+                 s3_key.version_id or 'null'))
+        for versions in stored_versions.values():
+            versions.sort()
+        return stored_versions
+
+    def _load_version_index(self):
+        version_index = VersionIndex(self.version_index_shard_width)
+        for s3_key in self.s3_bucket.list(prefix=self.version_index_prefix):
+            shard = s3_key.name[len(self.version_index_prefix):-len('.json')]
+            version_index.load_shard(shard, s3_key.get_contents_as_string())
+
+        logger.debug('loaded version index of {} keys'.format(len(version_index)))
+        return version_index
+
+    def _load_shared_index(self):
+        """Open the shared index, loading the S3 index into it if it is
+        empty (the first worker to open does).
+
+        """
+        self.shared_index_backend = open_backend(self.shared_index_url, self.shared_index_prefix)
+        name = self.version_index_prefix.rstrip('/')
+        shared_index = SharedVersionIndex(self.shared_index_backend, name,
+                                          self.version_index_shard_width,
+                                          self.shared_index_miss_ttl)
+        if not self.shared_index_backend.is_seeded(name):
+            shared_index.seed(self._load_version_index())
+            logger.info('loaded version index into {}'.format(self.shared_index_url))
+        return shared_index
+
+    def _save_version_index(self):
+        """Upload the shards of the version index modified during the crawl.
+
+        Shards are merged with their current remote copy first, so that
+        concurrent crawls of the same spider don't drop each other's
+        versions (short of writing the same shard at the same time).
+
+        """
+        for shard in sorted(self.version_index.dirty):
+            s3_key = self.s3_bucket.new_key('{}{}.json'.format(self.version_index_prefix, shard))
+            try:
+                remote = self.s3_bucket.get_key(s3_key.name)
+                if remote is not None:
+                    self.version_index.load_shard(shard, remote.get_contents_as_string())
+                s3_key.set_contents_from_string(self.version_index.dump_shard(shard))
+            finally:
+                s3_key.close()
+
+        logger.debug('saved {} version index shards'.format(len(self.version_index.dirty)))
+        self.version_index.dirty.clear()
+
     def _get_s3_key(self, key, epoch):
         """
         Return key with timestamp >= epoch.
@@ -163,7 +690,14 @@ class S3CacheStorage(object):
                null        2012-04-14T11:47:16.000Z *
 
                * versioning was not enabled at this point
+
+        With HISTORY_VERSION_INDEX, versions come from the index instead.
         """
+        if self.version_index is not None:
+            return self._get_indexed_s3_key(key, epoch)
+        return self._get_listed_s3_key(key, epoch)
+
+    def _get_listed_s3_key(self, key, epoch):
         # list_versions returns an iterator interface; build an actual
         # iterator
         s3_keys = iter(self.s3_bucket.list_versions(prefix=key))
@@ -181,7 +715,7 @@ class S3CacheStorage(object):
         # iterating backward through time
         last_key = first_key
         for s3_key in s3_keys:
-            if boto.utils.parse_ts(s3_key.last_modified) < epoch:
+            if _parse_ts(s3_key.last_modified) < epoch:
                 return last_key
             else:
                 last_key = s3_key
@@ -190,9 +724,44 @@ class S3CacheStorage(object):
         # to epoch
         return last_key
 
-    def _get_request_storage_key(self, spider, request):
-        key = request_fingerprint(request)
-        return '{name}/cache/{key}'.format(name=spider.name, key=key)
+    def _get_indexed_s3_key(self, key, epoch):
+        fingerprint = key.rsplit('/', 1)[1]
+        if fingerprint in self.version_index:
+            self.metrics.inc_value('history/index/hit')
+        else:
+            self.metrics.inc_value('history/index/miss')
+            self._backfill_version_index(key, fingerprint)
+            if fingerprint not in self.version_index:
+                self.version_index.add_missing(fingerprint)
+
+        version = self.version_index.lookup(fingerprint, epoch)
+        if version is None:
+            return None
+
+        s3_key = self.s3_bucket.new_key(key)
+        s3_key.version_id = version[1]
+        s3_key.last_modified = datetime.utcfromtimestamp(version[0]).strftime(S3_TIME_FORMAT)
+        return s3_key
+
+    def _backfill_version_index(self, key, fingerprint):
+        """Add the versions of a key stored before it was indexed.
+
+        Listed once per fingerprint, the first time the index sees it.
+        """
+        for s3_key in self.s3_bucket.list_versions(prefix=key):
+            if s3_key.name == key:
+                self.version_index.add(fingerprint,
+                                       _to_timestamp(_parse_ts(s3_key.last_modified)),
+                                       s3_key.version_id or 'null')
+
+    def _index_stored_version(self, key, version_id):
+        fingerprint = key.rsplit('/', 1)[1]
+        if fingerprint not in self.version_index:
+            # also picks up the version just stored
+            self._backfill_version_index(key, fingerprint)
+        else:
+            # the store time stands in for S3's last_modified
+            self.version_index.add(fingerprint, time.time(), version_id or 'null')
 
     def retrieve_response(self, spider, request):
         """
@@ -200,114 +769,516 @@ class S3CacheStorage(object):
         """
         key = self._get_request_storage_key(spider, request)
 
+        if self.prefetched is not None:
+            data_string = self.prefetched.get(key.rsplit('/', 1)[1])
+            if data_string is not None:
+                self.metrics.inc_value('history/prefetch/hit', spider=spider)
+                if self.lazy_body:
+                    return read_record_lazy(data_string, resolve_body=self._get_blob)
+                return decode_record(data_string, resolve_body=self._get_blob)
+            self.metrics.inc_value('history/prefetch/miss', spider=spider)
+
+        if self.bloom_filter is not None and key.rsplit('/', 1)[1] not in self.bloom_filter:
+            self.metrics.inc_value('history/bloom/skipped', spider=spider)
+            return
+
         epoch = request.meta.get('epoch')  # guaranteed to be True or datetime
         s3_key = self._get_s3_key(key, epoch)
+        if self.key_shard_width and self.read_unsharded_keys:
+            s3_key = self._merge_unsharded_key(spider, key, s3_key, epoch)
         logger.debug('Retrieving response for key {}.'.format(s3_key))
 
+        segment_version = self._lookup_segments(key, epoch)
+        if segment_version is not None and (
+                not s3_key or self._prefer_segment(s3_key, segment_version, epoch)):
+            return self._retrieve_from_segment(segment_version)
+
         if not s3_key:
+            if self.bloom_filter is not None:
+                # a false positive, or only versions newer than the epoch
+                self.metrics.inc_value('history/bloom/unmatched', spider=spider)
             return
 
         try:
-            data_string = s3_key.get_contents_as_string()
-        except boto.exception.S3ResponseError as e:
-            # See store_response for error descriptions
-            raise e
+            return self._read_s3_key(spider, s3_key)
+        except Exception as e:
+            if getattr(e, 'status', None) != 404 or not self._drop_indexed_version(
+                    key, s3_key.version_id):
+                raise
+        # the version was deleted since it was indexed, e.g. by compaction
+        self.metrics.inc_value('history/index/stale', spider=spider)
+        return self.retrieve_response(spider, request)
+
+    def _read_s3_key(self, spider, s3_key):
+        if self.lazy_body:
+            with self.metrics.timer('history/record/decode', spider=spider):
+                return self._read_record_lazy(s3_key.name, s3_key.version_id)
+
+        try:
+            # read the record chunk by chunk rather than as a whole
+            query_args = 'versionId={}'.format(s3_key.version_id) if s3_key.version_id else None
+            s3_key.open_read(query_args=query_args)
+            # includes downloading the body, which is read as it is decoded
+            with self.metrics.timer('history/record/decode', spider=spider):
+                return read_record_stream(s3_key, resolve_body=self._get_blob)
         finally:
             s3_key.close()
 
-        data = json.loads(data_string)
+    def _drop_indexed_version(self, key, version_id):
+        """Remove a version found deleted from the version index, listing
+        the key again if none is left. Return whether it was indexed.
 
-        metadata = data['metadata']
-        response_headers = Headers(data['response_headers'])
-        response_body = data['response_body']
+        """
+        if self.version_index is None:
+            return False
+        fingerprint = key.rsplit('/', 1)[1]
+        versions = self.version_index.get(fingerprint) or []
+        remaining = [version for version in versions if version[1] != (version_id or 'null')]
+        if len(remaining) == len(versions):
+            return False
 
-        if data.get('binary', False):
-            logger.debug('retrieved binary body')
-            response_body = base64.b64decode(response_body.decode('utf8'))
-            encoding = {}
-        else:
-            encoding = {'encoding': 'utf8'}
-        url = str(metadata['response_url'])
-        status = metadata.get('status')
-        Response = responsetypes.from_args(headers=response_headers, url=url)
+        self.version_index.set_versions(fingerprint, remaining)
+        if not remaining:
+            self._backfill_version_index(key, fingerprint)
+        return True
 
-        return Response(url=url,
-                        headers=response_headers,
-                        status=status,
-                        body=response_body,
-                        **encoding)
+    def _merge_unsharded_key(self, spider, key, s3_key, epoch):
+        """Pick between the version of key and the one of the same request
+        in the unsharded layout, stored before keys were sharded.
 
-    def store_response(self, spider, request, response):
-        """Store the given response in the cache.
+        Unsharded versions are older than the sharded ones, so they are
+        only looked up when the sharded key has no version, or when a
+        version between epoch and the one picked may have been stored.
 
         """
+        if s3_key and not (isinstance(epoch, datetime) and
+                           _key_timestamp(s3_key) >= _to_timestamp(epoch)):
+            return s3_key
+
+        unsharded_key = self._get_listed_s3_key(
+            cache_key(spider.name, key.rsplit('/', 1)[1]), epoch)
+        if not unsharded_key:
+            return s3_key
+        if s3_key:
+            versions = sorted([(_key_timestamp(s3_key), 1, s3_key),
+                               (_key_timestamp(unsharded_key), 0, unsharded_key)])
+            if _select_version(versions, epoch)[2] is s3_key:
+                return s3_key
+
+        self.metrics.inc_value('history/unsharded/hit', spider=spider)
+        return unsharded_key
+
+    def _lookup_segments(self, key, epoch):
+        """Return the (timestamp, segment, offset, length) of the version
+        matching epoch among those stored in segments, or None.
+
+        """
+        if not self.read_segments:
+            return None
+        if self.segments is None:
+            self.segments = self._load_segments()
+        return self.segments.lookup(key.rsplit('/', 1)[1], epoch)
+
+    def _prefer_segment(self, s3_key, segment_version, epoch):
+        """Pick between the version of the cache key and the one of a
+        segment, each matching epoch in its own history.
+
+        """
+        versions = sorted([(_key_timestamp(s3_key), False), (segment_version[0], True)])
+        return _select_version(versions, epoch)[1]
+
+    def _load_segments(self):
+        segments = ArchiveIndex()
+        for s3_key in self.s3_bucket.list(prefix=self.segment_prefix):
+            if not s3_key.name.endswith(INDEX_SUFFIX):
+                continue
+            entries, _ = load_index(s3_key.get_contents_as_string())
+            segment_id = s3_key.name[len(self.segment_prefix):-len(INDEX_SUFFIX)]
+            segments.add(segment_id, entries)
+
+        logger.debug('loaded {} fingerprints from segments'.format(len(segments)))
+        return segments
+
+    def _retrieve_from_segment(self, segment_version):
+        _, segment, offset, length = segment_version
+        logger.debug('Retrieving response from segment {} at {}.'.format(segment, offset))
+        if self.lazy_body:
+            return self._read_record_lazy(self.segment_prefix + segment, None, offset, length)
+
+        s3_key = self.s3_bucket.new_key(self.segment_prefix + segment)
+        try:
+            data_string = s3_key.get_contents_as_string(headers={
+                'Range': 'bytes={}-{}'.format(offset, offset + length - 1),
+            })
+        finally:
+            s3_key.close()
+
+        return decode_record(data_string, resolve_body=self._get_blob)
+
+    def _read_record_lazy(self, name, version_id, offset=0, length=None):
+        """Return the response of the record at offset of key name (to its
+        end unless length is given). Only its first HISTORY_LAZY_HEAD_SIZE
+        bytes are read, the rest of its body is on first access.
+
+        """
+        last = offset + length - 1 if length is not None else None
+        head_last = offset + self.lazy_head_size - 1
+        head = self._read_range(name, version_id, offset,
+                                head_last if last is None else min(head_last, last))
+
+        def read_from(start):
+            return self._read_range(name, version_id, offset + start, last)
+
+        whole = len(head) < self.lazy_head_size or (last is not None and last <= head_last)
+        return read_record_lazy(head, None if whole else read_from, resolve_body=self._get_blob)
+
+    def _read_range(self, name, version_id, first, last=None):
+        """Return the bytes first to last (included, or to the end) of a key
+        with a ranged GET.
+
+        """
+        s3_key = self.s3_bucket.new_key(name)
+        try:
+            return s3_key.get_contents_as_string(headers={
+                'Range': 'bytes={}-{}'.format(first, '' if last is None else last),
+            }, version_id=None if version_id == 'null' else version_id)
+        except Exception as e:
+            if getattr(e, 'status', None) == 416:
+                # the record ended with the bytes already read
+                return b''
+            raise
+        finally:
+            s3_key.close()
+
+    def _measure_store(self, spider, request, response, done=None):
+        return self._write(super(S3CacheStorage, self)._measure_store,
+                           spider, request, response, done)
+
+    def _write(self, func, *args):
+        """Run a write, making its S3 requests once when the writer pool
+        retries failed writes as a whole; the write then skips the steps
+        that succeeded in previous attempts.
+
+        """
+        if self.writer is None or not self.writer.retries:
+            return func(*args)
+
+        from history import s3
+        with s3.single_attempt():
+            return func(*args)
+
+    def _store_response(self, spider, request, response, done):
         logger.debug('storing response for {}.'.format(request.url))
         key = self._get_request_storage_key(spider, request)
-        response_body, binary = _reformat_response(response)
-
-        metadata = {
-            'url': request.url,
-            'method': request.method,
-            'status': response.status,
-            'response_url': response.url,
-        }
-
-        data = {
-            'binary': binary,
-            'metadata': metadata,
-            'request_headers': request.headers.to_unicode_dict(),
-            'request_body': _coerce_unicode_encoding(request.body),
-            'response_headers': response.headers.to_unicode_dict(),
-            'response_body': response.text
-        }
-
-        data_string = json.dumps(data, ensure_ascii=False)
-        # sometimes can cause memory error in SH if too big
-        logger.debug('request/response object size: {} kB'.format(len(data_string) / 1024))
+        metadata = _truncate_metadata_fields(record_metadata(request, response))
         # With versioning enabled creating a new s3_key is not
         # necessary. We could just write over an old s3_key. However,
         # the cost to GET the old s3_key is higher than the cost to
         # simply regenerate it using self._get_request_storage_key().
         s3_key = self.s3_bucket.new_key(key)
+        source_key = self.s3_bucket.new_key(self._get_source_name(request))
 
+        digest = body_digest(response.body)
+        metadata['digest'] = digest
+
+        # boto raises S3ResponseError on failed requests, see
+        # http://docs.pythonboto.org/en/latest/ref/boto.html#module-boto.exception
+        #   S3CopyError        : Error copying a key on S3.
+        #   S3CreateError      : Error creating a bucket or key on S3.
+        #   S3DataError        : Error receiving data from S3.
+        #   S3PermissionsError : Permissions error when accessing a bucket or key on S3.
+        #   S3ResponseError    : Error in response from S3.
+        #  e.status == 404 Not Found, probably the wrong bucket name
+        #  e.status == 403 Forbidden, probably incorrect credentials
         try:
-            metadata = _truncate_metadata_fields(metadata)
-            for k, v in metadata.items():
-                s3_key.set_metadata(k, v)
-            s3_key.set_contents_from_string(data_string)
-            # save source file
-            job_folder = self.save_source
-            # if the S3 key is too long, the AWS interface does not allow to download the file !
-            source_url = _truncate_url(request.url)
-            source_name = "{}/source/{}".format(job_folder, parse.quote_plus(source_url))
-            source_key = self.s3_bucket.new_key(source_name)
-            source_key.set_contents_from_string(response.body)
+            body_ref = None
+            if self.content_addressed:
+                body_ref = digest
+                self._store_blob(body_ref, response.body)
+
+            # a retried write must not store a second version of the record
+            if 'version_id' not in done:
+                if body_ref is None and len(response.body) >= self.streaming_threshold:
+                    chunks = self.metrics.timed_iter('history/record/encode',
+                                                     self.codec.iter_encode(request, response),
+                                                     spider=spider)
+                    done['version_id'] = self._upload_multipart(key, metadata, chunks)
+                else:
+                    with self.metrics.timer('history/record/encode', spider=spider):
+                        data_string, _ = self.codec.encode(request, response, body_ref=body_ref)
+                    for k, v in metadata.items():
+                        s3_key.set_metadata(k, v)
+                    s3_key.set_contents_from_string(data_string)
+                    done['version_id'] = s3_key.version_id
+            version_id = done['version_id']
+
+            if 'indexed' not in done:
+                fingerprint = key.rsplit('/', 1)[1]
+                if self.bloom_filter is not None:
+                    self.bloom_filter.add(fingerprint)
+                if self.version_index is not None:
+                    self._index_stored_version(key, version_id)
+                    self.version_index.set_digest(fingerprint, digest)
+                else:
+                    self.digests[key] = digest
+                if self.write_manifest:
+                    self.manifest.append([fingerprint, version_id or 'null', time.time()])
+                done['indexed'] = True
+
+            if body_ref is not None:
+                # the source copy points at the blob holding the body
+                source_key.set_metadata('blob', body_ref)
+                source_key.set_contents_from_string(self._get_blob_name(body_ref))
+            else:
+                # save source file, boto uploads it from a file-like view
+                # of the body without copying it
+                source_key.set_contents_from_file(io.BytesIO(response.body))
             # sometimes can cause memory error in SH if too big
             logger.debug('body size {} kB'.format(len(response.body) / 1024))
 
-        except boto.exception.S3ResponseError as e:
-            # http://docs.pythonboto.org/en/latest/ref/boto.html#module-boto.exception
-            #   S3CopyError        : Error copying a key on S3.
-            #   S3CreateError      : Error creating a bucket or key on S3.
-            #   S3DataError        : Error receiving data from S3.
-            #   S3PermissionsError : Permissions error when accessing a bucket or key on S3.
-            #   S3ResponseError    : Error in response from S3.
-            #  e.status == 404 Not Found, probably the wrong bucket name
-            #  e.status == 403 Forbidden, probably incorrect credentials
-            raise e
-
         finally:
             source_key.close()
             s3_key.close()
 
-    # from https://github.com/scrapy/scrapy/blob/342cb622f1ea93268477da557099010bbd72529a/scrapy/extensions/feedexport.py  # noqa
-    def _get_uri_params(self, spider):
-        params = {}
-        for k in dir(spider):
-            params[k] = getattr(spider, k)
-        ts = self.stats.get_value('start_time').replace(microsecond=0).isoformat().replace(':', '-')
-        params['time'] = ts
-        if not params.get('jobid', None):
-            jobid = os.getenv('SHUB_JOBKEY') or ''
-            params['jobid'] = jobid.replace('/', '_')
-        return params
+    def stored_timestamps(self, spider):
+        """Return the time of the most recent version of every response
+        stored for the spider, by request fingerprint.
+
+        They come from the version index, if any (keys stored before it was
+        enabled are left out), or from a listing of the cache keys, and from
+        the segments.
+        """
+        timestamps = {}
+        if self.version_index is not None:
+            timestamps.update(self.version_index.timestamps())
+        else:
+            for key, versions in self._list_stored_versions(spider).items():
+                fingerprint = key.rsplit('/', 1)[1]
+                timestamps[fingerprint] = max(timestamps.get(fingerprint, 0), versions[-1][0])
+
+        if self.read_segments:
+            if self.segments is None:
+                self.segments = self._load_segments()
+            for fingerprint, versions in self.segments.versions.items():
+                timestamps[fingerprint] = max(timestamps.get(fingerprint, 0), versions[-1][0])
+        return timestamps
+
+    def last_digest(self, spider, request):
+        """Return the body digest of the most recently stored version of the
+        response, or None.
+
+        It comes from the version index or from the metadata of the key,
+        fetched with a HEAD request.
+        """
+        key = self._get_request_storage_key(spider, request)
+        known, digest = self._known_digest(key)
+        if known:
+            return digest
+        return self._head_digest(key)
+
+    def last_digest_async(self, spider, request):
+        """Return a Deferred firing with the result of `last_digest`.
+
+        Digests known locally are returned right away; the HEAD request is
+        made on the reader pool, like retrievals.
+        """
+        key = self._get_request_storage_key(spider, request)
+        known, digest = self._known_digest(key)
+        if known:
+            return defer.succeed(digest)
+        return self._defer_read(self._head_digest, key)
+
+    def _known_digest(self, key):
+        """Return whether the digest of key can be told without a request
+        to S3, and that digest (None if nothing is stored).
+
+        """
+        fingerprint = key.rsplit('/', 1)[1]
+        if self.bloom_filter is not None and fingerprint not in self.bloom_filter:
+            return True, None
+        if self.version_index is not None:
+            digest = self.version_index.digest(fingerprint)
+        else:
+            digest = self.digests.get(key)
+        return digest is not None, digest
+
+    def _head_digest(self, key):
+        fingerprint = key.rsplit('/', 1)[1]
+        s3_key = self.s3_bucket.get_key(key)
+        if s3_key is None:
+            return None
+
+        digest = s3_key.get_metadata('digest')
+        if digest is not None:
+            if self.version_index is not None:
+                self.version_index.set_digest(fingerprint, digest)
+            else:
+                self.digests[key] = digest
+        return digest
+
+    def _get_blob_name(self, digest):
+        return '{}/{}'.format(self.blob_prefix, digest)
+
+    def _store_blob(self, digest, body):
+        """Upload a body under its digest, unless it already exists."""
+        if digest in self.known_blobs:
+            self.metrics.inc_value('history/blobs/known')
+            return
+
+        name = self._get_blob_name(digest)
+        # a HEAD is much cheaper than uploading the same body again
+        if self.s3_bucket.get_key(name) is not None:
+            self.metrics.inc_value('history/blobs/existing')
+        else:
+            blob_key = self.s3_bucket.new_key(name)
+            try:
+                blob_key.set_contents_from_file(io.BytesIO(body))
+            finally:
+                blob_key.close()
+            self.metrics.inc_value('history/blobs/uploaded')
+            self.metrics.inc_value('history/blobs/uploaded_bytes', len(body))
+
+        self.known_blobs.add(digest)
+
+    def _get_blob(self, digest):
+        blob_key = self.s3_bucket.new_key(self._get_blob_name(digest))
+        try:
+            return blob_key.get_contents_as_string()
+        finally:
+            blob_key.close()
+
+    def _upload_multipart(self, key, metadata, chunks):
+        """Upload a record as it is encoded, in parts of
+        HISTORY_STREAMING_PART_SIZE bytes. Return the version id of the
+        uploaded key.
+
+        """
+        upload = self.s3_bucket.initiate_multipart_upload(key, metadata=metadata)
+        try:
+            part = io.BytesIO()
+            part_number = 0
+            for chunk in chunks:
+                part.write(chunk)
+                if part.tell() >= self.streaming_part_size:
+                    part_number += 1
+                    part.seek(0)
+                    upload.upload_part_from_file(part, part_number)
+                    part = io.BytesIO()
+
+            if part.tell() or not part_number:
+                part_number += 1
+                part.seek(0)
+                upload.upload_part_from_file(part, part_number)
+            completed = upload.complete_upload()
+        except Exception:
+            upload.cancel_upload()
+            raise
+
+        logger.debug('uploaded {} in {} parts'.format(key, part_number))
+        return getattr(completed, 'version_id', None)
+
+
+class FilesystemCacheStorage(CacheStorageBase):
+    """Store responses on the local filesystem.
+
+    Mirrors S3CacheStorage without any network round-trip: each version of
+    a record is a file under `{HISTORY_FS_DIR}/{name}/cache/{xx}/{fingerprint}/`
+    (`xx` being the first characters of the fingerprint, to keep directories
+    small) named after the time it was stored, next to a file holding the
+    digest of its body, and versions are picked following the same epoch
+    rules. Source copies are saved under
+    `{HISTORY_FS_DIR}/{HISTORY_SAVE_SOURCE}/source/`.
+
+    """
+
+    def __init__(self, stats, general_settings):
+        super(FilesystemCacheStorage, self).__init__(stats, general_settings)
+        self.basedir = general_settings.get('HISTORY_FS_DIR', DEFAULT_FS_DIR)
+
+    def _get_key_dir(self, key):
+        prefix, fingerprint = key.rsplit('/', 1)
+        return os.path.join(self.basedir, prefix, fingerprint[:2], fingerprint)
+
+    def _list_versions(self, key_dir):
+        """Return the (timestamp, path) of every version stored in key_dir,
+        from the oldest to the most recent.
+
+        """
+        try:
+            names = os.listdir(key_dir)
+        except OSError:
+            return []
+
+        return sorted(
+            (int(name[:-len(RECORD_SUFFIX)]) / 1e6, os.path.join(key_dir, name))
+            for name in names if name.endswith(RECORD_SUFFIX)
+        )
+
+    def last_digest(self, spider, request):
+        """Return the body digest of the most recently stored version of the
+        response, or None.
+
+        It is read from the digest file written next to the record, or from
+        the record itself for records stored without one.
+        """
+        key_dir = self._get_key_dir(self._get_request_storage_key(spider, request))
+        versions = self._list_versions(key_dir)
+        if not versions:
+            return None
+
+        path = versions[-1][1]
+        try:
+            with open(path[:-len(RECORD_SUFFIX)] + DIGEST_SUFFIX, 'rb') as f:
+                return f.read().decode('ascii')
+        except (IOError, OSError):
+            pass
+        with open(path, 'rb') as f:
+            return body_digest(read_record_stream(f).body)
+
+    def stored_timestamps(self, spider):
+        """Return the time of the most recent version of every response
+        stored for the spider, by request fingerprint.
+
+        """
+        cache_dir = os.path.join(self.basedir, spider.name, 'cache')
+        timestamps = {}
+        for prefix in (os.listdir(cache_dir) if os.path.isdir(cache_dir) else []):
+            for fingerprint in os.listdir(os.path.join(cache_dir, prefix)):
+                versions = self._list_versions(os.path.join(cache_dir, prefix, fingerprint))
+                if versions:
+                    timestamps[fingerprint] = versions[-1][0]
+        return timestamps
+
+    def retrieve_response(self, spider, request):
+        """
+        Return response if present in cache, or None otherwise.
+        """
+        key_dir = self._get_key_dir(self._get_request_storage_key(spider, request))
+        epoch = request.meta.get('epoch')  # guaranteed to be True or datetime
+        version = _select_version(self._list_versions(key_dir), epoch)
+        logger.debug('Retrieving response from {}.'.format(version))
+
+        if version is None:
+            return
+
+        with open(version[1], 'rb') as f:
+            with self.metrics.timer('history/record/decode', spider=spider):
+                if self.lazy_body:
+                    return read_record_lazy(f.read())
+                return read_record_stream(f)
+
+    def _store_response(self, spider, request, response, done):
+        logger.debug('storing response for {}.'.format(request.url))
+        key_dir = self._get_key_dir(self._get_request_storage_key(spider, request))
+
+        # a retried write overwrites the files of the previous attempt
+        name = done.setdefault('name', '{:020d}'.format(int(time.time() * 1e6)))
+        chunks = self.metrics.timed_iter('history/record/encode',
+                                         self.codec.iter_encode(request, response),
+                                         spider=spider)
+        # the digest is written first: a digest without its record is
+        # ignored, a record without its digest is read in full
+        digest = body_digest(response.body).encode('ascii')
+        _write_file(os.path.join(key_dir, name + DIGEST_SUFFIX), [digest])
+        _write_file(os.path.join(key_dir, name + RECORD_SUFFIX), chunks)
+        _write_file(os.path.join(self.basedir, self._get_source_name(request)), [response.body])
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""Adaptive limits of the storage writes.
+
+`AdaptiveLimiter` adjusts the number of concurrent uploads and their rate
+AIMD-style (additive increase, multiplicative decrease), like TCP
+congestion control: limits grow slowly while uploads succeed within the
+target latency, and are halved when S3 throttles (503 SlowDown), fails or
+slows down beyond the target latency.
+
+"""
+
+from __future__ import absolute_import, unicode_literals
+import logging
+import socket
+
+from six.moves import http_client
+
+logger = logging.getLogger(__name__)
+
+MIN_RATE = 1.0  # writes per second
+# a limit is not decreased twice within this many seconds, so that the
+# writes already running when it was decreased don't decrease it again
+DECREASE_INTERVAL = 1.0
+# weight of the last latency in its moving average
+LATENCY_WEIGHT = 0.2
+
+
+def is_retryable(error):
+    """Whether a failed write may succeed later: S3 throttled it, failed on
+    its side or could not be reached.
+
+    """
+    status = getattr(error, 'status', None)
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(error, (socket.error, http_client.HTTPException))
+
+
+class AdaptiveLimiter(object):
+    """Concurrency and rate limits of the writes.
+
+    `concurrency` starts at max_concurrency and the rate is not limited
+    until the first throttled write, where it is set to half the current
+    throughput. Both then grow by about one unit per second of successful
+    writes, up to max_concurrency and max_rate (if set).
+
+    The current limits are kept in the stats under `history/store/limit/`
+    (a rate of 0 means it is not limited).
+
+    """
+
+    def __init__(self, stats, max_concurrency, target_latency=1.0, max_rate=None):
+        self.stats = stats
+        self.max_concurrency = max(1, max_concurrency)
+        self.target_latency = target_latency
+        self.max_rate = max_rate or None
+        self.limit = float(self.max_concurrency)
+        self.rate = None
+        self.latency = None
+        self.next_write = 0
+        self.last_decrease = None
+        self._update_stats()
+
+    @property
+    def concurrency(self):
+        return int(self.limit)
+
+    def delay(self, now):
+        """Return how long to wait before the next write, or 0 and count
+        the write as started.
+
+        """
+        rate = self.rate if self.rate is not None else self.max_rate
+        if rate is None:
+            return 0
+        if now < self.next_write:
+            return self.next_write - now
+        self.next_write = max(now, self.next_write) + 1.0 / rate
+        return 0
+
+    def success(self, latency, now):
+        self.latency = latency if self.latency is None else (
+            LATENCY_WEIGHT * latency + (1 - LATENCY_WEIGHT) * self.latency)
+        if latency > self.target_latency:
+            # S3 is slowing down: fewer concurrent writes, same rate
+            self._decrease(now, rate=False)
+            return
+
+        self.limit = min(self.max_concurrency, self.limit + 1.0 / self.limit)
+        if self.rate is not None:
+            self.rate += 1.0 / self.rate
+            if self.max_rate is not None:
+                self.rate = min(self.rate, self.max_rate)
+        self._update_stats()
+
+    def failure(self, now):
+        self.stats.inc_value('history/store/throttled')
+        self._decrease(now, rate=True)
+
+    def _decrease(self, now, rate):
+        if self.last_decrease is not None and now - self.last_decrease < DECREASE_INTERVAL:
+            return
+        self.last_decrease = now
+
+        if rate:
+            current = self.rate or self.max_rate or self._throughput()
+            self.rate = max(MIN_RATE, current / 2)
+        self.limit = max(1.0, self.limit / 2)
+        logger.debug('store limits decreased to {} writes, {} writes/s'.format(
+            self.concurrency, self.rate))
+        self._update_stats()
+
+    def _throughput(self):
+        # Little's law: writes in flight / time per write
+        if not self.latency:
+            return MIN_RATE
+        return self.limit / self.latency
+
+    def _update_stats(self):
+        self.stats.set_value('history/store/limit/concurrency', self.concurrency)
+        self.stats.set_value('history/store/limit/rate', round(self.rate or 0, 2))
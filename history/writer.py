@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+from collections import deque
+import logging
+from timeit import default_timer
+
+from twisted.internet import defer, threads
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+
+from history.throttle import is_retryable
+
+logger = logging.getLogger(__name__)
+
+# backoff of the retried writes, in seconds
+RETRY_DELAY = 0.5
+RETRY_MAX_DELAY = 30
+
+
+class BoundedWriter(object):
+    """Run storage writes on a bounded pool of worker threads.
+
+    At most `queue_size` writes are in flight (running, waiting for a free
+    thread or for a retry). Once the queue is full, `submit` returns a
+    Deferred which fires when the write has been accepted: returning it from
+    a downloader middleware holds the response back, which slows the crawl
+    down instead of buffering an unbounded amount of responses in memory.
+
+    With a `limiter` (see `history.throttle`), writes are started within its
+    concurrency and rate limits, which follow the latency and failures of
+    the writes. Writes failing with a retryable error are queued again, up
+    to `retries` times, with an exponential backoff.
+
+    """
+
+    def __init__(self, stats, max_threads=4, queue_size=100, limiter=None, retries=0):
+        self.stats = stats
+        self.max_threads = max(1, max_threads)
+        self.queue_size = max(1, queue_size)
+        self.limiter = limiter
+        self.retries = retries
+        self.pool = ThreadPool(minthreads=0, maxthreads=self.max_threads,
+                               name='history-writer')
+        # Deferreds of the accepted writes, firing once they are done
+        self.pending = set()
+        # accepted writes not running yet: [done, func, args, kwargs, attempt]
+        self.ready = deque()
+        self.running = 0
+        self.next_run = None
+        # writes waiting for room in the queue
+        self.waiting = deque()
+
+    @property
+    def depth(self):
+        return len(self.pending) + len(self.waiting)
+
+    def start(self):
+        self.pool.start()
+
+    def submit(self, func, *args, **kwargs):
+        """Schedule `func(*args, **kwargs)` on the pool.
+
+        Return None if the write was queued right away, or a Deferred firing
+        once there was room for it in the queue.
+
+        """
+        if len(self.pending) < self.queue_size:
+            self._accept(func, args, kwargs)
+            return None
+
+        # backpressure: park the write until a running one completes
+        self.stats.inc_value('history/store/queue_full')
+        accepted = defer.Deferred()
+        self.waiting.append((accepted, func, args, kwargs))
+        return accepted
+
+    def drain(self):
+        """Return a Deferred firing once every queued write has completed,
+        then stop the pool.
+
+        """
+        logger.debug('draining {} pending writes'.format(self.depth))
+        d = self._wait_all()
+        d.addBoth(lambda _: self.pool.stop())
+        return d
+
+    def _wait_all(self):
+        if not (self.pending or self.waiting):
+            return defer.succeed(None)
+
+        d = defer.DeferredList(list(self.pending), consumeErrors=True)
+        # writes parked in `waiting` get dispatched while the pending ones
+        # complete, so check again until both are empty
+        d.addCallback(lambda _: self._wait_all())
+        return d
+
+    def _accept(self, func, args, kwargs):
+        done = defer.Deferred()
+        self.pending.add(done)
+        done.addBoth(self._done, done)
+        self.ready.append([done, func, args, kwargs, 0])
+        self._run()
+
+    def _run(self):
+        from twisted.internet import reactor
+
+        self.next_run = None
+        concurrency = self.limiter.concurrency if self.limiter else self.max_threads
+        while self.ready and self.running < concurrency:
+            delay = self.limiter.delay(reactor.seconds()) if self.limiter else 0
+            if delay > 0:
+                self.next_run = reactor.callLater(delay, self._run)
+                return
+
+            write = self.ready.popleft()
+            self.running += 1
+            d = threads.deferToThreadPool(reactor, self.pool, _timed, *write[1:4])
+            d.addBoth(self._finished, write)
+
+    def _finished(self, result, write):
+        from twisted.internet import reactor
+
+        self.running -= 1
+        now = reactor.seconds()
+        if not isinstance(result, Failure):
+            if self.limiter is not None:
+                self.limiter.success(result, now)
+            write[0].callback(None)
+        else:
+            retryable = is_retryable(result.value)
+            if retryable and self.limiter is not None:
+                self.limiter.failure(now)
+            if retryable and write[4] < self.retries:
+                write[4] += 1
+                self.stats.inc_value('history/store/retried')
+                reactor.callLater(min(RETRY_MAX_DELAY, RETRY_DELAY * 2 ** write[4]),
+                                  self._retry, write)
+            else:
+                write[0].errback(result)
+
+        if self.next_run is None:
+            self._run()
+
+    def _retry(self, write):
+        self.ready.appendleft(write)
+        if self.next_run is None:
+            self._run()
+
+    def _done(self, result, d):
+        self.pending.discard(d)
+        if isinstance(result, Failure):
+            self.stats.inc_value('history/store/failed')
+            logger.info('failed to store response: {}'.format(result.getErrorMessage()))
+
+        if self.waiting:
+            accepted, func, args, kwargs = self.waiting.popleft()
+            self._accept(func, args, kwargs)
+            accepted.callback(None)
+
+        return None
+
+
+def _timed(func, args, kwargs):
+    """Run func, return how long it took in seconds."""
+    start = default_timer()
+    func(*args, **kwargs)
+    return default_timer() - start
@@ -28,6 +28,9 @@ setup(
     url='http://github.com/Kpler/scrapy-history-middleware',
     packages=packages,
     install_requires=requires,
+    entry_points={
+        'console_scripts': ['scrapy-history = history.cli:main'],
+    },
     classifiers=(
         'Development Status :: 4 - Beta'
         'Intended Audience :: Developers',
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""In-memory stand-in for the boto S3 objects used by the storage backends:
+a versioned bucket, its keys and multipart uploads.
+
+`connection()` returns a connection to patch over `history.s3.connect`.
+
+"""
+
+from __future__ import absolute_import, unicode_literals
+from datetime import datetime, timedelta
+import io
+import itertools
+
+from boto.exception import S3ResponseError
+
+
+class Version(object):
+
+    def __init__(self, version_id, last_modified, data, metadata):
+        self.version_id = version_id
+        self.last_modified = last_modified
+        self.data = data
+        self.metadata = metadata
+
+
+class Key(object):
+
+    def __init__(self, bucket, name, version=None):
+        self.bucket = bucket
+        self.name = name
+        self.version_id = version.version_id if version else None
+        self.last_modified = version.last_modified if version else None
+        self.metadata = dict(version.metadata) if version else {}
+        self.size = len(version.data) if version else None
+        self.fp = None
+
+    def set_metadata(self, name, value):
+        self.metadata[name] = value
+
+    def get_metadata(self, name):
+        return self.metadata.get(name)
+
+    def update_metadata(self, metadata):
+        self.metadata.update(metadata)
+
+    def set_contents_from_string(self, data, headers=None):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        version = self.bucket.put(self.name, data, self.metadata)
+        self.version_id = version.version_id
+
+    def set_contents_from_file(self, fp, headers=None, **kwargs):
+        self.set_contents_from_string(fp.read())
+
+    def set_contents_from_filename(self, filename, headers=None):
+        with open(filename, 'rb') as f:
+            self.set_contents_from_string(f.read())
+
+    def _version(self):
+        version = self.bucket.version(self.name, self.version_id)
+        if version is None:
+            raise S3ResponseError(404, 'Not Found')
+        return version
+
+    def get_contents_as_string(self, headers=None, version_id=None):
+        if version_id:
+            self.version_id = version_id
+        data = self._version().data
+        if headers and 'Range' in headers:
+            first, last = headers['Range'][len('bytes='):].split('-')
+            if int(first) >= len(data):
+                raise S3ResponseError(416, 'Requested Range Not Satisfiable')
+            data = data[int(first):int(last) + 1] if last else data[int(first):]
+        self.bucket.gets += 1
+        return data
+
+    def get_contents_to_filename(self, filename, headers=None):
+        with open(filename, 'wb') as f:
+            f.write(self.get_contents_as_string())
+
+    def open_read(self, headers=None, query_args=None, **kwargs):
+        if query_args and query_args.startswith('versionId='):
+            self.version_id = query_args[len('versionId='):]
+        self.fp = io.BytesIO(self.get_contents_as_string())
+
+    def read(self, size=0):
+        if self.fp is None:
+            self.open_read()
+        return self.fp.read(size) if size else self.fp.read()
+
+    def close(self):
+        self.fp = None
+
+
+class MultiPartUpload(object):
+
+    def __init__(self, bucket, name, metadata):
+        self.bucket = bucket
+        self.name = name
+        self.metadata = metadata or {}
+        self.parts = {}
+        self.cancelled = False
+
+    def upload_part_from_file(self, fp, part_num, **kwargs):
+        if self.bucket.fail_parts:
+            raise S3ResponseError(500, 'Internal Error')
+        self.parts[part_num] = fp.read()
+
+    def complete_upload(self):
+        data = b''.join(self.parts[number] for number in sorted(self.parts))
+        version = self.bucket.put(self.name, data, self.metadata)
+        self.bucket.uploads.remove(self)
+        return version
+
+    def cancel_upload(self):
+        self.cancelled = True
+        self.bucket.uploads.remove(self)
+
+
+class DeleteResult(object):
+
+    def __init__(self):
+        self.deleted = []
+        self.errors = []
+
+
+class Bucket(object):
+    """Versioned bucket; name => versions, the most recent first."""
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = []
+        self.ids = itertools.count(1)
+        # each version is stored a second after the previous one
+        self.clock = datetime(2018, 1, 1)
+        self.fail_parts = False
+        self.gets = 0
+        self.listings = 0
+
+    def put(self, name, data, metadata):
+        self.clock += timedelta(seconds=1)
+        version = Version(str(next(self.ids)), self.clock.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                          data, dict(metadata))
+        self.objects.setdefault(name, []).insert(0, version)
+        return version
+
+    def version(self, name, version_id=None):
+        versions = self.objects.get(name, [])
+        if version_id in (None, 'null'):
+            return versions[0] if versions else None
+        return next((v for v in versions if v.version_id == version_id), None)
+
+    def new_key(self, name):
+        return Key(self, name)
+
+    def get_key(self, name, headers=None, version_id=None):
+        version = self.version(name, version_id)
+        return Key(self, name, version) if version is not None else None
+
+    def list(self, prefix='', delimiter=''):
+        folders = set()
+        for name in sorted(self.objects):
+            if not name.startswith(prefix):
+                continue
+            rest = name[len(prefix):]
+            if delimiter and delimiter in rest:
+                folder = prefix + rest.split(delimiter, 1)[0] + delimiter
+                if folder not in folders:
+                    folders.add(folder)
+                    yield Key(self, folder)
+                continue
+            yield Key(self, name, self.objects[name][0])
+
+    def list_versions(self, prefix=''):
+        self.listings += 1
+        for name in sorted(self.objects):
+            if name.startswith(prefix):
+                for version in self.objects[name]:
+                    yield Key(self, name, version)
+
+    def delete_keys(self, names):
+        result = DeleteResult()
+        for name, version_id in names:
+            versions = [v for v in self.objects.get(name, []) if v.version_id != version_id]
+            if versions:
+                self.objects[name] = versions
+            else:
+                self.objects.pop(name, None)
+            result.deleted.append(name)
+        return result
+
+    def initiate_multipart_upload(self, name, metadata=None, **kwargs):
+        upload = MultiPartUpload(self, name, metadata)
+        self.uploads.append(upload)
+        return upload
+
+
+class Connection(object):
+
+    def __init__(self):
+        self.bucket = Bucket()
+        self.metrics = None
+
+    def get_bucket(self, name, validate=True):
+        return self.bucket
+
+    def close(self):
+        pass
+
+
+def connection():
+    return Connection()
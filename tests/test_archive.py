@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+from datetime import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from history.archive import (
+    ArchiveIndex,
+    ArchiveWriter,
+    dump_index,
+    load_index,
+    read_record,
+    scan_archive,
+)
+from history.index import _to_timestamp
+
+
+class TestArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'segment.seg')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, records):
+        writer = ArchiveWriter(self.path)
+        for fingerprint, timestamp, data in records:
+            writer.append(fingerprint, timestamp, data)
+        return writer.close()
+
+    def test_read_back_records(self):
+        entries = self._write([('aa', 1.0, b'first'), ('bb', 2.0, b'second')])
+        self.assertEqual([e[0] for e in entries], ['aa', 'bb'])
+        _, _, offset, length = entries[1]
+        self.assertEqual(read_record(self.path, offset, length), b'second')
+
+    def test_flush_records(self):
+        writer = ArchiveWriter(self.path, flush=True)
+        self.addCleanup(writer.close)
+        writer.append('aa', 1.0, b'first')
+        # as found after a crash, before the writer is closed
+        self.assertEqual(scan_archive(self.path), writer.entries)
+
+    def test_scan_rebuilds_index(self):
+        entries = self._write([('aa', 1.0, b'first'), ('bb', 2.0, b'second')])
+        self.assertEqual(scan_archive(self.path), entries)
+
+    def test_scan_truncates_partial_frame(self):
+        entries = self._write([('aa', 1.0, b'first')])
+        size = os.path.getsize(self.path)
+        self._write([('bb', 2.0, b'second')])
+        with open(self.path, 'ab') as f:
+            f.truncate(size + 5)
+
+        self.assertEqual(scan_archive(self.path), entries)
+        self.assertEqual(os.path.getsize(self.path), size)
+
+    def test_index_roundtrip(self):
+        entries = self._write([('aa', 1.0, b'first')])
+        loaded, metadata = load_index(dump_index(entries, job='spider/job'))
+        self.assertEqual(loaded, entries)
+        self.assertEqual(metadata, {'job': 'spider/job'})
+
+    def test_lookup_by_epoch(self):
+        index = ArchiveIndex()
+        old, new = _to_timestamp(datetime(2018, 1, 1)), _to_timestamp(datetime(2018, 2, 1))
+        index.add('s1', [('aa', new, 0, 10)])
+        index.add('s2', [('aa', old, 5, 10)])
+
+        self.assertEqual(index.lookup('aa', True)[1], 's1')
+        self.assertEqual(index.lookup('aa', datetime(2017, 12, 1))[1], 's2')
+        self.assertEqual(index.lookup('aa', datetime(2018, 1, 15))[1], 's1')
+        self.assertEqual(index.lookup('aa', datetime(2018, 3, 1))[1], 's1')
+        self.assertIsNone(index.lookup('bb', True))
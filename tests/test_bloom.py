@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+import hashlib
+import unittest
+
+from history.bloom import BloomFilter
+
+
+def fingerprints(start, stop):
+    return [hashlib.sha1(str(i).encode('ascii')).hexdigest() for i in range(start, stop)]
+
+
+class TestBloomFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.bloom_filter = BloomFilter.for_capacity(1000, 0.01)
+
+    def test_no_false_negatives(self):
+        added = fingerprints(0, 1000)
+        for fingerprint in added:
+            self.bloom_filter.add(fingerprint)
+        self.assertTrue(self.bloom_filter.dirty)
+        self.assertTrue(all(fingerprint in self.bloom_filter for fingerprint in added))
+
+    def test_false_positive_rate(self):
+        for fingerprint in fingerprints(0, 1000):
+            self.bloom_filter.add(fingerprint)
+        false_positives = sum(fingerprint in self.bloom_filter
+                              for fingerprint in fingerprints(1000, 11000))
+        self.assertLess(false_positives, 200)
+
+    def test_estimated_length(self):
+        self.assertEqual(self.bloom_filter.estimated_count(), 0)
+        for fingerprint in fingerprints(0, 500):
+            self.bloom_filter.add(fingerprint)
+        self.assertAlmostEqual(self.bloom_filter.estimated_count(), 500, delta=25)
+        self.assertFalse(self.bloom_filter.saturated)
+
+    def test_saturated(self):
+        full = BloomFilter.loads(BloomFilter(64, 3, b'\xff' * 8).dumps())
+        self.assertTrue(full.saturated)
+        self.assertEqual(full.estimated_count(), 64)
+        self.assertIn('a' * 40, full)
+
+    def test_dumps_loads(self):
+        self.bloom_filter.add('a' * 40)
+        loaded = BloomFilter.loads(self.bloom_filter.dumps())
+        self.assertEqual((loaded.size, loaded.hashes), (self.bloom_filter.size,
+                                                        self.bloom_filter.hashes))
+        self.assertIn('a' * 40, loaded)
+        self.assertNotIn('b' * 40, loaded)
+        self.assertFalse(loaded.dirty)
+        self.assertRaises(ValueError, BloomFilter.loads, b'nope' + loaded.dumps()[4:])
+
+    def test_update(self):
+        other = BloomFilter.for_capacity(1000, 0.01)
+        self.bloom_filter.add('a' * 40)
+        other.add('b' * 40)
+        self.bloom_filter.update(other)
+        self.assertIn('a' * 40, self.bloom_filter)
+        self.assertIn('b' * 40, self.bloom_filter)
+        self.assertRaises(ValueError, self.bloom_filter.update, BloomFilter.for_capacity(10))
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+from datetime import datetime
+import glob
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from scrapy.http import HtmlResponse, Request
+from scrapy.spiders import Spider
+from scrapy.utils.test import get_crawler
+
+from history.cache import LRUCache, TieredCacheStorage
+from history.storage import MANDATORY_SETTINGS
+
+import s3stub
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(10)
+        cache.set('a', 1, 4)
+        cache.set('b', 2, 4)
+        cache.get('a')
+        self.assertEqual(cache.set('c', 3, 4), 1)
+
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.size, 8)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_ignores_oversized_values(self):
+        cache = LRUCache(10)
+        self.assertEqual(cache.set('a', 1, 11), 0)
+        self.assertNotIn('a', cache)
+
+
+class TestTieredCacheStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.crawler = get_crawler(settings_dict={
+            'HISTORY_TIERED_BACKEND': 'history.storage.FilesystemCacheStorage',
+            'HISTORY_FS_DIR': self.tmpdir + '/remote',
+            'HISTORY_DISK_CACHE_DIR': self.tmpdir + '/local',
+        })
+        self.stats = self.crawler.stats
+        self.stats.set_value('start_time', datetime(2018, 1, 1))
+        self.spider = Spider('example')
+        self.storage = TieredCacheStorage(self.stats, self.crawler.settings)
+        self.storage.open_spider(self.spider)
+        self.request = Request('http://example.com', meta={'epoch': True})
+
+    def tearDown(self):
+        self.storage.close_spider(self.spider)
+        shutil.rmtree(self.tmpdir)
+
+    def _store(self, body):
+        response = HtmlResponse(self.request.url, body=body, encoding='utf-8',
+                                headers={'Content-Type': 'text/html; charset=utf-8'})
+        self.storage.store_response(self.spider, self.request, response)
+
+    def test_memory_hit(self):
+        self._store(b'first')
+        first = self.storage.retrieve_response(self.spider, self.request)
+        first.flags.append('historic')
+        second = self.storage.retrieve_response(self.spider, self.request)
+
+        self.assertEqual(second.body, b'first')
+        self.assertEqual(second.flags, [])
+        self.assertEqual(self.stats.get_value('history/tiered/memory/hit'), 1)
+        self.assertEqual(self.stats.get_value('history/tiered/disk/miss'), 1)
+
+    def test_disk_hit(self):
+        self._store(b'first')
+        self.storage.retrieve_response(self.spider, self.request)
+        self.storage.memory = LRUCache(1024)
+
+        self.assertEqual(self.storage.retrieve_response(self.spider, self.request).body, b'first')
+        self.assertEqual(self.stats.get_value('history/tiered/disk/hit'), 1)
+
+    def test_store_invalidates(self):
+        self._store(b'first')
+        self.storage.retrieve_response(self.spider, self.request)
+        self._store(b'second')
+
+        self.assertEqual(self.storage.retrieve_response(self.spider, self.request).body, b'second')
+
+    def test_disk_size_limit(self):
+        requests = [Request('http://example.com/{}'.format(i), meta={'epoch': True})
+                    for i in range(3)]
+        for request in requests:
+            self.storage.store_response(self.spider, request, HtmlResponse(
+                request.url, body=b'x' * 100, encoding='utf-8'))
+        self.storage.retrieve_response(self.spider, requests[0])
+        paths = glob.glob(os.path.join(self.tmpdir, 'local', '*', '*', '*', '*.rec'))
+        self.assertEqual(len(paths), 1)
+        self.storage.disk_max_size = int(os.path.getsize(paths[0]) * 2.5)
+
+        self.storage.retrieve_response(self.spider, requests[1])
+        # read from disk again, which makes the second entry the oldest
+        self.storage.memory = LRUCache(1024)
+        time.sleep(0.01)
+        self.storage.retrieve_response(self.spider, requests[0])
+        self.storage.retrieve_response(self.spider, requests[2])
+
+        self.assertEqual(self.stats.get_value('history/tiered/disk/evictions'), 1)
+        cached = [os.path.exists(self.storage._disk_path(
+            self.storage.backend._get_request_storage_key(self.spider, request), 'latest'))
+            for request in requests]
+        self.assertEqual(cached, [True, False, True])
+
+class TestTieredLazyBody(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        connection = s3stub.connection()
+        self.bucket = connection.bucket
+        patcher = mock.patch('history.s3.connect', return_value=connection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        settings_dict = {k: 'mock setting' for k in MANDATORY_SETTINGS}
+        settings_dict.update({
+            'HISTORY_LAZY_BODY': True,
+            'HISTORY_LAZY_HEAD_SIZE': 1024,
+            'HISTORY_COMPRESSION': 'none',
+            'HISTORY_DISK_CACHE_DIR': self.tmpdir,
+        })
+        crawler = get_crawler(settings_dict=settings_dict)
+        crawler.stats.set_value('start_time', datetime(2018, 1, 1))
+        self.spider = Spider('example')
+        self.storage = TieredCacheStorage(crawler.stats, crawler.settings)
+        self.storage.open_spider(self.spider)
+        self.request = Request('http://example.com', meta={'epoch': True})
+
+    def test_copies_stay_lazy(self):
+        body = b'x' * 4096
+        self.storage.store_response(self.spider, self.request, HtmlResponse(
+            self.request.url, body=body, headers={'Content-Type': 'text/html; charset=utf-8'}))
+        first = self.storage.retrieve_response(self.spider, self.request)
+        second = self.storage.retrieve_response(self.spider, self.request)
+        gets = self.bucket.gets
+        key = self.storage.backend._get_request_storage_key(self.spider, self.request)
+        path = self.storage._disk_path(key, 'latest')
+        self.assertFalse(os.path.exists(path))
+
+        self.assertEqual(first.body, body)
+        self.assertEqual(second.body, body)
+        self.assertEqual(first.encoding, 'utf-8')
+        self.assertEqual(self.bucket.gets, gets + 1)
+        self.assertTrue(os.path.exists(path))
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+from datetime import datetime
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+
+from scrapy.http import HtmlResponse, Request
+from scrapy.settings import Settings
+from scrapy.spiders import Spider
+from scrapy.utils.test import get_crawler
+
+from history.archive import ArchiveWriter
+from history.cli import READ_AHEAD, Compactor, _transcode, retained_versions
+from history.shared import open_backend
+from history.index import _to_timestamp
+from history.record import RecordCodec, decode_record, is_binary_record
+from history.replay import ReplayStorage
+from history.storage import MANDATORY_SETTINGS, S3CacheStorage
+import s3stub
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+def _version(day, hour):
+    return (_to_timestamp(datetime(2018, 1, day, hour)), '{}-{}'.format(day, hour))
+
+
+class TestRetainedVersions(unittest.TestCase):
+
+    def setUp(self):
+        self.versions = [_version(1, 8), _version(1, 20), _version(2, 8), _version(3, 8),
+                         _version(3, 20)]
+        self.now = _to_timestamp(datetime(2018, 1, 4))
+
+    def test_keep_all(self):
+        self.assertEqual(retained_versions(self.versions), self.versions)
+        self.assertEqual(retained_versions([]), [])
+
+    def test_keep_versions(self):
+        self.assertEqual(retained_versions(self.versions, keep_versions=2), self.versions[-2:])
+        self.assertEqual(retained_versions(self.versions, keep_versions=0), [])
+
+    def test_keep_daily(self):
+        self.assertEqual(retained_versions(self.versions, keep_daily=True),
+                         [_version(1, 20), _version(2, 8), _version(3, 20)])
+
+    def test_max_age(self):
+        self.assertEqual(retained_versions(self.versions, max_age=36 * 3600, now=self.now),
+                         [_version(3, 8), _version(3, 20)])
+        # the most recent version is always kept
+        self.assertEqual(retained_versions(self.versions, max_age=3600, now=self.now),
+                         [_version(3, 20)])
+
+    def test_combined(self):
+        kept = retained_versions(self.versions, keep_versions=2, keep_daily=True,
+                                 max_age=60 * 3600, now=self.now)
+        self.assertEqual(kept, [_version(2, 8), _version(3, 20)])
+
+
+class TestTranscode(unittest.TestCase):
+
+    def test_json_to_binary(self):
+        request = Request('http://example.com/', method='POST', body=b'q=1')
+        response = HtmlResponse(request.url, body='été'.encode('latin-1'), encoding='latin-1',
+                                headers={'Content-Type': 'text/html; charset=latin-1'})
+        json_record, _ = RecordCodec(Settings({'HISTORY_RECORD_FORMAT': 'json'})).encode(
+            request, response)
+
+        record = _transcode(json_record, RecordCodec(Settings()))
+        self.assertTrue(is_binary_record(record))
+        decoded = decode_record(record)
+        self.assertEqual(decoded.body, response.body)
+        self.assertEqual(decoded.text, 'été')
+
+
+class TestCompactor(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.spider = Spider('example')
+        self.connection = s3stub.connection()
+        self.bucket = self.connection.bucket
+        patcher = mock.patch('history.s3.connect', return_value=self.connection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _crawler(self, **settings):
+        settings_dict = {k: 'mock setting' for k in MANDATORY_SETTINGS}
+        settings_dict.update(settings)
+        crawler = get_crawler(settings_dict=settings_dict)
+        crawler.stats.set_value('start_time', datetime(2018, 1, 1))
+        return crawler
+
+    def _store(self, pairs, **settings):
+        """Store responses like a crawl would, return its job folder."""
+        crawler = self._crawler(**settings)
+        storage = S3CacheStorage(crawler.stats, crawler.settings)
+        storage.open_spider(self.spider)
+        for url, body in pairs:
+            request = Request(url)
+            storage.store_response(self.spider, request,
+                                   HtmlResponse(url, body=body, encoding='utf-8'))
+        storage.close_spider(self.spider)
+        return storage.save_source
+
+    def _replay(self, job):
+        crawler = self._crawler(HISTORY_REPLAY_DIR=self.tmpdir, HISTORY_REPLAY_JOB=job)
+        storage = ReplayStorage(crawler.stats, crawler.settings)
+        storage.open_spider(self.spider)
+        self.addCleanup(storage.close_spider, self.spider)
+        return storage
+
+    def test_replay_after_compaction(self):
+        job = self._store([('http://example.com/a', b'first a'),
+                           ('http://example.com/a', b'second a'),
+                           ('http://example.com/b', b'b')])
+
+        report = Compactor(self.bucket, 'example', keep_versions=1, threads=2).run()
+        self.assertEqual((report['kept'], report['dropped']), (2, 1))
+        self.assertEqual(report['manifests'], 1)
+        self.assertFalse(list(self.bucket.list_versions(prefix='example/cache/')))
+        manifest = json.loads(self.bucket.get_key(job + '/manifest.json')
+                              .get_contents_as_string().decode('utf-8'))
+        self.assertEqual(manifest['versions'], [])
+        self.assertEqual(len(manifest['segments']), 2)
+
+        storage = self._replay(job)
+        self.assertEqual(storage.retrieve_response(self.spider,
+                                                   Request('http://example.com/a')).body,
+                         b'second a')
+        self.assertEqual(storage.retrieve_response(self.spider,
+                                                   Request('http://example.com/b')).body, b'b')
+
+    def test_bounded_read_ahead(self):
+        self._store([('http://example.com/{}'.format(i), b'page') for i in range(30)])
+        compactor = Compactor(self.bucket, 'example', threads=2)
+        fetch, append = compactor._fetch_record, ArchiveWriter.append
+        counts = {'fetched': 0, 'appended': 0, 'ahead': 0}
+        lock = threading.Lock()
+
+        def fetch_record(record):
+            with lock:
+                counts['fetched'] += 1
+                counts['ahead'] = max(counts['ahead'], counts['fetched'] - counts['appended'])
+            return fetch(record)
+
+        def append_record(writer, *args):
+            with lock:
+                counts['appended'] += 1
+            return append(writer, *args)
+
+        with mock.patch.object(compactor, '_fetch_record', fetch_record), \
+                mock.patch.object(ArchiveWriter, 'append', append_record):
+            report = compactor.run()
+        self.assertEqual(report['kept'], 30)
+        self.assertEqual(counts['appended'], 30)
+        self.assertLessEqual(counts['ahead'], 2 * READ_AHEAD)
+
+    def _shared_index_settings(self):
+        return {'HISTORY_VERSION_INDEX': True,
+                'HISTORY_SHARED_INDEX': 'sqlite:///{}/index.db'.format(self.tmpdir)}
+
+    def _compact_and_retrieve(self, clear_shared_index):
+        settings = self._shared_index_settings()
+        self._store([('http://example.com/a', b'first'),
+                     ('http://example.com/a', b'second'),
+                     ('http://example.com/a', b'third')], **settings)
+
+        shared_index = open_backend(settings['HISTORY_SHARED_INDEX'])
+        self.addCleanup(shared_index.close)
+        Compactor(self.bucket, 'example', keep_versions=2, threads=2,
+                  shared_index=shared_index if clear_shared_index else None).run()
+
+        crawler = self._crawler(**settings)
+        storage = S3CacheStorage(crawler.stats, crawler.settings)
+        storage.open_spider(self.spider)
+        self.addCleanup(storage.close_spider, self.spider)
+        for epoch, body in ((True, b'third'), (datetime(2000, 1, 1), b'second')):
+            request = Request('http://example.com/a', meta={'epoch': epoch})
+            self.assertEqual(storage.retrieve_response(self.spider, request).body, body)
+        return crawler.stats
+
+    def test_shared_index_after_compaction(self):
+        stats = self._compact_and_retrieve(clear_shared_index=True)
+        self.assertIsNone(stats.get_value('history/index/stale'))
+
+    def test_stale_shared_index(self):
+        # versions left in the shared index are dropped on their first 404
+        stats = self._compact_and_retrieve(clear_shared_index=False)
+        self.assertEqual(stats.get_value('history/index/stale'), 3)
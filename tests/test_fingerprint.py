@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+import unittest
+
+from scrapy.http import Request
+from scrapy.settings import Settings
+from scrapy.utils.request import request_fingerprint
+
+from history.fingerprint import FingerprintCache, RequestFingerprinter
+
+
+class TestRequestFingerprinter(unittest.TestCase):
+
+    def fingerprint(self, request, **settings):
+        return RequestFingerprinter(Settings(settings)).fingerprint(request)
+
+    def test_scrapy_fingerprint_by_default(self):
+        for request in (Request('http://example.com/?b=2&a=1#top'),
+                        Request('http://example.com/', method='POST', body=b'q=1')):
+            self.assertEqual(self.fingerprint(request), request_fingerprint(request))
+
+        request = Request('http://example.com/', headers={'Accept-Language': 'fr'})
+        self.assertEqual(
+            self.fingerprint(request, HISTORY_FINGERPRINT_HEADERS=['Accept-Language']),
+            request_fingerprint(request, include_headers=['Accept-Language']))
+
+    def test_ignore_params(self):
+        settings = {'HISTORY_FINGERPRINT_IGNORE_PARAMS': ['sid', 'utm_.*']}
+        expected = self.fingerprint(Request('http://example.com/?a=1&b=2'))
+        for url in ('http://example.com/?sid=42&a=1&b=2',
+                    'http://example.com/?b=2&utm_source=x&a=1&utm_medium=y'):
+            self.assertEqual(self.fingerprint(Request(url), **settings), expected)
+
+        # names are matched whole
+        self.assertNotEqual(
+            self.fingerprint(Request('http://example.com/?a=1&b=2&sids=1'), **settings),
+            expected)
+
+    def test_ignore_body(self):
+        first = Request('http://example.com/', method='POST', body=b'token=1')
+        second = Request('http://example.com/', method='POST', body=b'token=2')
+        self.assertNotEqual(self.fingerprint(first), self.fingerprint(second))
+        self.assertEqual(self.fingerprint(first, HISTORY_FINGERPRINT_BODY=False),
+                         self.fingerprint(second, HISTORY_FINGERPRINT_BODY=False))
+
+
+class TestFingerprintCache(unittest.TestCase):
+
+    def test_computed_once_per_request(self):
+        calls = []
+
+        class Fingerprinter(object):
+            def fingerprint(self, request):
+                calls.append(request)
+                return 'fp'
+
+        cache = FingerprintCache(Fingerprinter())
+        request = Request('http://example.com/')
+        self.assertEqual(cache(request), 'fp')
+        self.assertEqual(cache(request), 'fp')
+        self.assertEqual(len(calls), 1)
+
+        cache(request.replace(url='http://example.com/other'))
+        self.assertEqual(len(calls), 2)
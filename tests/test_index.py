@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+from datetime import datetime
+import unittest
+
+from history.index import VersionIndex, _to_timestamp
+
+
+class TestVersionIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = VersionIndex(shard_width=1)
+        self.jan = _to_timestamp(datetime(2018, 1, 1))
+        self.feb = _to_timestamp(datetime(2018, 2, 1))
+        self.index.add('a1', self.feb, 'v2')
+        self.index.add('a1', self.jan, 'v1')
+
+    def test_lookup(self):
+        self.assertEqual(self.index.lookup('a1', True), (self.feb, 'v2'))
+        self.assertEqual(self.index.lookup('a1', datetime(2017, 1, 1)), (self.jan, 'v1'))
+        self.assertIsNone(self.index.lookup('b1', True))
+
+    def test_dirty_shards(self):
+        self.assertEqual(self.index.dirty, {'a'})
+        self.index.dirty.clear()
+        self.index.add('a1', self.jan, 'v1')
+        self.assertEqual(self.index.dirty, set())
+
+    def test_shard_roundtrip(self):
+        other = VersionIndex(shard_width=1)
+        other.add('a2', self.jan, 'v3')
+        other.load_shard('a', self.index.dump_shard('a'))
+
+        self.assertIn('a1', other)
+        self.assertIn('a2', other)
+        self.assertEqual(other.latest('a1'), (self.feb, 'v2'))
+
+    def test_digests(self):
+        self.index.dirty.clear()
+        self.index.set_digest('a1', 'd1')
+        self.assertEqual(self.index.dirty, {'a'})
+        self.assertEqual(self.index.digest('a1'), 'd1')
+        self.assertIsNone(self.index.digest('a2'))
+
+        other = VersionIndex(shard_width=1)
+        other.load_shard('a', self.index.dump_shard('a'))
+        self.assertEqual(other.digest('a1'), 'd1')
+
+    def test_load_shard_without_digests(self):
+        other = VersionIndex(shard_width=1)
+        other.load_shard('a', b'{"a1": [[1.0, "v1"]]}')
+        self.assertEqual(other.latest('a1'), (1.0, 'v1'))
+        self.assertIsNone(other.digest('a1'))
+
+    def test_clear_versions(self):
+        self.index.set_digest('a1', 'd1')
+        self.index.dirty.clear()
+        self.index.clear_versions('a1')
+
+        self.assertEqual(self.index.dirty, {'a'})
+        self.assertIn('a1', self.index)
+        self.assertIsNone(self.index.lookup('a1', True))
+        self.assertEqual(self.index.digest('a1'), 'd1')
+
+    def test_misses(self):
+        self.assertNotIn('b1', self.index)
+        self.index.add_missing('b1')
+        self.assertIn('b1', self.index)
+        self.assertIsNone(self.index.lookup('b1', True))
+        self.assertNotIn('b', self.index.dirty)
+
+        self.index.add('b1', self.jan, 'v1')
+        self.assertEqual(self.index.lookup('b1', True), (self.jan, 'v1'))
+        self.assertFalse(self.index.misses)
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+from datetime import datetime
+import shutil
+import time
+import tempfile
+import unittest
+
+from scrapy.http import HtmlResponse, Request
+from scrapy.spiders import Spider
+from scrapy.utils.test import get_crawler
+
+from history.logic import StoreBudget, StoreChanged, StoreDaily, StoreSample, StoreStale
+from history.storage import FilesystemCacheStorage
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class TestStoreChanged(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        crawler = get_crawler(settings_dict={'HISTORY_FS_DIR': self.tmpdir})
+        crawler.stats.set_value('start_time', datetime(2018, 1, 1))
+        self.stats = crawler.stats
+        self.spider = Spider('example')
+        self.storage = FilesystemCacheStorage(crawler.stats, crawler.settings)
+        self.storage.open_spider(self.spider)
+        self.store_if = StoreChanged(crawler.settings)
+        self.store_if.bind(self.storage, crawler.stats)
+        self.request = Request('http://example.com')
+
+    def tearDown(self):
+        self.storage.close_spider(self.spider)
+        shutil.rmtree(self.tmpdir)
+
+    def _response(self, body):
+        return HtmlResponse(self.request.url, body=body, encoding='utf-8',
+                            request=self.request)
+
+    def test_store_if_changed(self):
+        self.assertTrue(self.store_if(self.spider, self.request, self._response(b'first')))
+        self.storage.store_response(self.spider, self.request, self._response(b'first'))
+
+        self.assertFalse(self.store_if(self.spider, self.request, self._response(b'first')))
+        self.assertEqual(self.stats.get_value('history/store/unchanged', spider=self.spider), 1)
+        self.assertTrue(self.store_if(self.spider, self.request, self._response(b'second')))
+
+
+class LogicTestCase(unittest.TestCase):
+
+    settings = {}
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        settings = dict(self.settings, HISTORY_FS_DIR=self.tmpdir)
+        crawler = get_crawler(settings_dict=settings)
+        crawler.stats.set_value('start_time', datetime(2018, 1, 1))
+        self.stats = crawler.stats
+        self.spider = Spider('example')
+        self.storage = FilesystemCacheStorage(crawler.stats, crawler.settings)
+        self.storage.open_spider(self.spider)
+        self.store_if = self.logic(crawler.settings)
+        self.store_if.bind(self.storage, crawler.stats)
+
+    def tearDown(self):
+        self.storage.close_spider(self.spider)
+        shutil.rmtree(self.tmpdir)
+
+    def _store_if(self, url, body=b'body'):
+        request = Request(url)
+        return self.store_if(self.spider, request,
+                             HtmlResponse(url, body=body, encoding='utf-8', request=request))
+
+
+class TestStoreDaily(LogicTestCase):
+
+    logic = StoreDaily
+
+    def test_decided_once_per_hour(self):
+        midnight = time.mktime(datetime(2018, 1, 2, 0, 30).timetuple())
+        with mock.patch('history.logic.time.time', return_value=midnight):
+            self.assertTrue(self._store_if('http://example.com'))
+        self.assertEqual(self.store_if.decided_until, midnight + 30 * 60)
+
+        with mock.patch('history.logic.time.time', return_value=midnight + 30 * 60):
+            self.assertFalse(self._store_if('http://example.com'))
+
+
+class TestStoreSample(LogicTestCase):
+
+    logic = StoreSample
+    settings = {'HISTORY_STORE_SAMPLE_RATE': 0.25}
+
+    def test_deterministic_sample(self):
+        urls = ['http://example.com/{}'.format(i) for i in range(400)]
+        sampled = [url for url in urls if self._store_if(url)]
+        self.assertTrue(60 < len(sampled) < 140)
+        self.assertEqual([url for url in urls if self._store_if(url)], sampled)
+
+
+class TestStoreBudget(LogicTestCase):
+
+    logic = StoreBudget
+    settings = {'HISTORY_STORE_BUDGET_COUNT': 2, 'HISTORY_STORE_BUDGET_BYTES': 10}
+
+    def test_count_per_domain(self):
+        self.assertTrue(self._store_if('http://example.com/1'))
+        self.assertTrue(self._store_if('http://example.com/2'))
+        self.assertFalse(self._store_if('http://example.com/3'))
+        self.assertTrue(self._store_if('http://example.org/1'))
+        self.assertEqual(self.stats.get_value('history/store/over_budget', spider=self.spider), 1)
+
+    def test_bytes(self):
+        self.assertTrue(self._store_if('http://example.com/1', b'12345678'))
+        self.assertFalse(self._store_if('http://example.com/2', b'123'))
+
+    def test_new_window(self):
+        self._store_if('http://example.com/1')
+        self._store_if('http://example.com/2')
+        self.store_if.budgets['example.com'][0] -= 1
+        self.assertTrue(self._store_if('http://example.com/3'))
+
+
+class TestStoreStale(LogicTestCase):
+
+    logic = StoreStale
+    settings = {'HISTORY_STORE_MAX_AGE': 3600}
+
+    def test_store_if_stale(self):
+        request = Request('http://example.com/stored')
+        self.storage.store_response(self.spider, request,
+                                    HtmlResponse(request.url, body=b'body', request=request))
+        self.store_if.spider_opened(self.spider)
+        self.assertEqual(self.stats.get_value('history/store/known', spider=self.spider), 1)
+
+        self.assertFalse(self._store_if('http://example.com/stored'))
+        self.assertTrue(self._store_if('http://example.com/new'))
+        self.assertFalse(self._store_if('http://example.com/new'))
+        self.assertEqual(self.stats.get_value('history/store/fresh', spider=self.spider), 2)
+
+        self.store_if.max_age = 0
+        self.assertTrue(self._store_if('http://example.com/stored'))
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+import threading
+import unittest
+
+from scrapy.utils.test import get_crawler
+
+from history.metrics import Histogram, Metrics
+
+
+class RecordingSink(object):
+
+    def __init__(self, settings):
+        self.events = []
+
+    def increment(self, name, value):
+        self.events.append(('increment', name, value))
+
+    def observe(self, name, value):
+        self.events.append(('observe', name, value))
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        crawler = get_crawler(settings_dict={
+            'HISTORY_METRICS_SINK': 'tests.test_metrics.RecordingSink'})
+        self.stats = crawler.stats
+        self.metrics = Metrics(crawler.stats, crawler.settings)
+
+    def test_histogram_percentiles(self):
+        histogram = Histogram(size=1000)
+        for value in range(1, 101):
+            histogram.add(value)
+        self.assertEqual(histogram.percentile(50), 51)
+        self.assertEqual(histogram.percentile(99), 99)
+        self.assertIsNone(Histogram().percentile(50))
+
+    def test_histogram_bounded(self):
+        histogram = Histogram(size=10)
+        for value in range(1000):
+            histogram.add(value)
+        self.assertEqual(histogram.count, 1000)
+        self.assertEqual(len(histogram.sample), 10)
+
+    def test_stats(self):
+        self.metrics.inc('history/retrieve/hit')
+        self.metrics.observe('history/store/bytes', 10)
+        self.metrics.observe('history/store/bytes', 30)
+        self.metrics.close()
+
+        self.assertEqual(self.stats.get_value('history/retrieve/hit'), 1)
+        self.assertEqual(self.stats.get_value('history/store/bytes/count'), 2)
+        self.assertEqual(self.stats.get_value('history/store/bytes/sum'), 40)
+        self.assertEqual(self.stats.get_value('history/store/bytes/max'), 30)
+        self.assertEqual(self.stats.get_value('history/store/bytes/p99'), 30)
+
+    def test_concurrent_updates(self):
+        def update():
+            for _ in range(2000):
+                self.metrics.inc_value('history/test/count')
+                self.metrics.observe('history/test/size', 1)
+
+        threads = [threading.Thread(target=update) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.stats.get_value('history/test/count'), 16000)
+        self.assertEqual(self.stats.get_value('history/test/size/count'), 16000)
+        self.assertEqual(self.stats.get_value('history/test/size/sum'), 16000)
+
+    def test_timed_iter(self):
+        self.assertEqual(list(self.metrics.timed_iter('history/record/encode', 'ab')), ['a', 'b'])
+        self.assertEqual(self.stats.get_value('history/record/encode/count'), 1)
+
+    def test_sink(self):
+        self.metrics.inc('history/retrieve/miss')
+        with self.metrics.timer('history/retrieve/latency'):
+            pass
+        events = self.metrics.sink.events
+        self.assertEqual(events[0], ('increment', 'history/retrieve/miss', 1))
+        self.assertEqual(events[1][:2], ('observe', 'history/retrieve/latency'))
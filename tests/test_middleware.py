@@ -1,14 +1,24 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import absolute_import, unicode_literals
+import shutil
+import tempfile
 import unittest
 from datetime import datetime
 
 from scrapy.exceptions import NotConfigured
+from scrapy.http import HtmlResponse, Request
+from scrapy.spiders import Spider
 from scrapy.utils.test import get_crawler
+from twisted.internet import defer
 
 from history.middleware import HistoryMiddleware
 
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
 MANDATORY_SETTINGS = ['HISTORY_S3_BUCKET',
                       'AWS_ACCESS_KEY_ID',
                       'AWS_SECRET_ACCESS_KEY']
@@ -34,5 +44,69 @@ class TestHistoryMiddleware(unittest.TestCase):
         some_dt = datetime.now()
         self.assertEqual(HistoryMiddleware.parse_epoch(some_dt), some_dt)
 
+    def test_parse_date_epoch(self):
+        self.assertEqual(HistoryMiddleware.parse_epoch('20180102'), datetime(2018, 1, 2))
+        self.assertEqual(HistoryMiddleware.parse_epoch('2018-01-02'), datetime(2018, 1, 2))
+        self.assertEqual(HistoryMiddleware.parse_epoch('2018-01-02T03:04:05'),
+                         datetime(2018, 1, 2, 3, 4, 5))
+
     def test_parse_human_epoch(self):
         self.assertIsInstance(self.middleware.parse_epoch('yesterday'), datetime)
+
+
+class TestHistoricResponses(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        crawler = get_crawler(settings_dict={
+            'HISTORY_BACKEND': 'history.storage.FilesystemCacheStorage',
+            'HISTORY_FS_DIR': self.tmpdir,
+            'HISTORY_EPOCH': True,
+            'HISTORY_RETRIEVE_IF': 'history.logic.RetrieveAlways',
+        })
+        crawler.stats.set_value('start_time', datetime(2018, 1, 1))
+        self.spider = Spider('example')
+        self.middleware = HistoryMiddleware(crawler)
+        self.middleware.spider_opened(self.spider)
+
+    def tearDown(self):
+        self.middleware.spider_closed(self.spider)
+        shutil.rmtree(self.tmpdir)
+
+    def _result(self, d):
+        results = []
+        d.addBoth(results.append)
+        return results[0]
+
+    def test_retrieve_async(self):
+        request = Request('http://example.com')
+        response = HtmlResponse(request.url, body=b'body', encoding='utf-8', request=request)
+        self._result(self.middleware.process_response(request, response, self.spider))
+
+        historic = self._result(self.middleware.process_request(request, self.spider))
+        self.assertEqual(historic.body, b'body')
+        self.assertIn('historic', historic.flags)
+
+        stats = self.middleware.stats
+        self.assertEqual(stats.get_value('history/retrieve/hit'), 1)
+        self.assertEqual(stats.get_value('history/retrieve/bytes/sum'), 4)
+        self.assertEqual(stats.get_value('history/store/stored'), 1)
+        self.assertEqual(stats.get_value('history/store/latency/count'), 1)
+
+    def test_store_deferred_decision(self):
+        request = Request('http://example.com')
+        response = HtmlResponse(request.url, body=b'body', encoding='utf-8', request=request)
+        stats = self.middleware.stats
+        with mock.patch.object(self.middleware, 'store_if', return_value=defer.succeed(False)):
+            self.assertIs(self._result(self.middleware.process_response(
+                request, response, self.spider)), response)
+        self.assertEqual(stats.get_value('history/store/skipped'), 1)
+
+        with mock.patch.object(self.middleware, 'store_if', return_value=defer.succeed(True)):
+            self.assertIs(self._result(self.middleware.process_response(
+                request, response, self.spider)), response)
+        self.assertEqual(stats.get_value('history/store/stored'), 1)
+
+    def test_retrieve_async_missing(self):
+        request = Request('http://example.com/missing')
+        self.assertIsNone(self._result(self.middleware.process_request(request, self.spider)))
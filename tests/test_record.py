@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+import unittest
+
+from scrapy.exceptions import NotConfigured
+from scrapy.http import HtmlResponse, Request, Response
+from scrapy.settings import Settings
+
+from history.record import (
+    RecordCodec,
+    _try_decoding_response_body,
+    body_digest,
+    body_length,
+    decode_record,
+    detect_encoding,
+    is_binary_record,
+    read_record_lazy,
+)
+
+
+class TestRecordCodec(unittest.TestCase):
+
+    def setUp(self):
+        self.request = Request('http://example.com/page', method='POST', body=b'\xff\x00')
+        self.html = HtmlResponse('http://example.com/page',
+                                 body='<p>caf\xe9</p>'.encode('latin-1'),
+                                 headers={'Content-Type': 'text/html; charset=latin-1',
+                                          'Set-Cookie': ['a=1', 'b=2']})
+        self.pdf = Response('http://example.com/file.pdf', body=b'%PDF\x00\xff',
+                            headers={'Content-Type': 'application/pdf'})
+
+    def _roundtrip(self, response, **settings):
+        codec = RecordCodec(Settings(settings))
+        data_string, metadata = codec.encode(self.request, response)
+        self.assertEqual(metadata['status'], 200)
+        return data_string, decode_record(data_string)
+
+    def test_binary_text_response(self):
+        for compression in ('gzip', 'none'):
+            data_string, response = self._roundtrip(self.html, HISTORY_COMPRESSION=compression)
+            self.assertTrue(is_binary_record(data_string))
+            self.assertIsInstance(response, HtmlResponse)
+            self.assertEqual(response.body, self.html.body)
+            self.assertEqual(response.encoding, 'cp1252')
+            self.assertEqual(response.text, '<p>caf\xe9</p>')
+            self.assertEqual(response.headers.getlist('Set-Cookie'), [b'a=1', b'b=2'])
+
+    def test_binary_binary_response(self):
+        _, response = self._roundtrip(self.pdf)
+        self.assertEqual(response.body, self.pdf.body)
+        self.assertEqual(response.url, self.pdf.url)
+
+    def test_compression(self):
+        body = b'<p>hello</p>' * 1000
+        html = self.html.replace(body=body)
+        compressed, _ = self._roundtrip(html)
+        raw, _ = self._roundtrip(html, HISTORY_COMPRESSION='none')
+        self.assertLess(len(compressed), len(raw) / 10)
+
+    def test_body_reference(self):
+        codec = RecordCodec(Settings())
+        digest = body_digest(self.pdf.body)
+        data_string, _ = codec.encode(self.request, self.pdf, body_ref=digest)
+        self.assertNotIn(self.pdf.body, data_string)
+
+        response = decode_record(data_string, resolve_body={digest: self.pdf.body}.get)
+        self.assertEqual(response.body, self.pdf.body)
+        with self.assertRaises(ValueError):
+            decode_record(data_string)
+
+    def test_json_format_still_readable(self):
+        self.request = Request('http://example.com/page')
+        html = self.html.replace(body=b'<p>hello</p>', encoding='utf-8')
+        data_string, response = self._roundtrip(html, HISTORY_RECORD_FORMAT='json')
+        self.assertFalse(is_binary_record(data_string))
+        self.assertEqual(response.body, b'<p>hello</p>')
+
+    def test_json_keeps_original_bytes(self):
+        self.request = Request('http://example.com/page')
+        _, response = self._roundtrip(self.html, HISTORY_RECORD_FORMAT='json')
+        self.assertEqual(response.body, self.html.body)
+        self.assertEqual(response.text, '<p>caf\xe9</p>')
+
+        _, response = self._roundtrip(self.pdf, HISTORY_RECORD_FORMAT='json')
+        self.assertEqual(response.body, self.pdf.body)
+
+    def test_unknown_encoding(self):
+        self.request = Request('http://example.com/page')
+        html = self.html.replace(encoding='x-unknown')
+        for record_format in ('binary', 'json'):
+            _, response = self._roundtrip(html, HISTORY_RECORD_FORMAT=record_format)
+            self.assertEqual(response.body, self.html.body)
+
+    def test_legacy_json_record(self):
+        data_string = (b'{"binary": false, "metadata": {"url": "http://example.com/", '
+                       b'"response_url": "http://example.com/", "status": 200}, '
+                       b'"response_headers": {"Content-Type": "text/html"}, '
+                       b'"response_body": "caf\\u00e9"}')
+        self.assertEqual(decode_record(data_string).body, 'caf\xe9'.encode('utf-8'))
+
+    def test_lazy_body(self):
+        data_string, _ = self._roundtrip(self.html)
+        reads = []
+
+        def read_from(offset):
+            reads.append(offset)
+            return data_string[offset:]
+
+        response = read_record_lazy(data_string[:len(data_string) - 2], read_from)
+        self.assertIsInstance(response, HtmlResponse)
+        self.assertEqual(response.headers.getlist('Set-Cookie'), [b'a=1', b'b=2'])
+        self.assertEqual(body_length(response), len(self.html.body))
+        self.assertEqual(reads, [])
+        self.assertEqual(response.text, '<p>caf\xe9</p>')
+        self.assertEqual(reads, [len(data_string) - 2])
+        self.assertEqual(response.replace(status=404).body, self.html.body)
+
+    def test_lazy_partial_metadata(self):
+        data_string, _ = self._roundtrip(self.pdf)
+        response = read_record_lazy(data_string[:8], lambda offset: data_string[offset:])
+        self.assertEqual(response.body, self.pdf.body)
+        self.assertEqual(read_record_lazy(data_string).body, self.pdf.body)
+
+        self.request = Request('http://example.com/file.pdf')
+        data_string, _ = self._roundtrip(self.pdf, HISTORY_RECORD_FORMAT='json')
+        response = read_record_lazy(data_string[:8], lambda offset: data_string[offset:])
+        self.assertEqual(response.body, self.pdf.body)
+
+    def test_unknown_settings(self):
+        with self.assertRaises(NotConfigured):
+            RecordCodec(Settings({'HISTORY_RECORD_FORMAT': 'xml'}))
+        with self.assertRaises(NotConfigured):
+            RecordCodec(Settings({'HISTORY_COMPRESSION': 'lzma'}))
+
+
+class TestEncoding(unittest.TestCase):
+
+    def test_detect_declared_encoding(self):
+        html = HtmlResponse('http://example.com', body=b'<p>caf\xe9</p>',
+                            headers={'Content-Type': 'text/html; charset=latin-1'})
+        self.assertEqual(detect_encoding(html), 'cp1252')
+        # the body was not decoded to find it
+        self.assertIsNone(getattr(html, '_cached_ubody', None))
+
+    def test_detect_inferred_encoding(self):
+        html = HtmlResponse('http://example.com', body=b'<p>hello</p>')
+        html.text
+        self.assertEqual(detect_encoding(html), html.encoding)
+
+    def test_detect_binary_response(self):
+        self.assertIsNone(detect_encoding(Response('http://example.com', body=b'\x00')))
+
+    def test_decoding_fallbacks(self):
+        body = 'caf\xe9'.encode('utf-8')
+        self.assertEqual(_try_decoding_response_body(body, 'utf-8'), ('utf-8', 'caf\xe9'))
+        self.assertEqual(_try_decoding_response_body(body, 'ascii'), ('utf-8', 'caf\xe9'))
+        self.assertEqual(_try_decoding_response_body(b'caf\xe9', None),
+                         ('latin-1', 'caf\xe9'))
+        self.assertEqual(_try_decoding_response_body(body, 'x-unknown'), ('utf-8', 'caf\xe9'))
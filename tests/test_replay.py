@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+from datetime import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from scrapy.exceptions import NotConfigured
+from scrapy.http import HtmlResponse, Request
+from scrapy.settings import Settings
+from scrapy.spiders import Spider
+from scrapy.utils.request import request_fingerprint
+from scrapy.utils.test import get_crawler
+
+from history.archive import ArchiveWriter, dump_index
+from history.record import RecordCodec
+from history.replay import ReplayStorage
+
+JOB = 'example/2018-01-01T00-00-00_1_2_3'
+
+
+class TestReplayStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.spider = Spider('example')
+        self.request = Request('http://example.com/page')
+        self._write_archive([(self.request, b'replayed')])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write_archive(self, pairs):
+        """Write the archive a previous replay of JOB would have built."""
+        codec = RecordCodec(Settings())
+        path = os.path.join(self.tmpdir, JOB)
+        os.makedirs(os.path.dirname(path))
+        writer = ArchiveWriter(path + '.arc')
+        for request, body in pairs:
+            response = HtmlResponse(request.url, body=body, encoding='utf-8')
+            writer.append(request_fingerprint(request), 1.0, codec.encode(request, response)[0])
+        with open(path + '.idx', 'wb') as f:
+            f.write(dump_index(writer.close(), job=JOB))
+
+    def _storage(self, job, aws=True):
+        settings_dict = {
+            'HISTORY_REPLAY_DIR': self.tmpdir,
+            'HISTORY_REPLAY_JOB': job,
+        }
+        if aws:
+            settings_dict.update({
+                'HISTORY_S3_BUCKET': 'bucket',
+                'AWS_ACCESS_KEY_ID': 'key',
+                'AWS_SECRET_ACCESS_KEY': 'secret',
+            })
+        crawler = get_crawler(settings_dict=settings_dict)
+        crawler.stats.set_value('start_time', datetime(2018, 1, 2))
+        storage = ReplayStorage(crawler.stats, crawler.settings)
+        storage.open_spider(self.spider)
+        self.addCleanup(storage.close_spider, self.spider)
+        return storage
+
+    def test_replay_from_local_archive(self):
+        for job in (JOB, '1/2/3'):
+            storage = self._storage(job)
+            response = storage.retrieve_response(self.spider, self.request)
+            self.assertEqual(response.body, b'replayed')
+            self.assertIsNone(storage.retrieve_response(self.spider, Request('http://example.com')))
+
+    def test_replay_offline(self):
+        storage = self._storage(JOB, aws=False)
+        self.assertEqual(storage.retrieve_response(self.spider, self.request).body, b'replayed')
+        # S3 is needed for jobs not archived yet
+        self.assertRaises(NotConfigured, self._storage, 'example/2018-02-01T00-00-00_4_5_6',
+                          aws=False)
+
+    def test_never_stores(self):
+        storage = self._storage(JOB)
+        response = HtmlResponse(self.request.url, body=b'new', encoding='utf-8')
+        storage.store_response(self.spider, self.request, response)
+        self.assertEqual(storage.retrieve_response(self.spider, self.request).body, b'replayed')
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+import threading
+import time
+import unittest
+
+from boto.s3.connection import OrdinaryCallingFormat, S3Connection
+from scrapy.utils.test import get_crawler
+
+from history.metrics import Metrics
+from history.s3 import PooledS3Connection, _operation, connect, parse_endpoint, single_attempt
+
+
+def request(method, path):
+    return type(str('Request'), (object,), {'method': method, 'path': path})
+
+
+class Response(object):
+    """An HTTP response whose body is read in one go."""
+
+    def __init__(self, body):
+        self.body = body
+
+    def read(self, amt=None):
+        body, self.body = self.body, None
+        return body or b''
+
+    def close(self):
+        self.body = None
+
+    def isclosed(self):
+        return self.body is None
+
+
+class TestS3Connection(unittest.TestCase):
+
+    def test_parse_endpoint(self):
+        params = parse_endpoint('http://localhost:9000')
+        self.assertEqual((params['host'], params['port'], params['is_secure']),
+                         ('localhost', 9000, False))
+        self.assertIsInstance(params['calling_format'], OrdinaryCallingFormat)
+        self.assertTrue(parse_endpoint('s3.example.com')['is_secure'])
+
+    def test_operation(self):
+        self.assertEqual(_operation(request('GET', '/?versions&prefix=spider/cache/')), 'list')
+        self.assertEqual(_operation(request('GET', '/spider/cache/ab?versionId=1')), 'get')
+        self.assertEqual(_operation(request('PUT', '/spider/cache/ab')), 'put')
+
+    def test_connect(self):
+        connection = connect('key', 'secret', endpoint='http://localhost:9000', retries=2)
+        self.assertEqual(connection.host, 'localhost')
+        self.assertEqual(connection.port, 9000)
+        self.assertEqual(connection.num_retries, 2)
+        self.assertFalse(connection.use_proxy)
+
+    def test_max_connections(self):
+        crawler = get_crawler()
+        connection = PooledS3Connection('key', 'secret', max_connections=2)
+        connection.metrics = Metrics(crawler.stats, crawler.settings)
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def _mexe(self, *args, **kwargs):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+
+        original = S3Connection._mexe
+        S3Connection._mexe = _mexe
+        try:
+            workers = [threading.Thread(target=connection._mexe, args=(request('PUT', '/key'),))
+                       for _ in range(6)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        finally:
+            S3Connection._mexe = original
+
+        self.assertEqual(running[1], 2)
+        self.assertEqual(crawler.stats.get_value('history/s3/put/count'), 6)
+        self.assertEqual(crawler.stats.get_value('history/s3/wait/count'), 6)
+
+    def _patch_mexe(self, result):
+        original = S3Connection._mexe
+        S3Connection._mexe = lambda self, *args, **kwargs: result(*args, **kwargs)
+        self.addCleanup(setattr, S3Connection, '_mexe', original)
+
+    def test_slot_held_until_read(self):
+        connection = PooledS3Connection('key', 'secret', max_connections=1)
+        self._patch_mexe(lambda *args, **kwargs: Response(b'body'))
+
+        response = connection._mexe(request('GET', '/key'))
+        self.assertFalse(connection.slots.acquire(False))
+        self.assertEqual(response.read(), b'body')
+        self.assertTrue(connection.slots.acquire(False))
+        connection.slots.release()
+
+        connection._mexe(request('GET', '/key')).close()
+        self.assertTrue(connection.slots.acquire(False))
+        connection.slots.release()
+
+        # responses read by boto already
+        response = Response(b'')
+        response.read()
+        self._patch_mexe(lambda *args, **kwargs: response)
+        connection._mexe(request('PUT', '/key'))
+        self.assertTrue(connection.slots.acquire(False))
+
+    def test_single_attempt(self):
+        connection = PooledS3Connection('key', 'secret')
+        retries = []
+
+        def _mexe(request, sender=None, override_num_retries=None, retry_handler=None):
+            retries.append(override_num_retries)
+
+        self._patch_mexe(_mexe)
+        connection._mexe(request('PUT', '/key'))
+        with single_attempt():
+            connection._mexe(request('PUT', '/key'))
+        connection._mexe(request('PUT', '/key'), None, 2)
+        self.assertEqual(retries, [None, 0, 2])
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+from datetime import datetime
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from scrapy.exceptions import NotConfigured
+
+from history.index import VersionIndex, _to_timestamp
+from history.shared import SharedVersionIndex, SQLiteBackend, open_backend
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class TestSharedVersionIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'index.db')
+        self.backends = []
+        self.index = self.open_index()
+        self.jan = _to_timestamp(datetime(2018, 1, 1))
+        self.feb = _to_timestamp(datetime(2018, 2, 1))
+
+    def tearDown(self):
+        for backend in self.backends:
+            backend.close()
+        shutil.rmtree(self.tmpdir)
+
+    def open_index(self, miss_ttl=3600):
+        # each index stands for a worker with its own connection
+        backend = SQLiteBackend(self.path)
+        self.backends.append(backend)
+        return SharedVersionIndex(backend, 'sp/index', shard_width=1, miss_ttl=miss_ttl)
+
+    def test_shared_versions(self):
+        other = self.open_index()
+        self.index.add('a1', self.feb, 'v2')
+        other.add('a1', self.jan, 'v1')
+        self.assertIn('a1', other)
+        self.assertEqual(self.index.get('a1'), [(self.jan, 'v1'), (self.feb, 'v2')])
+        self.assertEqual(other.lookup('a1', datetime(2017, 1, 1)), (self.jan, 'v1'))
+        self.assertEqual(other.timestamps(), {'a1': self.feb})
+        # only the versions added by a worker are saved by it
+        self.assertEqual(self.index.shards, {'a': {'a1': [(self.feb, 'v2')]}})
+
+    def test_shared_digests(self):
+        self.index.set_digest('a1', 'd1')
+        self.assertEqual(self.open_index().digest('a1'), 'd1')
+        self.assertEqual(self.index.dirty, {'a'})
+
+    def test_set_versions(self):
+        other = self.open_index()
+        self.index.add('a1', self.jan, 'v1')
+        self.index.add('a1', self.feb, 'v2')
+        other.set_versions('a1', [(self.feb, 'v2')])
+        self.assertEqual(self.index.get('a1'), [(self.feb, 'v2')])
+
+        other.clear_versions('a1')
+        # known without versions, until stored again
+        self.assertIn('a1', self.index)
+        self.assertIsNone(self.index.lookup('a1', True))
+        self.assertEqual(self.index.timestamps(), {})
+        self.index.add('a1', self.jan, 'v3')
+        self.assertEqual(other.get('a1'), [(self.jan, 'v3')])
+
+    def test_misses(self):
+        other = self.open_index()
+        self.assertNotIn('a1', self.index)
+        self.index.add_missing('a1')
+        self.assertIn('a1', other)
+        self.assertIsNone(other.lookup('a1', True))
+        other.add('a1', self.jan, 'v1')
+        self.assertEqual(self.index.lookup('a1', True), (self.jan, 'v1'))
+
+    def test_expired_misses(self):
+        index = self.open_index(miss_ttl=-1)
+        index.add_missing('a1')
+        self.assertNotIn('a1', index)
+
+    def test_seed(self):
+        version_index = VersionIndex(shard_width=1)
+        version_index.add('a1', self.jan, 'v1')
+        version_index.set_digest('a1', 'd0')
+        self.index.set_digest('a1', 'd1')
+        self.assertFalse(self.index.backend.is_seeded('sp/index'))
+        self.index.seed(version_index)
+        self.assertTrue(self.index.backend.is_seeded('sp/index'))
+        self.assertEqual(self.index.get('a1'), [(self.jan, 'v1')])
+        self.assertEqual(self.index.digest('a1'), 'd1')
+        self.assertFalse(self.open_index().backend.is_seeded('sp/other'))
+
+    def test_open_backend(self):
+        backend = open_backend('sqlite:///' + self.path)
+        self.backends.append(backend)
+        self.assertEqual(backend.path, self.path)
+        self.assertRaises(NotConfigured, open_backend, 'memcached://localhost')
+
+    def test_open_redis_backend(self):
+        # redis is imported by the Redis backend only
+        with mock.patch.dict(sys.modules, {'redis': None}):
+            self.assertRaises(NotConfigured, open_backend, 'redis://localhost:6379/0')
+        redis = mock.Mock()
+        with mock.patch.dict(sys.modules, {'redis': redis}):
+            backend = open_backend('redis://localhost:6379/0', prefix='test:')
+        redis.StrictRedis.from_url.assert_called_once_with('redis://localhost:6379/0')
+        self.assertEqual(backend._key('sp/index', 'latest'), 'test:sp/index:latest')
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+from datetime import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from boto.exception import S3ResponseError
+from scrapy.http import HtmlResponse, Request
+from scrapy.spiders import Spider
+from scrapy.utils.test import get_crawler
+
+from history.archive import INDEX_SUFFIX, load_index
+from history.spool import JOB_SUFFIX, S3SpoolStorage
+from history.storage import MANDATORY_SETTINGS, S3CacheStorage
+import s3stub
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class TestS3SpoolStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def _storage(self, job):
+        """A storage spooling into tmpdir, as if opened by job."""
+        settings_dict = {k: 'mock setting' for k in MANDATORY_SETTINGS}
+        settings_dict['HISTORY_SPOOL_DIR'] = self.tmpdir
+        crawler = get_crawler(settings_dict=settings_dict)
+        storage = S3SpoolStorage(crawler.stats, crawler.settings)
+        storage.spider_spool_dir = self.tmpdir
+        storage.save_source = job
+        storage.writer = mock.Mock()
+        return storage
+
+    def _index_metadata(self, sealed_path):
+        with open(sealed_path[:-len('.seg')] + INDEX_SUFFIX, 'rb') as f:
+            return load_index(f.read())
+
+    def test_recover_with_job_of_segment(self):
+        crashed = self._storage('example/job1')
+        segment = crashed._open_segment()
+        segment.append('a1', 1.0, b'record')
+        segment.close()
+
+        storage = self._storage('example/job2')
+        storage._recover()
+        sealed_path = storage.writer.submit.call_args[0][2]
+        entries, metadata = self._index_metadata(sealed_path)
+        self.assertEqual(metadata, {'job': 'example/job1'})
+        self.assertEqual([entry[0] for entry in entries], ['a1'])
+        self.assertFalse([name for name in os.listdir(self.tmpdir)
+                          if name.endswith(JOB_SUFFIX)])
+
+    def test_recover_without_job(self):
+        segment = self._storage('example/job1')._open_segment()
+        segment.append('a1', 1.0, b'record')
+        segment.close()
+        os.remove(segment.path[:-len('.seg.open')] + JOB_SUFFIX)
+
+        storage = self._storage('example/job2')
+        storage._recover()
+        _, metadata = self._index_metadata(storage.writer.submit.call_args[0][2])
+        # rather than the job of the crawl recovering it
+        self.assertEqual(metadata, {})
+
+    def test_orphan_job_removed(self):
+        path = os.path.join(self.tmpdir, '1-abc' + JOB_SUFFIX)
+        with open(path, 'w') as f:
+            f.write('example/job1')
+        storage = self._storage('example/job2')
+        storage._recover()
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(storage.writer.submit.called)
+
+
+class TestSpoolRoundTrip(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.spider = Spider('example')
+        self.connection = s3stub.connection()
+        self.bucket = self.connection.bucket
+        patcher = mock.patch('history.s3.connect', return_value=self.connection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # uploads run right away rather than on the writer pool
+        patcher = mock.patch('history.storage.BoundedWriter')
+        self.writer = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.writer.submit.side_effect = lambda func, *args: func(*args)
+        self.writer.retries = 0
+
+    def _crawler(self, **settings):
+        settings_dict = {k: 'mock setting' for k in MANDATORY_SETTINGS}
+        settings_dict['HISTORY_SPOOL_DIR'] = self.tmpdir
+        settings_dict.update(settings)
+        crawler = get_crawler(settings_dict=settings_dict)
+        crawler.stats.set_value('start_time', datetime(2018, 1, 1))
+        return crawler
+
+    def _spool(self, pairs):
+        crawler = self._crawler()
+        storage = S3SpoolStorage(crawler.stats, crawler.settings)
+        storage.open_spider(self.spider)
+        self.addCleanup(storage.close_spider, self.spider)
+        for url, body in pairs:
+            request = Request(url)
+            storage.store_response(self.spider, request,
+                                   HtmlResponse(url, body=body, encoding='utf-8'))
+        return storage
+
+    def _retrieve(self, url):
+        crawler = self._crawler()
+        storage = S3CacheStorage(crawler.stats, crawler.settings)
+        storage.open_spider(self.spider)
+        return storage.retrieve_response(self.spider, Request(url, meta={'epoch': True}))
+
+    def _segments(self):
+        return sorted(name for name in self.bucket.objects
+                      if name.startswith('example/segments/'))
+
+    def test_seal_stale_segment(self):
+        storage = self._spool([('http://example.com/a', b'a'), ('http://example.com/b', b'b')])
+        storage._seal_if_stale()
+        self.assertEqual(self._segments(), [])
+
+        storage.segment.created -= storage.segment_age
+        storage._seal_if_stale()
+        self.assertIsNone(storage.segment)
+        segment, index = self._segments()
+        self.assertEqual(index, segment + INDEX_SUFFIX)
+        entries, metadata = load_index(self.bucket.get_key(index).get_contents_as_string())
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(metadata, {'job': storage.save_source})
+        # uploaded segments are removed from the spool
+        self.assertFalse([name for name in os.listdir(storage.spider_spool_dir)
+                          if not name.endswith(JOB_SUFFIX)])
+
+        self.assertEqual(self._retrieve('http://example.com/a').body, b'a')
+        self.assertEqual(self._retrieve('http://example.com/b').body, b'b')
+        self.assertIsNone(self._retrieve('http://example.com/c'))
+
+    def test_seal_on_close(self):
+        storage = self._spool([('http://example.com/a', b'first')])
+        storage.close_spider(self.spider)
+        self.assertEqual(len(self._segments()), 2)
+        self.assertEqual(self._retrieve('http://example.com/a').body, b'first')
+
+    def test_retried_upload(self):
+        def submit(func, *args):
+            try:
+                func(*args)
+            except S3ResponseError:
+                func(*args)
+        self.writer.submit.side_effect = submit
+        put = s3stub.Key.set_contents_from_filename
+        failures = [S3ResponseError(500, 'Internal Error')]
+
+        # the index upload fails once, after the segment is uploaded
+        def put_index(key, filename, headers=None):
+            if key.name.endswith(INDEX_SUFFIX) and failures:
+                raise failures.pop()
+            return put(key, filename, headers)
+
+        with mock.patch.object(s3stub.Key, 'set_contents_from_filename', put_index):
+            storage = self._spool([('http://example.com/a', b'first')])
+            storage.close_spider(self.spider)
+        self.assertFalse(failures)
+        self.assertEqual([len(self.bucket.objects[name]) for name in self._segments()], [1, 1])
+        self.assertEqual(self._retrieve('http://example.com/a').body, b'first')
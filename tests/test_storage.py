@@ -0,0 +1,524 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+from datetime import datetime, timedelta
+import os
+import shutil
+import tempfile
+import unittest
+
+from boto.exception import S3ResponseError
+from scrapy.http import HtmlResponse, Request
+from scrapy.spiders import Spider
+from scrapy.utils.test import get_crawler
+
+from history import s3
+from history.archive import ArchiveWriter, dump_index
+from history.index import _select_version, _to_timestamp
+from history.lru import LRUCache
+from history.record import body_digest
+from history.storage import (
+    DIGEST_SUFFIX,
+    MANDATORY_SETTINGS,
+    FilesystemCacheStorage,
+    S3CacheStorage,
+    _template_fields,
+    cache_key,
+)
+import s3stub
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class TestSelectVersion(unittest.TestCase):
+
+    def setUp(self):
+        self.versions = [(_to_timestamp(datetime(2018, month, 1)), month) for month in (1, 2, 3)]
+
+    def test_most_recent_without_epoch(self):
+        self.assertEqual(_select_version(self.versions, True)[1], 3)
+
+    def test_first_version_after_epoch(self):
+        self.assertEqual(_select_version(self.versions, datetime(2017, 6, 1))[1], 1)
+        self.assertEqual(_select_version(self.versions, datetime(2018, 1, 15))[1], 2)
+        self.assertEqual(_select_version(self.versions, datetime(2018, 2, 1))[1], 2)
+
+    def test_most_recent_when_all_older(self):
+        self.assertEqual(_select_version(self.versions, datetime(2019, 1, 1))[1], 3)
+
+    def test_no_version(self):
+        self.assertIsNone(_select_version([], True))
+
+
+class TestCacheKey(unittest.TestCase):
+
+    def test_layouts(self):
+        fingerprint = '0805a1b2c3'
+        self.assertEqual(cache_key('example', fingerprint), 'example/cache/0805a1b2c3')
+        self.assertEqual(cache_key('example', fingerprint, 2), 'example/cache/08/0805a1b2c3')
+
+
+class TestTemplateFields(unittest.TestCase):
+
+    def test_fields(self):
+        self.assertEqual(_template_fields('{name}/{time}_{jobid}'), {'name', 'time', 'jobid'})
+        self.assertEqual(_template_fields('{settings.BOT_NAME}/{args[0]}/{{x}}'),
+                         {'settings', 'args'})
+
+
+class TestFilesystemCacheStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        crawler = get_crawler(settings_dict={'HISTORY_FS_DIR': self.tmpdir})
+        crawler.stats.set_value('start_time', datetime(2018, 1, 1))
+        self.spider = Spider('example')
+        self.storage = FilesystemCacheStorage(crawler.stats, crawler.settings)
+        self.storage.open_spider(self.spider)
+
+    def tearDown(self):
+        self.storage.close_spider(self.spider)
+        shutil.rmtree(self.tmpdir)
+
+    def _response(self, request, body):
+        return HtmlResponse(request.url, body=body, encoding='utf-8', request=request,
+                            headers={'Content-Type': 'text/html; charset=utf-8'})
+
+    def test_missing(self):
+        request = Request('http://example.com', meta={'epoch': True})
+        self.assertIsNone(self.storage.retrieve_response(self.spider, request))
+
+    def test_retrieve_most_recent(self):
+        request = Request('http://example.com', meta={'epoch': True})
+        self.storage.store_response(self.spider, request, self._response(request, b'first'))
+        self.storage.store_response(self.spider, request, self._response(request, b'second'))
+
+        response = self.storage.retrieve_response(self.spider, request)
+        self.assertEqual(response.body, b'second')
+        self.assertEqual(response.url, request.url)
+        self.assertEqual(response.status, 200)
+
+    def test_retrieve_by_epoch(self):
+        request = Request('http://example.com', meta={'epoch': datetime(2000, 1, 1)})
+        self.storage.store_response(self.spider, request, self._response(request, b'first'))
+        self.storage.store_response(self.spider, request, self._response(request, b'second'))
+
+        response = self.storage.retrieve_response(self.spider, request)
+        self.assertEqual(response.body, b'first')
+
+    def test_save_source(self):
+        self.assertEqual(self.storage.save_source, 'example/2018-01-01T00-00-00_')
+
+        crawler = get_crawler(settings_dict={
+            'HISTORY_FS_DIR': self.tmpdir,
+            'HISTORY_SAVE_SOURCE': '{name}/{region}',
+        })
+        storage = FilesystemCacheStorage(crawler.stats, crawler.settings)
+        self.spider.region = 'eu'
+        storage.open_spider(self.spider)
+        self.assertEqual(storage.save_source, 'example/eu')
+
+    def test_fingerprinter(self):
+        crawler = get_crawler(settings_dict={
+            'HISTORY_FS_DIR': self.tmpdir,
+            'HISTORY_FINGERPRINT_IGNORE_PARAMS': ['sid'],
+        })
+        crawler.stats.set_value('start_time', datetime(2018, 1, 1))
+        storage = FilesystemCacheStorage(crawler.stats, crawler.settings)
+        storage.open_spider(self.spider)
+
+        request = Request('http://example.com/?sid=1')
+        storage.store_response(self.spider, request, self._response(request, b'first'))
+        retrieved = storage.retrieve_response(
+            self.spider, Request('http://example.com/?sid=2', meta={'epoch': True}))
+        self.assertEqual(retrieved.body, b'first')
+
+    def test_last_digest(self):
+        request = Request('http://example.com')
+        self.assertIsNone(self.storage.last_digest(self.spider, request))
+        self.storage.store_response(self.spider, request, self._response(request, b'first'))
+        self.assertEqual(self.storage.last_digest(self.spider, request), body_digest(b'first'))
+
+        # records stored without a digest file are read instead
+        key_dir = self.storage._get_key_dir(
+            self.storage._get_request_storage_key(self.spider, request))
+        for name in os.listdir(key_dir):
+            if name.endswith(DIGEST_SUFFIX):
+                os.remove(os.path.join(key_dir, name))
+        self.assertEqual(self.storage.last_digest(self.spider, request), body_digest(b'first'))
+
+
+class TestS3CacheStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.spider = Spider('example')
+        self.connection = s3stub.connection()
+        self.bucket = self.connection.bucket
+        patcher = mock.patch('history.s3.connect', return_value=self.connection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _storage(self, **settings):
+        settings_dict = {k: 'mock setting' for k in MANDATORY_SETTINGS}
+        settings_dict.update(settings)
+        crawler = get_crawler(settings_dict=settings_dict)
+        crawler.stats.set_value('start_time', datetime(2018, 1, 1))
+        storage = S3CacheStorage(crawler.stats, crawler.settings)
+        storage.open_spider(self.spider)
+        return storage
+
+    def _response(self, request, body):
+        return HtmlResponse(request.url, body=body, encoding='utf-8', request=request,
+                            headers={'Content-Type': 'text/html; charset=utf-8'})
+
+    def test_round_trip(self):
+        storage = self._storage()
+        request = Request('http://example.com', meta={'epoch': True})
+        self.assertIsNone(storage.retrieve_response(self.spider, request))
+        storage.store_response(self.spider, request, self._response(request, b'first'))
+        storage.store_response(self.spider, request, self._response(request, b'second'))
+
+        response = storage.retrieve_response(self.spider, request)
+        self.assertEqual(response.body, b'second')
+        self.assertEqual(response.url, request.url)
+        # cache key and source copy
+        self.assertEqual(len(self.bucket.objects), 2)
+        self.assertFalse(self.bucket.uploads)
+
+        old_request = Request('http://example.com', meta={'epoch': datetime(2000, 1, 1)})
+        self.assertEqual(storage.retrieve_response(self.spider, old_request).body, b'first')
+
+    def test_last_digest_async(self):
+        request = Request('http://example.com')
+        storage = self._storage()
+        storage.store_response(self.spider, request, self._response(request, b'first'))
+
+        digests = []
+        with mock.patch.object(self.bucket, 'get_key', wraps=self.bucket.get_key) as get_key:
+            storage.last_digest_async(self.spider, request).addCallback(digests.append)
+            self.assertFalse(get_key.called)
+            # a new crawl knows nothing of the digest, and asks S3 once
+            other = self._storage()
+            other.last_digest_async(self.spider, request).addCallback(digests.append)
+            other.last_digest_async(self.spider, request).addCallback(digests.append)
+            self.assertEqual(get_key.call_count, 1)
+        self.assertEqual(digests, [body_digest(b'first')] * 3)
+
+    def test_writes_made_once_when_retried(self):
+        storage = self._storage()
+        attempts = []
+
+        def write():
+            attempts.append(getattr(s3._attempts, 'single', False))
+
+        storage._write(write)
+        storage.writer = mock.Mock(retries=3)
+        storage._write(write)
+        storage.writer.retries = 0
+        storage._write(write)
+        self.assertEqual(attempts, [False, True, False])
+
+    def test_single_part_below_threshold(self):
+        storage = self._storage(HISTORY_STREAMING_THRESHOLD=1024)
+        request = Request('http://example.com', meta={'epoch': True})
+        with mock.patch.object(self.bucket, 'initiate_multipart_upload') as initiate:
+            storage.store_response(self.spider, request, self._response(request, b'x' * 1023))
+        self.assertFalse(initiate.called)
+        self.assertEqual(storage.retrieve_response(self.spider, request).body, b'x' * 1023)
+
+    def test_multipart_above_threshold(self):
+        storage = self._storage(HISTORY_STREAMING_THRESHOLD=1024)
+        # below the 5 MB minimum of S3, which the stub doesn't enforce
+        storage.streaming_part_size = 1024 * 1024
+        request = Request('http://example.com', meta={'epoch': True})
+        # incompressible, records are encoded by 1 MB chunks
+        body = os.urandom(3 * 1024 * 1024)
+        uploads = []
+        initiate = self.bucket.initiate_multipart_upload
+
+        def record_upload(*args, **kwargs):
+            uploads.append(initiate(*args, **kwargs))
+            return uploads[-1]
+
+        with mock.patch.object(self.bucket, 'initiate_multipart_upload',
+                               side_effect=record_upload):
+            storage.store_response(self.spider, request, self._response(request, body))
+        self.assertEqual(len(uploads), 1)
+        self.assertGreater(len(uploads[0].parts), 1)
+        self.assertEqual(uploads[0].metadata['digest'], storage.digests[
+            storage._get_request_storage_key(self.spider, request)])
+        self.assertEqual(storage.retrieve_response(self.spider, request).body, body)
+
+    def test_multipart_cancelled_on_error(self):
+        storage = self._storage(HISTORY_STREAMING_THRESHOLD=1024)
+        request = Request('http://example.com', meta={'epoch': True})
+        uploads = []
+        initiate = self.bucket.initiate_multipart_upload
+
+        def record_upload(*args, **kwargs):
+            uploads.append(initiate(*args, **kwargs))
+            return uploads[-1]
+
+        self.bucket.fail_parts = True
+        with mock.patch.object(self.bucket, 'initiate_multipart_upload',
+                               side_effect=record_upload):
+            self.assertRaises(S3ResponseError, storage.store_response, self.spider, request,
+                              self._response(request, b'x' * 2048))
+        self.assertTrue(uploads[0].cancelled)
+        self.assertFalse(self.bucket.uploads)
+        self.assertFalse(storage.manifest)
+        self.assertIsNone(storage.retrieve_response(self.spider, request))
+
+    def test_retried_write(self):
+        storage = self._storage(HISTORY_VERSION_INDEX=True)
+        request = Request('http://example.com', meta={'epoch': True})
+        response = self._response(request, b'body')
+        done = {}
+        # the source copy fails after the record is stored
+        with mock.patch.object(s3stub.Key, 'set_contents_from_file',
+                               side_effect=S3ResponseError(500, 'Internal Error')):
+            self.assertRaises(S3ResponseError, storage._measure_store, self.spider, request,
+                              response, done)
+        storage._measure_store(self.spider, request, response, done)
+
+        key = storage._get_request_storage_key(self.spider, request)
+        self.assertEqual(len(self.bucket.objects[key]), 1)
+        self.assertIn(storage._get_source_name(request), self.bucket.objects)
+        self.assertEqual(len(storage.manifest), 1)
+        self.assertEqual(len(storage.version_index.get(key.rsplit('/', 1)[1])), 1)
+        self.assertEqual(storage.retrieve_response(self.spider, request).body, b'body')
+
+    def test_content_addressed(self):
+        storage = self._storage(HISTORY_CONTENT_ADDRESSED=True)
+        body = os.urandom(10000)
+        requests = [Request('http://example.com/{}'.format(page), meta={'epoch': True})
+                    for page in 'abc']
+        for request, page_body in zip(requests, [body, body, b'other']):
+            storage.store_response(self.spider, request, self._response(request, page_body))
+
+        blob_name = 'blobs/' + body_digest(body)
+        self.assertEqual(len(self.bucket.objects[blob_name]), 1)
+        self.assertIn('blobs/' + body_digest(b'other'), self.bucket.objects)
+        self.assertEqual(storage.stats.get_value('history/blobs/known'), 1)
+        self.assertEqual(storage.stats.get_value('history/blobs/uploaded'), 2)
+        # records reference the body rather than holding it
+        key = storage._get_request_storage_key(self.spider, requests[0])
+        self.assertLess(len(self.bucket.version(key).data), len(body))
+        source = self.bucket.get_key(storage._get_source_name(requests[1]))
+        self.assertEqual(source.get_metadata('blob'), body_digest(body))
+        self.assertEqual(source.get_contents_as_string(), blob_name.encode('ascii'))
+
+        # another crawl finds the blob with a HEAD request
+        other = self._storage(HISTORY_CONTENT_ADDRESSED=True)
+        request = Request('http://example.com/d')
+        other.store_response(self.spider, request, self._response(request, body))
+        self.assertEqual(len(self.bucket.objects[blob_name]), 1)
+        self.assertEqual(other.stats.get_value('history/blobs/existing'), 1)
+
+        for request, page_body in zip(requests, [body, body, b'other']):
+            self.assertEqual(other.retrieve_response(self.spider, request).body, page_body)
+
+    def test_unsharded_keys(self):
+        unsharded = self._storage()
+        request = Request('http://example.com/a')
+        unsharded.store_response(self.spider, request, self._response(request, b'unsharded'))
+        only_unsharded = Request('http://example.com/b')
+        unsharded.store_response(self.spider, only_unsharded,
+                                 self._response(only_unsharded, b'b'))
+        storage = self._storage(HISTORY_S3_KEY_SHARD_WIDTH=2)
+        storage.store_response(self.spider, request, self._response(request, b'sharded'))
+        fingerprint = storage.request_fingerprint(request)
+        self.assertIn('example/cache/{}/{}'.format(fingerprint[:2], fingerprint),
+                      self.bucket.objects)
+
+        def retrieve(request, epoch):
+            return storage.retrieve_response(
+                self.spider, request.replace(meta={'epoch': epoch})).body
+
+        self.assertEqual(retrieve(request, True), b'sharded')
+        self.assertEqual(retrieve(only_unsharded, True), b'b')
+        # the unsharded version is the first one stored after the epoch
+        self.assertEqual(retrieve(request, datetime(2000, 1, 1)), b'unsharded')
+        self.assertEqual(storage.stats.get_value('history/unsharded/hit'), 2)
+        # between the unsharded version and the sharded one
+        unsharded_time = self.bucket.version(
+            'example/cache/{}'.format(fingerprint)).last_modified
+        epoch = datetime.strptime(unsharded_time, '%Y-%m-%dT%H:%M:%S.000Z') + timedelta(
+            seconds=1)
+        self.assertEqual(retrieve(request, epoch), b'sharded')
+        self.assertEqual(storage.stats.get_value('history/unsharded/hit'), 2)
+
+        storage = self._storage(HISTORY_S3_KEY_SHARD_WIDTH=2,
+                                HISTORY_S3_READ_UNSHARDED_KEYS=False)
+        self.assertIsNone(storage.retrieve_response(
+            self.spider, only_unsharded.replace(meta={'epoch': True})))
+
+    def test_sharded_source(self):
+        storage = self._storage(HISTORY_S3_KEY_SHARD_WIDTH=2)
+        request = Request('http://example.com/a')
+        storage.store_response(self.spider, request, self._response(request, b'a'))
+        name = '{}/source/{}/http%3A%2F%2Fexample.com%2Fa'.format(
+            storage.save_source, storage.request_fingerprint(request)[:2])
+        self.assertEqual(self.bucket.get_key(name).get_contents_as_string(), b'a')
+
+    def test_bloom_filter_miss(self):
+        storage = self._storage(HISTORY_BLOOM_FILTER=True, HISTORY_BLOOM_CAPACITY=1000)
+        stored = Request('http://example.com/a', meta={'epoch': True})
+        storage.store_response(self.spider, stored, self._response(stored, b'a'))
+        self.assertIn(storage.request_fingerprint(stored), storage.bloom_filter)
+
+        gets, listings = self.bucket.gets, self.bucket.listings
+        with mock.patch.object(self.bucket, 'get_key') as get_key, \
+                mock.patch.object(self.bucket, 'new_key') as new_key:
+            self.assertIsNone(storage.retrieve_response(
+                self.spider, Request('http://example.com/b', meta={'epoch': True})))
+        self.assertFalse(get_key.called or new_key.called)
+        self.assertEqual((self.bucket.gets, self.bucket.listings), (gets, listings))
+        self.assertEqual(storage.stats.get_value('history/bloom/skipped'), 1)
+        self.assertEqual(storage.retrieve_response(self.spider, stored).body, b'a')
+
+    def test_bloom_filter_saved(self):
+        settings = {'HISTORY_BLOOM_FILTER': True, 'HISTORY_BLOOM_CAPACITY': 1000}
+        first, second = self._storage(**settings), self._storage(**settings)
+        requests = [Request('http://example.com/{}'.format(page), meta={'epoch': True})
+                    for page in 'abc']
+        for storage, request in zip((first, second), requests):
+            storage.store_response(self.spider, request, self._response(request, b'page'))
+        first.close_spider(self.spider)
+        # merged with the filter saved by the first crawl
+        second.close_spider(self.spider)
+
+        storage = self._storage(**settings)
+        self.assertIsNone(storage.stats.get_value('history/bloom/built'))
+        for request in requests[:2]:
+            self.assertIn(storage.request_fingerprint(request), storage.bloom_filter)
+        self.assertNotIn(storage.request_fingerprint(requests[2]), storage.bloom_filter)
+
+        storage = self._storage(HISTORY_BLOOM_REBUILD=True, **settings)
+        self.assertEqual(storage.stats.get_value('history/bloom/built'), 2)
+        for request in requests[:2]:
+            self.assertIn(storage.request_fingerprint(request), storage.bloom_filter)
+
+    def _check_lazy_reads(self, record_format):
+        storage = self._storage(HISTORY_LAZY_BODY=True, HISTORY_RECORD_FORMAT=record_format,
+                                HISTORY_COMPRESSION='none')
+        body = b' '.join(str(i).encode('ascii') for i in range(1000))
+        stored = Request('http://example.com/stored', meta={'epoch': True})
+        storage.store_response(self.spider, stored, self._response(stored, body))
+        record_size = len(self.bucket.version(
+            storage._get_request_storage_key(self.spider, stored)).data)
+
+        # the record read from a segment sits between two others
+        spooled = Request('http://example.com/spooled', meta={'epoch': True})
+        path = os.path.join(tempfile.mkdtemp(), 'segment')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        writer = ArchiveWriter(path)
+        for url, page_body in (('http://example.com/before', b'before'),
+                               (spooled.url, body),
+                               ('http://example.com/after', b'after')):
+            request = Request(url)
+            data_string, _ = storage.codec.encode(request, self._response(request, page_body))
+            writer.append(storage.request_fingerprint(request), 1.0, data_string)
+        entries = writer.close()
+        segment_record_size = entries[1][3]
+        self.bucket.new_key('example/segments/1').set_contents_from_filename(path)
+        self.bucket.new_key('example/segments/1.idx').set_contents_from_string(
+            dump_index(entries))
+
+        for request, size in ((stored, record_size), (spooled, segment_record_size)):
+            # heads shorter than, as long as and longer than the record
+            for head_size in (size - 1, size, size + 1, 16):
+                storage.lazy_head_size = head_size
+                response = storage.retrieve_response(self.spider, request)
+                self.assertEqual(response.body, body, (request.url, head_size))
+                self.assertEqual(response.url, request.url)
+
+    def test_lazy_reads_binary(self):
+        self._check_lazy_reads('binary')
+
+    def test_lazy_reads_json(self):
+        self._check_lazy_reads('json')
+
+    def test_read_range_past_end(self):
+        storage = self._storage()
+        self.bucket.new_key('example/key').set_contents_from_string(b'0123456789')
+        self.assertEqual(storage._read_range('example/key', None, 8), b'89')
+        self.assertEqual(storage._read_range('example/key', None, 2, 4), b'234')
+        self.assertEqual(storage._read_range('example/key', None, 10), b'')
+
+    def test_version_index_misses(self):
+        storage = self._storage(HISTORY_VERSION_INDEX=True)
+        request = Request('http://example.com', meta={'epoch': True})
+        self.assertIsNone(storage.retrieve_response(self.spider, request))
+        self.assertIsNone(storage.retrieve_response(self.spider, request))
+        # listed once, to backfill the index
+        self.assertEqual(self.bucket.listings, 1)
+
+        storage.store_response(self.spider, request, self._response(request, b'first'))
+        self.assertEqual(self.bucket.listings, 1)
+        self.assertEqual(storage.retrieve_response(self.spider, request).body, b'first')
+
+    def _prefetching_storage(self, **settings):
+        """A storage whose prefetch runs the calls queued in `calls` when
+        told to, rather than on its pool.
+
+        """
+        storage = self._storage(HISTORY_PREFETCH=True, **settings)
+        storage.prefetched = LRUCache(storage.prefetch_cache_size)
+        storage.prefetcher = mock.Mock()
+        calls = []
+        storage.prefetcher.callInThread.side_effect = lambda f, *args: calls.append((f, args))
+        return storage, calls
+
+    def _run(self, calls, count=None):
+        for _ in range(len(calls) if count is None else count):
+            f, args = calls.pop(0)
+            f(*args)
+
+    def _store_pages(self, storage, count):
+        for i in range(count):
+            request = Request('http://example.com/{}'.format(i))
+            storage.store_response(self.spider, request, self._response(request, b'page'))
+
+    def test_prefetch_size_cap(self):
+        storage, calls = self._prefetching_storage(HISTORY_PREFETCH_CACHE_SIZE=1)
+        self._store_pages(storage, 3)
+        storage._prefetch(self.spider, True)
+        self.assertEqual(len(calls), 3)
+        self._run(calls)
+        # over the cap after the first download
+        self.assertEqual(storage.stats.get_value('history/prefetch/fetched'), 1)
+
+    def test_prefetch_stop(self):
+        storage, calls = self._prefetching_storage()
+        self._store_pages(storage, 3)
+        storage._prefetch(self.spider, True)
+        self._run(calls, 1)
+        prefetcher = storage.prefetcher
+        storage.close_spider(self.spider)
+        self.assertTrue(prefetcher.stop.called)
+        self._run(calls)
+        self.assertEqual(storage.stats.get_value('history/prefetch/fetched'), 1)
+
+    def test_prefetch_segments(self):
+        storage, calls = self._prefetching_storage()
+        request = Request('http://example.com', meta={'epoch': True})
+        data_string, _ = storage.codec.encode(request, self._response(request, b'spooled'))
+        path = os.path.join(tempfile.mkdtemp(), 'segment')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        writer = ArchiveWriter(path)
+        writer.append(storage.request_fingerprint(request), 1.0, data_string)
+        entries = writer.close()
+        self.bucket.new_key('example/segments/1').set_contents_from_filename(path)
+        self.bucket.new_key('example/segments/1.idx').set_contents_from_string(
+            dump_index(entries))
+
+        storage._prefetch(self.spider, True)
+        self._run(calls)
+        gets = self.bucket.gets
+        self.assertEqual(storage.retrieve_response(self.spider, request).body, b'spooled')
+        self.assertEqual(storage.stats.get_value('history/prefetch/hit'), 1)
+        self.assertEqual(self.bucket.gets, gets)
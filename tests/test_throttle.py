@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+import socket
+import unittest
+
+from boto.exception import S3ResponseError
+from scrapy.utils.test import get_crawler
+
+from history.throttle import AdaptiveLimiter, is_retryable
+
+
+class TestIsRetryable(unittest.TestCase):
+
+    def test_errors(self):
+        self.assertTrue(is_retryable(S3ResponseError(503, 'Slow Down')))
+        self.assertTrue(is_retryable(S3ResponseError(500, 'Internal Error')))
+        self.assertTrue(is_retryable(socket.timeout()))
+        self.assertFalse(is_retryable(S3ResponseError(403, 'Forbidden')))
+        self.assertFalse(is_retryable(ValueError()))
+
+
+class TestAdaptiveLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = get_crawler().stats
+        self.limiter = AdaptiveLimiter(self.stats, 8, target_latency=1.0)
+
+    def test_unlimited_rate(self):
+        self.assertEqual(self.limiter.concurrency, 8)
+        self.assertEqual(self.limiter.delay(0), 0)
+        self.assertEqual(self.limiter.delay(0), 0)
+
+    def test_multiplicative_decrease(self):
+        self.limiter.success(0.5, now=0)
+        self.limiter.failure(now=1)
+        self.assertEqual(self.limiter.concurrency, 4)
+        # half the throughput: 8 writes in flight taking 0.5s each
+        self.assertEqual(self.limiter.rate, 8)
+        self.assertEqual(self.stats.get_value('history/store/limit/concurrency'), 4)
+        self.assertEqual(self.stats.get_value('history/store/limit/rate'), 8)
+
+        # not decreased again by the writes started before
+        self.limiter.failure(now=1.5)
+        self.assertEqual(self.limiter.concurrency, 4)
+        self.limiter.failure(now=3)
+        self.assertEqual(self.limiter.concurrency, 2)
+        self.assertEqual(self.limiter.rate, 4)
+
+    def test_slow_writes_decrease_concurrency(self):
+        self.limiter.success(2.0, now=0)
+        self.assertEqual(self.limiter.concurrency, 4)
+        self.assertIsNone(self.limiter.rate)
+
+    def test_additive_increase(self):
+        self.limiter.success(0.5, now=0)
+        self.limiter.failure(now=1)
+        for _ in range(8):
+            self.limiter.success(0.5, now=2)
+        self.assertEqual(self.limiter.concurrency, 5)
+        self.assertAlmostEqual(self.limiter.rate, 9, places=0)
+
+    def test_rate(self):
+        limiter = AdaptiveLimiter(self.stats, 8, max_rate=2)
+        self.assertEqual(limiter.delay(10), 0)
+        self.assertEqual(limiter.delay(10), 0.5)
+        self.assertEqual(limiter.delay(10.5), 0)
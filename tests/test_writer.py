@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, unicode_literals
+import unittest
+
+from boto.exception import S3ResponseError
+from scrapy.utils.test import get_crawler
+from twisted.internet import defer, task
+from twisted.python.failure import Failure
+
+from history.writer import BoundedWriter
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class TestBoundedWriter(unittest.TestCase):
+    """Writes run as Deferreds fired by the tests, on a fake clock."""
+
+    def setUp(self):
+        # installs the reactor before it is patched
+        from twisted.internet import reactor  # noqa: F401
+        self.stats = get_crawler().stats
+        self.clock = task.Clock()
+        self.writes = []
+        for patcher in (mock.patch('twisted.internet.reactor', self.clock),
+                        mock.patch('history.writer.threads.deferToThreadPool',
+                                   side_effect=self._defer_write)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _defer_write(self, clock, pool, timed, func, args, kwargs):
+        d = defer.Deferred()
+        self.writes.append((d, args))
+        return d
+
+    def _writer(self, **kwargs):
+        writer = BoundedWriter(self.stats, **kwargs)
+        writer.pool = mock.Mock()
+        return writer
+
+    def _succeed(self, index=0):
+        self.writes.pop(index)[0].callback(0.1)
+
+    def _fail(self, error, index=0):
+        self.writes.pop(index)[0].errback(Failure(error))
+
+    def test_backpressure(self):
+        writer = self._writer(max_threads=1, queue_size=2)
+        self.assertIsNone(writer.submit(None, 1))
+        self.assertIsNone(writer.submit(None, 2))
+        accepted = writer.submit(None, 3)
+        self.assertFalse(accepted.called)
+        self.assertEqual(writer.depth, 3)
+        self.assertEqual(self.stats.get_value('history/store/queue_full'), 1)
+        # only max_threads writes run at once
+        self.assertEqual([args for _, args in self.writes], [(1,)])
+
+        self._succeed()
+        self.assertTrue(accepted.called)
+        self.assertEqual(writer.depth, 2)
+        self.assertEqual([args for _, args in self.writes], [(2,)])
+        self._succeed()
+        self._succeed()
+        self.assertEqual(writer.depth, 0)
+
+    def test_retry_exhaustion(self):
+        writer = self._writer(retries=2)
+        writer.submit(None, 1)
+        for delay in (1, 2):
+            self._fail(S3ResponseError(503, 'Slow Down'))
+            self.assertFalse(self.writes)
+            # exponential backoff
+            self.clock.advance(delay - 0.01)
+            self.assertFalse(self.writes)
+            self.clock.advance(0.01)
+            self.assertEqual(len(self.writes), 1)
+
+        self._fail(S3ResponseError(503, 'Slow Down'))
+        self.assertFalse(self.clock.getDelayedCalls())
+        self.assertEqual(self.stats.get_value('history/store/retried'), 2)
+        self.assertEqual(self.stats.get_value('history/store/failed'), 1)
+        self.assertEqual(writer.depth, 0)
+
+    def test_not_retryable(self):
+        writer = self._writer(retries=2)
+        writer.submit(None, 1)
+        self._fail(S3ResponseError(403, 'Forbidden'))
+        self.assertFalse(self.clock.getDelayedCalls())
+        self.assertIsNone(self.stats.get_value('history/store/retried'))
+        self.assertEqual(self.stats.get_value('history/store/failed'), 1)
+
+    def test_drain(self):
+        writer = self._writer(max_threads=1, queue_size=1)
+        writer.submit(None, 1)
+        writer.submit(None, 2)
+        drained = []
+        writer.drain().addCallback(drained.append)
+        self.assertFalse(drained)
+
+        self._fail(ValueError())
+        # the parked write runs before the pool stops
+        self.assertFalse(drained)
+        self.assertFalse(writer.pool.stop.called)
+        self._succeed()
+        self.assertTrue(drained)
+        self.assertTrue(writer.pool.stop.called)
+
+    def test_drain_idle(self):
+        writer = self._writer()
+        self.assertTrue(writer.drain().called)
+        self.assertTrue(writer.pool.stop.called)